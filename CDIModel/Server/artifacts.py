@@ -0,0 +1,146 @@
+import os
+import re
+import shutil
+import threading
+import uuid
+
+from encoder import IMAGE_FORMATS
+
+# base64: frames inside the JSON, as before; url: links into the artifact store;
+# multipart: a multipart/mixed body with a JSON part per frame followed by its image parts
+TRANSPORTS = ("base64", "url", "multipart")
+
+JOB_ID = re.compile(r"^[0-9a-f]{8,64}$")
+
+
+class FrameOptions:
+    """How a request wants its annotated frames delivered.
+
+    quality is the encoder's 0-100 quality (None keeps the encoder default) and max_dim caps the
+    longer side of full frames (0 keeps them full size). Outside base64 transport every frame
+    also gets a thumbnail no larger than thumbnail_dim; multipart bodies carry only the
+    thumbnails unless full_frames is set, the full frames being a URL away.
+    """
+
+    def __init__(self, transport="base64", image_format="jpeg", quality=None, max_dim=0, thumbnail_dim=320,
+                 full_frames=False):
+        if transport not in TRANSPORTS:
+            raise ValueError(f"transport must be one of {', '.join(TRANSPORTS)}")
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(f"frame_format must be one of {', '.join(IMAGE_FORMATS)}")
+        if quality is not None and not 1 <= quality <= 100:
+            raise ValueError("frame_quality must be between 1 and 100")
+        if max_dim < 0 or thumbnail_dim < 0:
+            raise ValueError("frame_max_dim and thumbnail_dim can't be negative")
+        self.transport = transport
+        self.image_format = image_format
+        self.quality = quality
+        self.max_dim = max_dim
+        self.thumbnail_dim = thumbnail_dim
+        self.full_frames = full_frames
+
+    @classmethod
+    def from_request(cls, values, accept="", default_transport="base64", default_thumbnail_dim=320):
+        """Options from request values (transport, frame_format, frame_quality, frame_max_dim,
+        thumbnail_dim, full_frames); without frame_format, WebP is picked if the Accept header lists it."""
+        image_format = values.get('frame_format')
+        if not image_format:
+            image_format = "webp" if "image/webp" in accept else "jpeg"
+        return cls(
+            transport=values.get('transport', default_transport),
+            image_format=image_format.lower().replace("jpg", "jpeg"),
+            quality=values.get('frame_quality', None, type=int),
+            max_dim=values.get('frame_max_dim', 0, type=int),
+            thumbnail_dim=values.get('thumbnail_dim', default_thumbnail_dim, type=int),
+            full_frames=values.get('full_frames', '0').lower() in ('1', 'true', 'yes'),
+        )
+
+    @property
+    def extension(self):
+        return IMAGE_FORMATS[self.image_format][0]
+
+    @property
+    def mimetype(self):
+        return IMAGE_FORMATS[self.image_format][1]
+
+    def cache_options(self):
+        """The options that change a cached response."""
+        return {"transport": self.transport, "frame_format": self.image_format, "frame_quality": self.quality,
+                "frame_max_dim": self.max_dim, "thumbnail_dim": self.thumbnail_dim}
+
+
+class ArtifactStore:
+    """Per-job directories of encoded frames, served by URL and trimmed oldest-first to max_bytes.
+
+    Job ids are the request's result cache key, so a cached response's URLs stay valid for as
+    long as the job directory exists.
+    """
+
+    def __init__(self, root, max_bytes=2 << 30):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def job_dir(self, job_id):
+        if not JOB_ID.match(job_id or ""):
+            raise ValueError(f"Invalid job id {job_id!r}")
+        return os.path.join(self.root, job_id)
+
+    def has_job(self, job_id):
+        """True if the job's frames are still stored; also marks it as recently used."""
+        path = self.job_dir(job_id)
+        if not os.path.isdir(path):
+            return False
+        os.utime(path)
+        return True
+
+    def save(self, job_id, name, data):
+        """Write one artifact; concurrent writers of the same job and name are harmless."""
+        path = self.job_dir(job_id)
+        os.makedirs(path, exist_ok=True)
+        target = os.path.join(path, name)
+        tmp_path = f"{target}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, target)  # readers never see a half-written frame
+        return name
+
+    def read(self, job_id, name):
+        with open(os.path.join(self.job_dir(job_id), name), 'rb') as f:
+            return f.read()
+
+    def trim(self):
+        """Remove the least recently used jobs until the store fits in max_bytes."""
+        with self.lock:
+            jobs = []
+            for job_id in os.listdir(self.root):
+                path = os.path.join(self.root, job_id)
+                try:
+                    size = sum(entry.stat().st_size for entry in os.scandir(path))
+                    jobs.append((os.stat(path).st_mtime, size, path))
+                except OSError:
+                    continue  # removed in the meantime
+            total = sum(size for _, size, _ in jobs)
+            for _, size, path in sorted(jobs):
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+
+
+def create_artifact_store(root):
+    """Store under root, capped at ARTIFACT_STORE_MB."""
+    return ArtifactStore(root, max_bytes=int(float(os.environ.get('ARTIFACT_STORE_MB', '2048')) * (1 << 20)))
+
+
+def multipart_part(boundary, body, content_type, content_id=None):
+    """One part of a multipart/mixed body, boundary line included."""
+    headers = [f"--{boundary}", f"Content-Type: {content_type}", f"Content-Length: {len(body)}"]
+    if content_id:
+        headers.append(f"Content-ID: <{content_id}>")
+    return ("\r\n".join(headers) + "\r\n\r\n").encode() + body + b"\r\n"
+
+
+def multipart_end(boundary):
+    return f"--{boundary}--\r\n".encode()
@@ -0,0 +1,67 @@
+import torch
+import detectron2.data.transforms as T
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.data import MetadataCatalog
+from detectron2.modeling import build_model
+from quantization import quantize_torch_linear
+
+
+class BatchPredictor:
+    """Drop-in replacement for detectron2's DefaultPredictor that can run many frames per forward pass.
+
+    GeneralizedRCNN already takes a list of images, so predict_batch() preprocesses the frames the
+    same way DefaultPredictor does and feeds them to the model batch_size at a time. Calling the
+    predictor with a single frame keeps the DefaultPredictor contract. quantize=True applies
+    dynamic int8 quantization to the model's Linear layers (CPU only).
+    """
+
+    def __init__(self, cfg, batch_size=4, quantize=False):
+        self.cfg = cfg.clone()
+        self.model = build_model(self.cfg)
+        self.model.eval()
+        if len(cfg.DATASETS.TEST):
+            self.metadata = MetadataCatalog.get(cfg.DATASETS.TEST[0])
+
+        DetectionCheckpointer(self.model).load(cfg.MODEL.WEIGHTS)
+        if quantize and self.cfg.MODEL.DEVICE == "cpu":
+            # int8 box head on CPU; the convolutional backbone stays fp32
+            self.model = quantize_torch_linear(self.model)
+
+        self.aug = T.ResizeShortestEdge(
+            [cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MIN_SIZE_TEST], cfg.INPUT.MAX_SIZE_TEST
+        )
+        self.input_format = cfg.INPUT.FORMAT
+        assert self.input_format in ["RGB", "BGR"], self.input_format
+        self.batch_size = max(1, int(batch_size))
+
+    def preprocess(self, frame, min_size=None):
+        """Turn a BGR uint8 frame into the input dict GeneralizedRCNN expects.
+
+        min_size overrides the config's MIN_SIZE_TEST for this frame.
+        """
+        if self.input_format == "RGB":
+            frame = frame[:, :, ::-1]
+        height, width = frame.shape[:2]
+        aug = self.aug if min_size is None else T.ResizeShortestEdge([min_size, min_size], self.cfg.INPUT.MAX_SIZE_TEST)
+        image = aug.get_transform(frame).apply_image(frame)
+        image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+        image = image.to(self.cfg.MODEL.DEVICE)
+        return {"image": image, "height": height, "width": width}
+
+    def predict_batch(self, frames, min_sizes=None):
+        """Run the model on a list of BGR frames; returns one {"instances": Instances} dict per frame.
+
+        min_sizes optionally gives each frame its own input size (see preprocess).
+        """
+        if min_sizes is None:
+            min_sizes = [None] * len(frames)
+        outputs = []
+        with torch.no_grad():
+            for start in range(0, len(frames), self.batch_size):
+                end = start + self.batch_size
+                inputs = [self.preprocess(frame, min_size) for frame, min_size in zip(frames[start:end], min_sizes[start:end])]
+                outputs.extend(self.model(inputs))
+        return outputs
+
+    def __call__(self, frame):
+        return self.predict_batch([frame])[0]
@@ -0,0 +1,78 @@
+"""Compare the old seek-per-sample loop against the sequential frame sampler.
+
+Usage:
+    python bench_frame_sampler.py uploaded_videos/video.mp4 --interval 1.0 --repeat 3
+"""
+import argparse
+import time
+
+import cv2
+
+from frame_sampler import get_video_fps, sample_frames
+
+
+def seek_loop(video_path, interval_seconds):
+    """The loop the upload_video handlers used: one CAP_PROP_POS_FRAMES seek per sample."""
+    cap = cv2.VideoCapture(video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    frame_interval = max(1, int(fps * interval_seconds))
+
+    frames = 0
+    for i in range(0, frame_count, frame_interval):
+        cap.set(cv2.CAP_PROP_POS_FRAMES, i)
+        ret, frame = cap.read()
+        if not ret or frame is None:
+            continue
+        frames += 1
+    cap.release()
+    return frames
+
+
+def sequential_loop(video_path, interval_seconds):
+    """Read the file once with grab()/retrieve() through sample_frames."""
+    cap = cv2.VideoCapture(video_path)
+    frames = sum(1 for _ in sample_frames(cap, interval_seconds=interval_seconds))
+    cap.release()
+    return frames
+
+
+def time_loop(loop, video_path, interval_seconds, repeat):
+    """Return (frames sampled, best wall time in seconds) over repeat runs."""
+    best = None
+    frames = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        frames = loop(video_path, interval_seconds)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return frames, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("videos", nargs="*", default=["uploaded_videos/video.mp4"])
+    parser.add_argument("--interval", type=float, default=1.0, help="Seconds between sampled frames")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per loop; the fastest is reported")
+    args = parser.parse_args()
+
+    for video_path in args.videos:
+        cap = cv2.VideoCapture(video_path)
+        if not cap.isOpened():
+            print(f"{video_path}: failed to open, skipping")
+            continue
+        fps = get_video_fps(cap)
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+
+        seek_frames, seek_time = time_loop(seek_loop, video_path, args.interval, args.repeat)
+        seq_frames, seq_time = time_loop(sequential_loop, video_path, args.interval, args.repeat)
+
+        print(f"{video_path}: {frame_count} frames @ {fps:.2f} fps, sampling every {args.interval}s")
+        print(f"  seek loop:       {seek_frames:4d} frames in {seek_time:.3f}s ({seek_time / max(seek_frames, 1) * 1000:.1f} ms/sample)")
+        print(f"  sequential loop: {seq_frames:4d} frames in {seq_time:.3f}s ({seq_time / max(seq_frames, 1) * 1000:.1f} ms/sample)")
+        print(f"  speedup: {seek_time / seq_time:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+"""Headless latency and accuracy benchmark for every stage of the frame pipeline.
+
+Stages: decode (JPEG read), yolo, vgg, damage, parts, render (damage overlay) and encode
+(JPEG + base64). For each one it reports p50/p95/p99 latency, throughput and the process's
+peak RSS after the stage. It also reports box mAP of the damage detector against
+COCO_val_annos.json and of the parts detector against COCO_mul_val_annos.json. Stages whose
+weights aren't given are skipped.
+
+Results go to JSON (--output). With --baseline the run is compared against an earlier
+report, and the exit code is 1 if any stage's p50 or p95 slowed by more than --max-slowdown
+(and --min-slowdown-ms), or any mAP dropped by more than --max-map-drop.
+
+Usage:
+    python benchmark.py --yolo-weights ../yolo/yolov5s.onnx --vgg-weights ../vgg/vgg_damage_model.pth \\
+        --damage-config ../V_MODELS/damage/config_detectron.yaml --damage-weights ../V_MODELS/damage/detectron_model.pth \\
+        --parts-config ../V_MODELS/parts/config.yaml --parts-weights ../V_MODELS/parts/parts_model_final.pth \\
+        --output bench.json
+    python benchmark.py --random-vgg --output bench.json --baseline bench_main.json
+"""
+import argparse
+import base64
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from evaluation import CocoGroundTruth, coco_map, instances_to_predictions
+from part_mapping import PART_CLASS_NAMES
+
+# COCO_mul_val_annos.json category -> parts model classes that count as that category
+PART_CATEGORY_CLASSES = {
+    "headlamp": ["Headlight - -L-", "Headlight - -R-"],
+    "rear_bumper": ["Rear bumper"],
+    "door": ["Driver-s door - -F-R-", "Passenger-s door - -F-L-", "Passenger-s door - -R-L-", "Passenger-s door - -R-R-"],
+    "hood": ["Car hood"],
+    "front_bumper": ["Front bumper"],
+}
+
+
+def time_calls(fn, inputs, warmup=1):
+    """Run fn on every input after warmup calls; returns (outputs, latencies in ms)."""
+    for item in inputs[:warmup]:
+        fn(item)
+    outputs, latencies = [], []
+    for item in inputs:
+        start = time.perf_counter()
+        outputs.append(fn(item))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return outputs, latencies
+
+
+def latency_summary(latencies):
+    """p50/p95/p99/mean in ms and throughput in items per second."""
+    if not latencies:
+        return {}
+    return {
+        "count": len(latencies),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+        "mean_ms": round(float(np.mean(latencies)), 3),
+        "throughput_per_s": round(1000.0 * len(latencies) / max(sum(latencies), 1e-9), 2),
+    }
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far (ru_maxrss is KiB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1 << 20) if sys.platform == "darwin" else peak / 1024, 1)
+
+
+def load_detectron_predictor(config, weights, quantize=False):
+    from detectron2.config import get_cfg
+    from batch_predictor import BatchPredictor
+
+    cfg = get_cfg()
+    cfg.merge_from_file(config)
+    cfg.MODEL.WEIGHTS = weights
+    cfg.MODEL.DEVICE = "cpu"
+    return BatchPredictor(cfg, batch_size=1, quantize=quantize)
+
+
+def parts_category_map(ground_truth):
+    """Parts model class id -> annotation category id, for the classes the annotations cover."""
+    ids_by_name = {name: category_id for category_id, name in ground_truth.categories.items()}
+    return {PART_CLASS_NAMES.index(cls): ids_by_name[category]
+            for category, classes in PART_CATEGORY_CLASSES.items() if category in ids_by_name
+            for cls in classes}
+
+
+def run_benchmark(args):
+    data_dir = args.data
+    datasets = [name for name in args.datasets.split(",") if name]
+    paths = []
+    for name in datasets:
+        folder = os.path.join(data_dir, name)
+        names = sorted(f for f in os.listdir(folder) if f.lower().endswith((".jpg", ".jpeg", ".png")))
+        paths.extend(os.path.join(folder, f) for f in names[:args.limit])
+    if not paths:
+        raise SystemExit(f"No images found under {data_dir} for {datasets}")
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {"platform": platform.platform(), "cpus": os.cpu_count(), "torch_threads": torch.get_num_threads()},
+        "datasets": datasets,
+        "images": len(paths),
+        "int8": args.int8,
+        "stages": {},
+        "accuracy": {},
+    }
+    stages = report["stages"]
+
+    def record(stage, latencies):
+        stages[stage] = dict(latency_summary(latencies), peak_rss_mb=peak_rss_mb())
+        print(f"{stage:>7}: p50 {stages[stage]['p50_ms']:.1f} ms, p95 {stages[stage]['p95_ms']:.1f} ms, "
+              f"{stages[stage]['throughput_per_s']:.1f}/s, peak RSS {stages[stage]['peak_rss_mb']} MB")
+
+    frames, latencies = time_calls(cv2.imread, paths)
+    record("decode", latencies)
+
+    from process_video import VGGModel, YOLOModel
+    cars = [[] for _ in frames]
+    if args.yolo_weights:
+        yolo = YOLOModel(args.yolo_weights, quantize=args.int8, calibration_dir=args.calibration)
+        cars, latencies = time_calls(yolo.detect_cars, frames)
+        record("yolo", latencies)
+
+    vgg_weights = args.vgg_weights
+    if vgg_weights is None and args.random_vgg:
+        from torchvision import models
+        model = models.vgg16(pretrained=False)
+        model.classifier[6] = torch.nn.Linear(4096, 3)
+        vgg_weights = os.path.join(tempfile.mkdtemp(prefix="bench_"), "vgg_random.pth")
+        torch.save(model.state_dict(), vgg_weights)
+    if vgg_weights:
+        vgg = VGGModel(vgg_weights, backend=args.vgg_backend, quantize=args.int8)
+        # The primary car's crop, or the centre of the image when YOLO didn't run or found nothing
+        crops = []
+        for frame, frame_cars in zip(frames, cars):
+            h, w = frame.shape[:2]
+            x1, y1, x2, y2 = frame_cars[0][:4] if frame_cars else (w // 8, h // 8, w - w // 8, h - h // 8)
+            crops.append(frame[y1:y2, x1:x2])
+        _, latencies = time_calls(lambda crop: vgg.classify_with_confidence([crop]), crops)
+        record("vgg", latencies)
+
+    rendered = frames
+    if args.damage_config and args.damage_weights:
+        predictor = load_detectron_predictor(args.damage_config, args.damage_weights, args.int8)
+        damage_outputs, latencies = time_calls(predictor, frames)
+        record("damage", latencies)
+
+        from overlay import draw_damage_overlay
+        rendered, latencies = time_calls(lambda item: draw_damage_overlay(item[0], item[1]["instances"]),
+                                         list(zip(frames, damage_outputs)))
+        record("render", latencies)
+
+        ground_truth = CocoGroundTruth(args.damage_annotations)
+        val_frames = {name: cv2.imread(path) for name, path in ground_truth.image_paths()}
+        predictions = {name: instances_to_predictions(predictor(frame)["instances"], {0: min(ground_truth.categories)})
+                       for name, frame in val_frames.items()}
+        report["accuracy"]["damage"] = coco_map(ground_truth, predictions)
+
+    if args.parts_config and args.parts_weights:
+        predictor = load_detectron_predictor(args.parts_config, args.parts_weights, args.int8)
+        _, latencies = time_calls(predictor, frames)
+        record("parts", latencies)
+
+        ground_truth = CocoGroundTruth(args.parts_annotations)
+        category_map = parts_category_map(ground_truth)
+        predictions = {name: instances_to_predictions(predictor(cv2.imread(path))["instances"], category_map)
+                       for name, path in ground_truth.image_paths()}
+        report["accuracy"]["parts"] = coco_map(ground_truth, predictions)
+
+    _, latencies = time_calls(
+        lambda image: base64.b64encode(cv2.imencode(".jpg", image)[1]).decode("utf-8"), rendered
+    )
+    record("encode", latencies)
+
+    for model, quality in report["accuracy"].items():
+        print(f"{model} mAP {quality['mAP']}, AP50 {quality['AP50']}")
+    return report
+
+
+def find_regressions(report, baseline, max_slowdown=0.1, max_map_drop=0.01, min_slowdown_ms=1.0):
+    """Human-readable descriptions of every stage that got slower, or model that got less accurate.
+
+    A slowdown must exceed both max_slowdown (relative) and min_slowdown_ms, so timer noise on
+    millisecond stages doesn't fail the check.
+    """
+    regressions = []
+    for stage, stats in report["stages"].items():
+        old = baseline.get("stages", {}).get(stage)
+        if not old:
+            continue
+        for metric in ("p50_ms", "p95_ms"):
+            if (old.get(metric) and stats[metric] > old[metric] * (1 + max_slowdown)
+                    and stats[metric] - old[metric] > min_slowdown_ms):
+                regressions.append(f"{stage} {metric}: {old[metric]} -> {stats[metric]} "
+                                   f"(+{(stats[metric] / old[metric] - 1) * 100:.0f}%)")
+    for model, quality in report["accuracy"].items():
+        old = baseline.get("accuracy", {}).get(model, {}).get("mAP")
+        if old is not None and quality["mAP"] is not None and quality["mAP"] < old - max_map_drop:
+            regressions.append(f"{model} mAP: {old:.4f} -> {quality['mAP']:.4f}")
+    return regressions
+
+
+def main():
+    data_dir = os.path.join("..", "data")
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", default=data_dir)
+    parser.add_argument("--datasets", default="img,test,val", help="Comma-separated folders under --data")
+    parser.add_argument("--limit", type=int, default=50, help="Images per dataset")
+    parser.add_argument("--yolo-weights")
+    parser.add_argument("--vgg-weights")
+    parser.add_argument("--random-vgg", action="store_true", help="Use a randomly initialised VGG")
+    parser.add_argument("--vgg-backend", default="torch", choices=["torch", "onnx"])
+    parser.add_argument("--damage-config")
+    parser.add_argument("--damage-weights")
+    parser.add_argument("--parts-config")
+    parser.add_argument("--parts-weights")
+    parser.add_argument("--damage-annotations", default=os.path.join(data_dir, "val", "COCO_val_annos.json"))
+    parser.add_argument("--parts-annotations", default=os.path.join(data_dir, "val", "COCO_mul_val_annos.json"))
+    parser.add_argument("--int8", action="store_true", help="Benchmark the int8 models")
+    parser.add_argument("--calibration", default=os.path.join(data_dir, "img"), help="Images for YOLO int8 calibration")
+    parser.add_argument("--threads", type=int, help="torch intra-op threads")
+    parser.add_argument("--output", help="Write the report as JSON here")
+    parser.add_argument("--baseline", help="Earlier report to check for regressions")
+    parser.add_argument("--max-slowdown", type=float, default=0.1, help="Allowed p50/p95 slowdown, as a fraction")
+    parser.add_argument("--min-slowdown-ms", type=float, default=1.0, help="Ignore slowdowns smaller than this")
+    parser.add_argument("--max-map-drop", type=float, default=0.01, help="Allowed absolute mAP drop")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    report = run_benchmark(args)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(report, json.load(f), args.max_slowdown, args.max_map_drop,
+                                           args.min_slowdown_ms)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print("No regressions against the baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,51 +1,121 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory
 import cv2
 import os
-import base64
 import torch
 from detectron2.config import get_cfg
-from detectron2.engine import DefaultPredictor
-from detectron2.utils.visualizer import Visualizer
 from detectron2.data import MetadataCatalog
 from flask_cors import CORS
-from detectron2.utils.visualizer import ColorMode
 import traceback
-from process_video import YOLOModel, VGGModel, process_frame
+import json
+from contextlib import closing
+from process_video import YOLOModel, VGGModel, analyze_cars, draw_cars
+from frame_sampler import sample_frames, batch_frames, prefetch_frames, sample_growing_video
+from overlay import draw_damage_overlay, draw_tracked_damage
+from batch_predictor import BatchPredictor
+from roi import predict_rois
+from model_pool import ModelPool
+from pipeline import Pipeline, Stage, parse_workers
+from artifacts import FrameOptions, create_artifact_store, multipart_part, multipart_end
+from encoder import create_frame_encoder
+from uploads import UploadStore, UploadOffsetError
+from keyframes import KeyframeSelector
+from cascade import Cascade
+from damage_tracker import DamageTracker, boxes_to_array, car_signature
+from part_mapping import PART_CLASS_NAMES, assign_damage_to_parts
+from result_cache import create_result_cache, file_digest, cache_key, model_version
+import metrics
+from metrics import stage_timer, timed_iter
 from flask_cors import CORS
-import matplotlib.pyplot as plt
+from werkzeug.utils import secure_filename
 import numpy as np
+import uuid
 
 app = Flask(__name__)
 CORS(app)
+# /metrics and per-request trace ids
+metrics.init_app(app)
 
-# Initialize YOLO and VGG models
-yolo_model = YOLOModel(r"D:\CarInsuranceClaim\CDIModel\yolo\yolov5s.onnx")
-vgg_model = VGGModel(r"D:\CarInsuranceClaim\CDIModel\vgg\vgg_damage_model.pth")
+# Number of sampled frames sent through each Detectron2 forward pass
+inference_batch_size = int(os.environ.get('INFERENCE_BATCH_SIZE', '4'))
 
-# Initialize Detectron2 model for damage detection
+# Sampled frames decoded ahead of inference on a background thread; 0 decodes inline
+decode_queue_size = int(os.environ.get('DECODE_QUEUE_SIZE', '8'))
+
+# Damage detection config
 damage_cfg = get_cfg()
 damage_cfg.merge_from_file(r"D:\CarInsuranceClaim\CDIModel\V_MODELS\damage\config_detectron.yaml")
 damage_cfg.MODEL.WEIGHTS = r"D:\CarInsuranceClaim\CDIModel\V_MODELS\damage\detectron_model.pth"
 damage_cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = 0.7
 damage_cfg.MODEL.DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-damage_predictor = DefaultPredictor(damage_cfg)
 
-# Initialize Detectron2 model for car part detection
+# Car part detection config
 parts_cfg = get_cfg()
 parts_cfg.merge_from_file(r"D:\CarInsuranceClaim\CDIModel\V_MODELS\parts\config.yaml")
 parts_cfg.MODEL.WEIGHTS = r"D:\CarInsuranceClaim\CDIModel\V_MODELS\parts\parts_model_final.pth"
 parts_cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = 0.5
 parts_cfg.MODEL.DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-parts_predictor = DefaultPredictor(parts_cfg)
+
+yolo_weights = r"D:\CarInsuranceClaim\CDIModel\yolo\yolov5s.onnx"
+vgg_weights = r"D:\CarInsuranceClaim\CDIModel\vgg\vgg_damage_model.pth"
+
+# INT8_INFERENCE=1 runs int8 copies of the models on CPU; YOLO is calibrated on the QUANT_CALIBRATION_DIR images
+int8_inference = os.environ.get('INT8_INFERENCE', '0') == '1'
+quant_calibration_dir = os.environ.get('QUANT_CALIBRATION_DIR', r"D:\CarInsuranceClaim\CDIModel\data\img")
+
+def build_models(num_threads):
+    """Load one replica of every model the frame pipeline uses."""
+    return {
+        "yolo": YOLOModel(yolo_weights, intra_op_threads=num_threads,
+                          quantize=int8_inference, calibration_dir=quant_calibration_dir),
+        # VGG_BACKEND=onnx runs the classifier through onnxruntime
+        "vgg": VGGModel(vgg_weights,
+                        backend=os.environ.get('VGG_BACKEND', 'torch'),
+                        intra_op_threads=int(os.environ.get('VGG_THREADS', '0')) or num_threads,
+                        quantize=int8_inference),
+        "damage": BatchPredictor(damage_cfg, batch_size=inference_batch_size, quantize=int8_inference),
+        "parts": BatchPredictor(parts_cfg, batch_size=inference_batch_size, quantize=int8_inference),
+    }
+
+# Sampled frames closer than this (0..1) to the last processed frame reuse its results; 0 disables
+default_keyframe_threshold = float(os.environ.get('KEYFRAME_THRESHOLD', '0.04'))
+default_keyframe_method = os.environ.get('KEYFRAME_METHOD', 'diff')
+
+# Early exits for undamaged cars; see cascade.py for the CASCADE_* settings
+default_cascade = Cascade.from_env()
+
+# ROI_INFERENCE=1 runs damage and part detection on the padded YOLO car crop at a size picked from the crop
+roi_inference = os.environ.get('ROI_INFERENCE', '1') == '1'
+roi_padding = float(os.environ.get('ROI_PADDING', '0.1'))
+
+def predict_frames(predictor, frames, car_boxes):
+    """predict_batch, or predict_rois on the car crops in ROI mode; results are in frame coordinates."""
+    if roi_inference:
+        return predict_rois(predictor, frames, car_boxes, padding=roi_padding)
+    return predictor.predict_batch(frames)
+
+# Tracked frames in a row before Detectron2 damage detection runs again; 0 detects every frame.
+# Tracking stays opt-in: tracked frames show Kalman-predicted boxes instead of fresh masks, and
+# their accuracy against per-frame detection hasn't been measured on the validation set yet.
+damage_track_max_skip = int(os.environ.get('DAMAGE_TRACK_MAX_SKIP', '0'))
+
+# Worker threads per pipeline stage (cars, parts, encode; damage always has one) and the queue between stages;
+# PIPELINE_THREADED=0 runs the stages one after another on the request thread
+pipeline_workers = parse_workers(os.environ.get('PIPELINE_WORKERS', 'cars=1,parts=1,encode=2'))
+pipeline_queue_size = int(os.environ.get('PIPELINE_QUEUE_SIZE', '2'))
+pipeline_threaded = os.environ.get('PIPELINE_THREADED', '1') == '1'
+
+# MODEL_REPLICAS copies of the models, each on its own slice of the CPU cores
+model_pool = ModelPool(build_models, replicas=int(os.environ.get('MODEL_REPLICAS', '1')))
+
+# Per-frame results per uploaded video, keyed by the video's hash, the weights and the request options
+video_cache = create_result_cache('upload_video')
+vision_version = model_version(yolo_weights, vgg_weights, damage_cfg.MODEL.WEIGHTS, parts_cfg.MODEL.WEIGHTS,
+                               os.environ.get('VGG_BACKEND', 'torch'), f"roi={roi_inference}:{roi_padding}", f"int8={int8_inference}")
+# Most result bytes a streamed run buffers for the cache; longer runs (in practice base64 frames) aren't cached
+stream_cache_max_bytes = int(float(os.environ.get('STREAM_CACHE_MB', '32')) * (1 << 20))
 
 # Define car part class names
-class_names = [
-    "Car-parts", "Car boot", "Car hood", "Driver-s door - -F-R-", "Fender - -F-L-",
-    "Fender - -F-R-", "Fender - -R-L-", "Fender - -R-R-", "Front bumper",
-    "Headlight - -L-", "Headlight - -R-", "Passenger-s door - -F-L-", "Passenger-s door - -R-L-",
-    "Passenger-s door - -R-R-", "Rear bumper", "Rear light - -L-", "Rear light - -R-",
-    "Side bumper - -L-", "Side bumper - -R-", "Side mirror - -L-", "Side mirror - -R-"
-]
+class_names = PART_CLASS_NAMES
 
 # Assign class names to metadata
 parts_metadata = MetadataCatalog.get("my_dataset_test")
@@ -58,56 +128,71 @@ processed_frame_folder = './processed_frames'
 os.makedirs(uploaded_videos_folder, exist_ok=True)
 os.makedirs(processed_frame_folder, exist_ok=True)
 
-def encode_image_to_base64(image):
-    """Convert an image to a Base64 string."""
+# Resumable chunked uploads, one file per upload next to its <upload_id>.json progress; deleted once
+# their results have been streamed, or after UPLOAD_TTL_HOURS without a new chunk
+upload_store = UploadStore(uploaded_videos_folder, ttl_seconds=float(os.environ.get('UPLOAD_TTL_HOURS', '24')) * 3600)
+
+# Encoded frames of url/multipart responses, one directory per job, served under /processed_frames/<job_id>/
+artifact_store = create_artifact_store(os.path.join(processed_frame_folder, 'jobs'))
+
+# FRAME_TRANSPORT=url or multipart changes the default frame delivery; base64 keeps frames inside the JSON
+default_frame_transport = os.environ.get('FRAME_TRANSPORT', 'base64')
+default_thumbnail_dim = int(os.environ.get('FRAME_THUMBNAIL_DIM', '320'))
+
+# Thread pool that JPEG/WebP-encodes result frames off the inference path; see encoder.create_frame_encoder
+frame_encoder = create_frame_encoder()
+
+def artifact_url(job_id, filename):
+    return f"/processed_frames/{job_id}/{filename}"
+
+def submit_frame_encodes(image, frame_options):
+    """Start encoding a frame, and outside base64 transport its thumbnail, on the encoder pool; returns {kind: future}."""
+    if frame_options.transport == "base64":
+        return {"frame": frame_encoder.submit_base64(image, frame_options.image_format, frame_options.quality,
+                                                     frame_options.max_dim)}
+    futures = {"frame": frame_encoder.submit(image, frame_options.image_format, frame_options.quality,
+                                             frame_options.max_dim)}
+    if frame_options.thumbnail_dim:
+        futures["thumbnail"] = frame_encoder.submit(image, frame_options.image_format, frame_options.quality,
+                                                    frame_options.thumbnail_dim)
+    return futures
+
+def frame_fields(name, futures, frame_options, job_id):
+    """Wait for a frame's encodes and return its result fields: base64 data, or the URLs of the stored artifacts."""
     try:
-        _, img_encoded = cv2.imencode('.jpg', image)
-        if img_encoded is None:
+        encoded = {kind: future.result() for kind, future in futures.items()}
+        if encoded["frame"] is None:
             raise ValueError("Failed to encode image")
-        return base64.b64encode(img_encoded).decode('utf-8')
+        if frame_options.transport == "base64":
+            return {"frame": encoded["frame"]}
+
+        filename = artifact_store.save(job_id, f"{name}{frame_options.extension}", encoded["frame"])
+        fields = {"frame_url": artifact_url(job_id, filename), "frame_type": frame_options.mimetype}
+        if encoded.get("thumbnail") is not None:
+            filename = artifact_store.save(job_id, f"{name}_thumb{frame_options.extension}", encoded["thumbnail"])
+            fields["thumbnail_url"] = artifact_url(job_id, filename)
+        return fields
     except Exception as e:
-        print(f"Error encoding image: {e}")
+        print(f"Error encoding {name}: {e}")
         return None
 
-def detect_damage(frame):
-    """Run the Detectron2 model on the processed frame and return the annotated image."""
-    outputs = damage_predictor(frame)
+def detect_damage(frame, outputs):
+    """Annotate the processed frame with the damage predictor's outputs.
 
+    Returns the image and the damage bounding boxes as ((x1, y1), (x2, y2)) in frame coordinates.
+    """
     # Extract predictions
-    instances = outputs["instances"]
-    scores = instances.scores
-    pred_classes = instances.pred_classes
-    pred_boxes = instances.pred_boxes
-
-    # Visualize results
-    v = Visualizer(frame[:, :, ::-1], MetadataCatalog.get(damage_cfg.DATASETS.TEST[0]), scale=0.5)
-    out = v.draw_instance_predictions(instances.to("cpu"))
-
-    # Annotate the damage on the frame
-    damage_count = len(pred_classes)
-    for i in range(damage_count):
-        score = scores[i].item()
-        label = pred_classes[i].item()
-        damage_text = f"Damage: {label}, {score*100:.2f}%"
-
-        # Get bounding box
-        box = pred_boxes[i].tensor.cpu().numpy().flatten()
-        top_left = (int(box[0]), int(box[1]))
-        bottom_right = (int(box[2]), int(box[3]))
-
-        # Draw text
-        out.ax.text(top_left[0], top_left[1] - 10, damage_text, color='white', fontsize=10,
-                    bbox=dict(facecolor='black', alpha=0.5, boxstyle='round,pad=0.3'))
-
-    # Display total damage parts at the bottom
-    damage_count_text = f"Total Damage Parts: {damage_count}"
-    out.ax.text(0.5, 0.05, damage_count_text, color='white', fontsize=10, ha='center', va='bottom',
-                transform=out.ax.transAxes, bbox=dict(facecolor='black', alpha=0.7, boxstyle='round,pad=0.5')) 
-
-    return out.get_image()[:, :, ::-1]
-
-def detect_parts(frame):
-    """Run the car part detection model on the frame and return the annotated image."""
+    instances = outputs["instances"].to("cpu")
+
+    damage_boxes = []
+    for box in instances.pred_boxes.tensor.numpy():
+        damage_boxes.append(((int(box[0]), int(box[1])), (int(box[2]), int(box[3]))))
+
+    # Draw masks, boxes, labels and the damage count straight into the frame buffer
+    return draw_damage_overlay(frame, instances), damage_boxes
+
+def detect_parts(frame, outputs):
+    """Annotate the frame with the car part predictor's outputs and return the image."""
     # Ensure the frame is a valid NumPy array in BGR format
     if frame is None or not isinstance(frame, np.ndarray):
         print("Invalid frame detected in detect_parts")
@@ -116,9 +201,6 @@ def detect_parts(frame):
     # Ensure the frame is contiguous and of type uint8
     frame = np.ascontiguousarray(frame, dtype=np.uint8)
 
-    # Run the part detection model
-    outputs = parts_predictor(frame)
-
     # Extract predictions
     instances = outputs["instances"].to("cpu")
     pred_classes = instances.pred_classes.numpy()
@@ -159,9 +241,353 @@ def detect_parts(frame):
 
     return frame
 
+def new_work(batch, is_key):
+    """Pipeline work item for one batch of sampled frames; is_key marks the keyframes to analyze."""
+    return {
+        "batch": batch,
+        "is_key": is_key,
+        "keyframes": [sample for sample, key in zip(batch, is_key) if key],
+        "damage_items": [],  # (frame_index, timestamp, processed_frame, label, car_box) for frames past the cascade
+        "parts_items": [],  # (frame_index, timestamp, damage_frame, label, car_box, damage_array, stages) for frames that need part detection
+        "finished": [],  # (frame_index, timestamp, image, label, stages, damaged_parts) ready to encode
+        "results": {},
+    }
+
+def analyze_cars_stage(work, models, cascade):
+    """YOLO and VGG on every keyframe; frames without a car, or with an undamaged one, finish here."""
+    for i, timestamp, frame in work["keyframes"]:
+        print(f"Processing frame {i} with dimensions: {frame.shape}")
+
+        # Detect and classify cars using YOLO and VGG models
+        with stage_timer("process_frame"):
+            cars = analyze_cars(frame, models["yolo"], models["vgg"])
+        if not cars:
+            work["finished"].append((i, timestamp, frame, "No car detected", ["yolo"], ()))
+            continue
+
+        label = f"{cars[0]['class']}"
+        processed_frame = draw_cars(frame, cars)
+
+        # A car VGG is confident is undamaged doesn't need the Detectron2 stages
+        if not cascade.should_run_damage(cars[0]):
+            work["finished"].append((i, timestamp, processed_frame, label, ["yolo", "vgg"], ()))
+            continue
+
+        work["damage_items"].append((i, timestamp, processed_frame, label, cars[0]["box"]))
+    return work
+
+def detect_damage_stage(work, models, cascade, tracker):
+    """Damage detection on the frames the tracker can't cover; the others reuse its tracks.
+
+    The tracker plans which frames of the batch need detection and those go through the model
+    in one batch. The frames are then applied to the tracker in order; where a detection ended
+    differently than planned (damage lost, or none found), the rest of the batch is planned and
+    batched again, keeping the detections already made. The tracker is stateful, so this stage
+    must see the batches in order and one at a time.
+    """
+    pending = work["damage_items"]
+    damage_outputs = {}  # frame index -> detection, made but not applied yet
+    while pending:
+        plan = tracker.plan_detections([item[4] for item in pending], [item[2] for item in pending])
+        detect_items = [item for item, detect in zip(pending, plan) if detect and item[0] not in damage_outputs]
+        if detect_items:
+            try:
+                with stage_timer("detect_damage"):
+                    outputs = predict_frames(models["damage"], [item[2] for item in detect_items],
+                                             [item[4] for item in detect_items])
+            except Exception as e:
+                # The tracker hasn't seen these frames; send them on without damage results
+                print(f"Error in damage detection: {e}")
+                print(traceback.format_exc())
+                for i, timestamp, processed_frame, label, _ in pending:
+                    work["finished"].append((i, timestamp, processed_frame, label, ["yolo", "vgg"], ()))
+                return work
+            damage_outputs.update(zip([item[0] for item in detect_items], outputs))
+
+        applied = 0
+        for item in pending:
+            i, _, processed_frame, _, car_box = item
+            if i in damage_outputs:
+                outputs = damage_outputs.pop(i)
+                signature = car_signature(processed_frame, car_box)  # before the overlay is drawn into the frame
+                with stage_timer("render"):
+                    damage_frame, damage_boxes = detect_damage(processed_frame, outputs)
+                damage_array = boxes_to_array(damage_boxes)
+                tracker.update(i, damage_array, outputs["instances"].scores.cpu().numpy(), car_box, signature)
+                finish_damage(work, cascade, item, damage_frame, damage_array, ["yolo", "vgg", "damage"])
+            elif tracker.needs_detection(car_box, processed_frame):
+                break  # planned as tracked, but an earlier detection didn't end as expected
+            else:
+                # Tracks are advanced in frame order so the Kalman predictions line up with detections
+                tracks = tracker.carry_forward()
+                with stage_timer("render"):
+                    damage_frame = draw_tracked_damage(processed_frame, tracks)
+                damage_array = np.array([track.box for track in tracks], dtype=np.float32).reshape(-1, 4)
+                finish_damage(work, cascade, item, damage_frame, damage_array, ["yolo", "vgg", "track"])
+            applied += 1
+        pending = pending[applied:]
+    return work
+
+def finish_damage(work, cascade, item, damage_frame, damage_array, stages):
+    """Queue a frame for part detection, or finish it when it has no damage to attribute."""
+    i, timestamp, _, label, car_box = item
+    damage_frame = np.ascontiguousarray(damage_frame, dtype=np.uint8)
+
+    # Without any damage there is nothing to attribute to a part
+    if not cascade.should_run_parts(len(damage_array)):
+        work["finished"].append((i, timestamp, damage_frame, label, stages, ()))
+        return
+    work["parts_items"].append((i, timestamp, damage_frame, label, car_box, damage_array, stages + ["parts"]))
+
+def detect_parts_stage(work, models):
+    """Part detection once per damage frame, all frames in one batch, and damage-to-part attribution."""
+    parts_items = work["parts_items"]
+    if not parts_items:
+        return work
+
+    try:
+        with stage_timer("detect_parts"):
+            parts_outputs = predict_frames(models["parts"], [item[2] for item in parts_items], [item[4] for item in parts_items])
+    except Exception as e:
+        print(f"Error in part detection: {e}")
+        print(traceback.format_exc())
+        return work
+
+    for (i, timestamp, damage_frame, label, _, damage_array, stages), outputs in zip(parts_items, parts_outputs):
+        # Attribute every damage region to the part that covers most of it
+        instances = outputs["instances"].to("cpu")
+        damaged_parts, _ = assign_damage_to_parts(
+            damage_array, instances.pred_boxes.tensor.numpy(), instances.pred_classes.numpy(),
+            instances.scores.numpy(), class_names
+        )
+        with stage_timer("render"):
+            final_frame = detect_parts(damage_frame, outputs)
+        work["finished"].append((i, timestamp, final_frame, label, stages, damaged_parts))
+    return work
+
+def encode_stage(work, frame_options, job_id):
+    """Encode every finished frame into its result dict: base64 inside it, or as artifacts it links to.
+
+    All of the batch's encodes are queued on the encoder pool before waiting on any of them.
+    """
+    pending = [(i, timestamp, label, stages, damaged_parts, submit_frame_encodes(image, frame_options))
+               for i, timestamp, image, label, stages, damaged_parts in work["finished"]]
+    for i, timestamp, label, stages, damaged_parts, futures in pending:
+        fields = frame_fields(f"frame_{i}", futures, frame_options, job_id)
+        if fields:
+            work["results"][i] = dict({"index": i, "timestamp": round(timestamp, 3), "label": label,
+                                       "stages": stages, "damaged_parts": list(damaged_parts)}, **fields)
+            print(f"Frame {i} processed and added to response")
+        else:
+            print(f"Frame {i} could not be encoded, skipping...")
+    return work
+
+def build_pipeline(models, cascade, tracker, frame_options, job_id):
+    """cars -> damage -> parts -> encode, so one batch's YOLO overlaps the previous one's Mask R-CNN and encode.
+
+    Frames the cascade lets go early skip the later stages but still pass through them in order.
+    """
+    return Pipeline([
+        Stage("cars", lambda work: analyze_cars_stage(work, models, cascade), pipeline_workers.get("cars", 1)),
+        # The tracker needs batches in order and one at a time
+        Stage("damage", lambda work: detect_damage_stage(work, models, cascade, tracker), 1),
+        Stage("parts", lambda work: detect_parts_stage(work, models), pipeline_workers.get("parts", 1)),
+        Stage("encode", lambda work: encode_stage(work, frame_options, job_id), pipeline_workers.get("encode", 2)),
+    ], max_queued=pipeline_queue_size, threaded=pipeline_threaded)
+
+def analyze_video_frames(samples, selector, cascade, tracker, frame_options, job_id):
+    """Yield a result dict per sampled frame, in order.
+
+    samples yields (frame_index, timestamp, frame), e.g. sample_frames() over the uploaded file.
+
+    Frames the keyframe selector rejects skip inference and reuse the results of the last
+    keyframe before them; those results carry "reused_from" with that keyframe's index.
+    Keyframes go through the stages of build_pipeline(); "stages" in each result lists the
+    models that ran on the frame and "damaged_parts" maps each damaged part to the damage
+    regions on it. frame_options decides how frames are encoded; url and multipart transport
+    store them under job_id in the artifact store.
+    """
+    def plan(samples):
+        # Keyframe selection is stateful and cheap, so it runs in order on the pipeline's source thread
+        for batch in batch_frames(timed_iter(samples, "decode"), inference_batch_size):
+            yield new_work(batch, [selector.is_keyframe(frame) for _, _, frame in batch])
+
+    last_result = None
+
+    # Decode on the decoder thread; "decode" is the time the pipeline waits for frames.
+    # closing() stops the pipeline and the decoder before the caller releases the capture, even on early exit.
+    # The replica is held for the whole video so every stage runs on its models and cores.
+    with closing(prefetch_frames(samples, decode_queue_size)) as samples, \
+            model_pool.checkout() as models, \
+            closing(build_pipeline(models, cascade, tracker, frame_options, job_id).run(plan(samples))) as works:
+        for work in works:
+            for (i, timestamp, _), key in zip(work["batch"], work["is_key"]):
+                if key:
+                    last_result = work["results"].get(i)
+                    if last_result is not None:
+                        yield last_result
+                elif last_result is not None:
+                    yield dict(last_result, index=i, timestamp=round(timestamp, 3), reused_from=last_result["index"])
+
+def get_keyframe_selector():
+    """Keyframe selector for this request; keyframe_threshold / keyframe_method override the server defaults."""
+    threshold = request.values.get('keyframe_threshold', default_keyframe_threshold, type=float)
+    method = request.values.get('keyframe_method', default_keyframe_method)
+    return KeyframeSelector(threshold=threshold, method=method)
+
+def get_cascade():
+    """Cascade for this request; cascade=0 runs every stage on every frame with a car."""
+    flag = request.values.get('cascade')
+    if flag is not None and flag.lower() in ('0', 'false', 'no'):
+        return Cascade(enabled=False)
+    return default_cascade
+
+def video_summary(selector, tracker):
+    """Whole-video reports that follow the per-frame results; also records the frame counts in the metrics."""
+    report = selector.report()
+    metrics.record_video(report["frames_processed"], report["frames_skipped"])
+    return {
+        "keyframe_report": report,
+        "damage_instances": tracker.instances(),
+        "tracking_report": tracker.report()
+    }
+
+def get_frame_options():
+    """Frame transport, format, quality and sizes for this request; see artifacts.FrameOptions."""
+    return FrameOptions.from_request(request.values, request.headers.get('Accept', ''),
+                                     default_transport=default_frame_transport,
+                                     default_thumbnail_dim=default_thumbnail_dim)
+
+def video_cache_key(video_path, selector, cascade, tracker, frame_options):
+    """Cache key for this video under this request's keyframe, cascade, tracking and frame settings."""
+    return cache_key(
+        file_digest(video_path), vision_version,
+        keyframe_threshold=selector.threshold, keyframe_method=selector.method,
+        cascade=(cascade.enabled, sorted(cascade.no_damage_classes), cascade.no_damage_confidence,
+                 cascade.skip_parts_without_damage),
+        track_max_skip=tracker.max_skip,
+        **frame_options.cache_options()
+    )
+
+def result_size(result):
+    """Rough size of a frame result in bytes, dominated by any base64 frames in it."""
+    return sum(len(value) for value in result.values() if isinstance(value, str)) + 256
+
+def frame_events(samples, selector, cascade, tracker, frame_options, key, cap=None, cache=True):
+    """Yield a "frame" event per processed frame, then a "done" summary (or an "error").
+
+    key is the job id of the stored frames and, with cache set, where the finished run is
+    cached. Only up to stream_cache_max_bytes of results are held for the cache; past that
+    the run isn't cached, so memory doesn't grow with the video. URL results are small, so
+    those runs are nearly always cached. cap, if given, is released at the end.
+    """
+    # Flask may run the generator after the request hooks, so keep timing into this request's trace
+    trace = metrics.current_trace()
+    # Results are only kept when they are going to be cached
+    results = [] if cache else None
+    buffered_bytes = 0
+    frames_sent = 0
+    try:
+        metrics.use_trace(trace)
+        for result in analyze_video_frames(samples, selector, cascade, tracker, frame_options, key):
+            if results is not None:
+                buffered_bytes += result_size(result)
+                if buffered_bytes > stream_cache_max_bytes:
+                    print(f"Results of job {key} passed {stream_cache_max_bytes >> 20} MB, not caching this run")
+                    results = None
+                else:
+                    results.append(result)
+            frames_sent += 1
+            yield dict(result, type="frame")
+
+        summary = video_summary(selector, tracker)
+        if results is not None:
+            video_cache.put(key, {"results": results, "summary": summary})
+        if frame_options.transport != "base64":
+            artifact_store.trim()
+        yield dict(summary, type="done", message="Processing complete!",
+                   frames_sent=frames_sent, cached=False, **metrics.trace_report())
+
+    except Exception as e:
+        print(f"Unexpected error while streaming: {e}")
+        print(traceback.format_exc())
+        yield {"type": "error", "error": str(e)}
+
+    finally:
+        if cap is not None:
+            cap.release()
+
+def cached_events(cached):
+    """Replay a cached run as the events frame_events would have produced."""
+    for result in cached["results"]:
+        yield dict(result, type="frame")
+    yield dict(cached["summary"], type="done", message="Processing complete!",
+               frames_sent=len(cached["results"]), cached=True)
+
+def ndjson_body(events):
+    for event in events:
+        yield json.dumps(event) + "\n"
+
+def multipart_body(events, frame_options, job_id, boundary):
+    """multipart/mixed: each event as a JSON part; a frame event is followed by its thumbnail
+    (and with full_frames, the full frame), each with the Content-ID named in the event's "parts"."""
+    for event in events:
+        images = []
+        if event["type"] == "frame":
+            urls = [event.get("thumbnail_url")] + ([event.get("frame_url")] if frame_options.full_frames else [])
+            images = [url.rsplit("/", 1)[1] for url in urls if url]
+            event = dict(event, parts=images)
+        yield multipart_part(boundary, json.dumps(event).encode(), "application/json")
+        for name in images:
+            yield multipart_part(boundary, artifact_store.read(job_id, name), frame_options.mimetype, content_id=name)
+    yield multipart_end(boundary)
+
+def video_response(results, summary, cached, frame_options):
+    """Non-streaming response body for a finished run; frames are base64 data or URLs, per the transport."""
+    if frame_options.transport == "base64":
+        frames = dict(frames=[result["frame"] for result in results])
+    else:
+        frames = dict(frames=[result["frame_url"] for result in results],
+                      thumbnails=[result.get("thumbnail_url") for result in results])
+    return dict(
+        summary,
+        message="Processing complete!",
+        labels=[result["label"] for result in results],
+        stages=[result["stages"] for result in results],
+        cached=cached,
+        **frames
+    )
+
+def wants_stream():
+    """True if the client asked for NDJSON streaming via ?stream=1, a form field or the Accept header."""
+    flag = request.args.get('stream') or request.form.get('stream')
+    if flag is not None:
+        return flag.lower() in ('1', 'true', 'yes')
+    return 'application/x-ndjson' in request.headers.get('Accept', '')
+
+def events_response(events, frame_options, job_id):
+    """Stream events as multipart/mixed for multipart transport, NDJSON otherwise."""
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    if frame_options.transport == "multipart":
+        boundary = uuid.uuid4().hex
+        return Response(multipart_body(events, frame_options, job_id, boundary),
+                        mimetype=f'multipart/mixed; boundary={boundary}', headers=headers)
+    return Response(ndjson_body(events), mimetype='application/x-ndjson', headers=headers)
+
 @app.route('/upload_video', methods=['POST'])
 def upload_video():
-    """Upload and process video, then run damage and part detection on frames."""
+    """Upload and process video, then run damage and part detection on frames.
+
+    With streaming enabled the response is NDJSON sent over chunked transfer, one line per
+    frame as soon as it is processed. The server only holds on to results for the cache, up to
+    STREAM_CACHE_MB per run. A video that was processed before with the same models and
+    settings is answered from the result cache.
+
+    transport=url returns frame and thumbnail URLs under /processed_frames/<job_id>/ instead of
+    base64 frames; transport=multipart always streams a multipart/mixed body with the
+    thumbnails as binary parts. frame_format, frame_quality, frame_max_dim and thumbnail_dim
+    tune the encoding.
+    """
     if 'video' not in request.files:
         return jsonify({"error": "No video file uploaded"}), 400
 
@@ -170,84 +596,181 @@ def upload_video():
         return jsonify({"error": "No selected file"}), 400
 
     try:
-        video_path = os.path.join(uploaded_videos_folder, video_file.filename)
+        frame_options = get_frame_options()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Unique name per upload so concurrent requests never overwrite each other's video; it is
+    # removed once hashed and processed
+    filename = f"{uuid.uuid4().hex}_{secure_filename(video_file.filename) or 'video.mp4'}"
+    video_path = os.path.join(uploaded_videos_folder, filename)
+    cap = None
+    try:
         video_file.save(video_path)
 
+        selector = get_keyframe_selector()
+        cascade = get_cascade()
+        tracker = DamageTracker(max_skip=damage_track_max_skip)
+
+        # The cache key doubles as the job id of the stored frames, so cached URLs stay valid
+        key = video_cache_key(video_path, selector, cascade, tracker, frame_options)
+        cached = video_cache.get(key)
+        if cached is not None and frame_options.transport != "base64" and not artifact_store.has_job(key):
+            cached = None  # the frames it links to were trimmed from the store
+        if cached is not None:
+            print(f"Serving {filename} from the result cache")
+            if wants_stream() or frame_options.transport == "multipart":
+                return events_response(cached_events(cached), frame_options, key)
+            return jsonify(video_response(cached["results"], cached["summary"], cached=True, frame_options=frame_options))
+
         cap = cv2.VideoCapture(video_path)
         if not cap.isOpened():
             return jsonify({"error": "Failed to open video file"}), 400
 
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        frame_interval = int(fps * 1)  # Process one frame per second
-
-        processed_frames = []
-        labels = []
-
-        for i in range(0, frame_count, frame_interval):
-            cap.set(cv2.CAP_PROP_POS_FRAMES, i)
-            ret, frame = cap.read()
-            if not ret or frame is None:
-                print(f"Skipping frame {i} (empty or corrupted)")
-                continue
-
-            print(f"Processing frame {i} with dimensions: {frame.shape}")
+        if wants_stream() or frame_options.transport == "multipart":
+            samples = sample_frames(cap, interval_seconds=1.0)
+            response = events_response(frame_events(samples, selector, cascade, tracker, frame_options, key, cap=cap),
+                                       frame_options, key)
+            # The stream still reads the video; clean up once the response is closed, even if it never started
+            stream_cap, stream_path = cap, video_path
+            response.call_on_close(lambda: remove_video(stream_cap, stream_path))
+            cap, video_path = None, None
+            return response
 
-            # Process frame using YOLO and VGG models
-            processed_frame, label = process_frame(frame, yolo_model, vgg_model)
+        samples = sample_frames(cap, interval_seconds=1.0)
+        results = list(analyze_video_frames(samples, selector, cascade, tracker, frame_options, key))
 
-            if label == "No car detected":
-                labels.append("No car detected")
-                encoded_frame = encode_image_to_base64(processed_frame)
-                if encoded_frame:
-                    processed_frames.append(encoded_frame)
-                continue
-
-            # Run damage detection on the processed frame
-            try:
-                damage_frame = detect_damage(processed_frame)
-            except Exception as e:
-                print(f"Error in damage detection: {e}")
-                print(traceback.format_exc())
-                continue
-
-            # Debug: Check damage frame type and shape
-            print(f"Damage frame type: {type(damage_frame)}")
-            print(f"Damage frame shape: {damage_frame.shape}")
-
-            # Run car part detection on the damage frame
-            try:
-                final_frame = detect_parts(damage_frame)
-            except Exception as e:
-                print(f"Error in part detection: {e}")
-                print(traceback.format_exc())
-                continue
-
-            # Encode the final frame
-            encoded_frame = encode_image_to_base64(final_frame)
-            if encoded_frame:
-                processed_frames.append(encoded_frame)
-                labels.append(label)
-                print(f"Frame {i} processed and added to response")
-            else:
-                print(f"Frame {i} could not be encoded, skipping...")
+        summary = video_summary(selector, tracker)
+        video_cache.put(key, {"results": results, "summary": summary})
+        if frame_options.transport != "base64":
+            artifact_store.trim()
 
-        cap.release()
+        keyframe_report = summary["keyframe_report"]
+        print(f"Keyframe selection saved {keyframe_report['frames_skipped']} of {keyframe_report['frames_sampled']} frames")
 
-        return jsonify({
-            "message": "Processing complete!",
-            "frames": processed_frames,
-            "labels": labels
-        })
+        return jsonify(dict(video_response(results, summary, cached=False, frame_options=frame_options),
+                            **metrics.trace_report()))
 
     except Exception as e:
         print(f"Unexpected error: {e}")
         print(traceback.format_exc())
         return jsonify({"error": str(e)}), 500
 
+    finally:
+        remove_video(cap, video_path)
+
+def remove_video(cap, video_path):
+    """Release the capture and delete the uploaded video; either may be None."""
+    if cap is not None:
+        cap.release()
+    if video_path is not None:
+        try:
+            os.remove(video_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Could not remove {video_path}: {e}")
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    """Start a resumable upload: {"filename", "size"} (size optional) -> upload id and URLs.
+
+    Send the video in chunks to PATCH upload_url, each with an Upload-Offset header equal to the
+    bytes received so far, and Upload-Complete: 1 on the last one unless size was given. GET
+    upload_url returns the offset to resume from. Open results_url at any point to have the
+    frames processed as they arrive.
+    """
+    values = request.get_json(silent=True) or request.values
+    try:
+        size = int(values['size']) if values.get('size') not in (None, '') else None
+        upload = upload_store.create(values.get('filename'), size)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(dict(upload.status(), upload_url=f"/uploads/{upload.upload_id}",
+                        results_url=f"/uploads/{upload.upload_id}/results")), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    upload = upload_store.get(upload_id)
+    if upload is None:
+        return jsonify({"error": "Unknown upload"}), 404
+    return jsonify(upload.status())
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def delete_upload(upload_id):
+    """Drop an upload, e.g. one the client gave up on; its results can't be requested afterwards."""
+    if not upload_store.delete(upload_id):
+        return jsonify({"error": "Unknown upload"}), 404
+    return '', 204
+
+@app.route('/uploads/<upload_id>', methods=['PATCH', 'PUT'])
+def upload_chunk(upload_id):
+    """Append the request body at Upload-Offset; 409 with the current offset if that's not where the upload is."""
+    upload = upload_store.get(upload_id)
+    if upload is None:
+        return jsonify({"error": "Unknown upload"}), 404
+    offset = request.headers.get('Upload-Offset', type=int)
+    if offset is None:
+        return jsonify({"error": "Upload-Offset header is required"}), 400
+    final = request.headers.get('Upload-Complete', '0').lower() in ('1', 'true', 'yes')
+    try:
+        return jsonify(upload.append(offset, request.get_data(cache=False), final))
+    except UploadOffsetError as e:
+        return jsonify({"error": str(e), "offset": e.offset}), 409
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+@app.route('/uploads/<upload_id>/results', methods=['GET', 'POST'])
+def upload_results(upload_id):
+    """Stream results for a chunked upload, processing frames as soon as their bytes have arrived.
+
+    Takes the same keyframe, cascade and frame transport options as /upload_video and always
+    streams (NDJSON, or multipart/mixed for transport=multipart). Results of an upload still in
+    progress aren't added to the result cache, as the video's hash isn't known until the end.
+    Once a run has gone through the whole video, the upload is deleted.
+    """
+    upload = upload_store.get(upload_id)
+    if upload is None:
+        return jsonify({"error": "Unknown upload"}), 404
+    try:
+        frame_options = get_frame_options()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    selector = get_keyframe_selector()
+    cascade = get_cascade()
+    tracker = DamageTracker(max_skip=damage_track_max_skip)
+    # Every run gets its own job: another run of the same upload may use other options or models
+    job_id = uuid.uuid4().hex
+    samples = sample_growing_video(upload, interval_seconds=1.0)
+    events = frame_events(samples, selector, cascade, tracker, frame_options, job_id, cache=False)
+    return events_response(delete_upload_when_done(events, upload_id), frame_options, job_id)
+
+def delete_upload_when_done(events, upload_id):
+    """Pass events through and delete the upload after a run that reached the end of the video."""
+    done = False
+    for event in events:
+        done = done or event["type"] == "done"
+        yield event
+    if done:
+        upload_store.delete(upload_id)
+
 @app.route('/processed_frames/<filename>')
 def serve_processed_frame(filename):
     return send_from_directory(processed_frame_folder, filename)
 
+@app.route('/processed_frames/<job_id>/<filename>')
+def serve_job_frame(job_id, filename):
+    """A stored frame or thumbnail.
+
+    Job ids are result cache keys (video hash, models and options) or fresh ids per run, so a
+    job's files are never rewritten with different content.
+    """
+    try:
+        job_dir = artifact_store.job_dir(job_id)
+    except ValueError:
+        return jsonify({"error": "Unknown job"}), 404
+    return send_from_directory(job_dir, filename, max_age=7 * 24 * 3600)
+
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    app.run(debug=True, host='0.0.0.0', port=5000)
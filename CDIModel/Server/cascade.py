@@ -0,0 +1,44 @@
+import os
+
+
+class Cascade:
+    """Early-exit rules between the per-frame stages.
+
+    - After VGG: if the primary car's class is one of no_damage_classes with probability at
+      least no_damage_confidence, Detectron2 damage and parts detection are skipped.
+    - After damage detection: if skip_parts_without_damage is set and no damage instances
+      were found, parts detection is skipped.
+
+    VGG class ids have no names in this repo, so the VGG gate stays off until
+    no_damage_classes is configured.
+    """
+
+    def __init__(self, no_damage_classes=(), no_damage_confidence=0.9, skip_parts_without_damage=True, enabled=True):
+        self.no_damage_classes = set(no_damage_classes)
+        self.no_damage_confidence = no_damage_confidence
+        self.skip_parts_without_damage = skip_parts_without_damage
+        self.enabled = enabled
+
+    @classmethod
+    def from_env(cls):
+        """Read CASCADE_NO_DAMAGE_CLASSES (comma-separated VGG ids), CASCADE_NO_DAMAGE_CONFIDENCE,
+        CASCADE_SKIP_PARTS_WITHOUT_DAMAGE and CASCADE_ENABLED."""
+        classes = [int(c) for c in os.environ.get("CASCADE_NO_DAMAGE_CLASSES", "").split(",") if c.strip()]
+        return cls(
+            no_damage_classes=classes,
+            no_damage_confidence=float(os.environ.get("CASCADE_NO_DAMAGE_CONFIDENCE", "0.9")),
+            skip_parts_without_damage=os.environ.get("CASCADE_SKIP_PARTS_WITHOUT_DAMAGE", "1") == "1",
+            enabled=os.environ.get("CASCADE_ENABLED", "1") == "1",
+        )
+
+    def should_run_damage(self, car):
+        """car is the primary car dict from process_video.analyze_cars."""
+        if not self.enabled:
+            return True
+        return not (car["class"] in self.no_damage_classes and
+                    car["class_confidence"] >= self.no_damage_confidence)
+
+    def should_run_parts(self, damage_count):
+        if not self.enabled:
+            return True
+        return not (self.skip_parts_without_damage and damage_count == 0)
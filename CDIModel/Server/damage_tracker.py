@@ -0,0 +1,241 @@
+import numpy as np
+
+from keyframes import diff_signature, signature_distance
+
+
+def box_iou(a, b):
+    """IoU between every box in a (N x 4) and every box in b (M x 4), as an N x M array."""
+    a = np.asarray(a, dtype=np.float32).reshape(-1, 4)
+    b = np.asarray(b, dtype=np.float32).reshape(-1, 4)
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-6)
+
+
+def boxes_to_array(damage_boxes):
+    """Convert detect_damage's [((x1, y1), (x2, y2)), ...] to an N x 4 float array."""
+    return np.array([[x1, y1, x2, y2] for (x1, y1), (x2, y2) in damage_boxes], dtype=np.float32).reshape(-1, 4)
+
+
+class KalmanBoxTrack:
+    """One damage region followed with a constant-velocity Kalman filter.
+
+    The state is the box centre, width and height plus their velocities per processed frame.
+    """
+
+    # Constant-velocity transition and position-only measurement
+    F = np.eye(8, dtype=np.float32)
+    F[:4, 4:] = np.eye(4)
+    H = np.eye(4, 8, dtype=np.float32)
+
+    def __init__(self, track_id, box, score, frame_index):
+        self.id = track_id
+        cx, cy, w, h = self.to_cxcywh(box)
+        self.x = np.array([cx, cy, w, h, 0, 0, 0, 0], dtype=np.float32)
+        self.P = np.diag([10, 10, 10, 10, 100, 100, 100, 100]).astype(np.float32)
+        self.Q = np.diag([1, 1, 1, 1, 0.1, 0.1, 0.1, 0.1]).astype(np.float32)
+        self.R = np.diag([4, 4, 16, 16]).astype(np.float32)
+
+        self.best_box = np.asarray(box, dtype=np.float32)
+        self.best_score = float(score)
+        self.first_frame = frame_index
+        self.last_frame = frame_index
+        self.hits = 1
+        self.misses = 0
+
+    @staticmethod
+    def to_cxcywh(box):
+        x1, y1, x2, y2 = box
+        return (x1 + x2) / 2, (y1 + y2) / 2, x2 - x1, y2 - y1
+
+    @property
+    def box(self):
+        cx, cy, w, h = self.x[:4]
+        w, h = max(w, 1.0), max(h, 1.0)
+        return np.array([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2], dtype=np.float32)
+
+    def predict(self):
+        self.x = self.F @ self.x
+        self.P = self.F @ self.P @ self.F.T + self.Q
+        return self.box
+
+    def update(self, box, score, frame_index):
+        z = np.array(self.to_cxcywh(box), dtype=np.float32)
+        S = self.H @ self.P @ self.H.T + self.R
+        K = self.P @ self.H.T @ np.linalg.inv(S)
+        self.x = self.x + K @ (z - self.H @ self.x)
+        self.P = (np.eye(8, dtype=np.float32) - K @ self.H) @ self.P
+
+        self.hits += 1
+        self.misses = 0
+        self.last_frame = frame_index
+        if score >= self.best_score:
+            self.best_score = float(score)
+            self.best_box = np.asarray(box, dtype=np.float32)
+
+
+def car_signature(frame, car_box):
+    """Thumbnail of the car crop, for spotting new surface coming into view."""
+    x1, y1, x2, y2 = [int(v) for v in car_box]
+    crop = frame[max(y1, 0):max(y2, 0), max(x1, 0):max(x2, 0)]
+    return diff_signature(crop if crop.size else frame)
+
+
+class DamageTracker:
+    """Follows damage boxes from frame to frame so Detectron2 only runs when something changes.
+
+    Between detections, tracks are carried forward by their Kalman prediction. needs_detection()
+    asks for a full detection when there has never been one, when the last detection found no
+    damage or left a track unmatched, when the car box has moved or the car crop looks
+    different enough (content_change, on the keyframe "diff" scale) that new surface may be in
+    view, or after max_skip tracked frames in a row. Decisions depend on the last update(), so
+    ask for a frame only after the frames before it were updated or carried forward;
+    plan_detections() guesses ahead for a whole batch so its detections can run together. A
+    max_skip of 0 detects on every frame and only deduplicates. instances() lists each
+    physical damage region once for the whole video.
+    """
+
+    def __init__(self, iou_threshold=0.3, max_misses=1, max_skip=0, car_shift=0.2, content_change=0.08, min_hits=1):
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.max_skip = max_skip
+        self.car_shift = car_shift
+        self.content_change = content_change
+        self.min_hits = min_hits
+
+        self.tracks = []
+        self.finished = []
+        self.next_id = 1
+        self.detected_car_box = None
+        self.detected_signature = None
+        self.frames_since_detection = 0
+        self.lost_at_last_detection = False
+        self.frames_detected = 0
+        self.frames_tracked = 0
+
+    def needs_detection(self, car_box=None, frame=None):
+        """True if the next frame should go through the damage model instead of reusing tracks."""
+        if self.frames_detected == 0 or self.lost_at_last_detection or not self.tracks:
+            return True
+        signature = car_signature(frame, car_box) if frame is not None and car_box is not None else None
+        return self.scene_changed(self.frames_since_detection, self.detected_car_box, self.detected_signature,
+                                  car_box, signature)
+
+    def scene_changed(self, frames_since_detection, detected_car_box, detected_signature, car_box, signature):
+        """The checks of needs_detection() that don't depend on what the last detection found."""
+        if frames_since_detection >= self.max_skip:
+            return True
+        if car_box is not None and detected_car_box is not None:
+            if box_iou(car_box, detected_car_box)[0, 0] < 1.0 - self.car_shift:
+                return True
+            if signature is not None and detected_signature is not None:
+                if signature_distance(signature, detected_signature, "diff") >= self.content_change:
+                    return True
+        return False
+
+    def plan_detections(self, car_boxes, frames):
+        """Guess needs_detection() for each of the next frames at once, so they can share a batch.
+
+        The car box and content checks are exact, as the frames that would be detected are known
+        in advance. What those detections will find isn't, so they are assumed to find damage
+        to track if the last one did (or if there hasn't been one yet), and none otherwise.
+        Check needs_detection() again before carrying a frame forward; where the guess was
+        wrong it says so.
+        """
+        expect_tracks = self.frames_detected == 0 or bool(self.tracks)
+        must_detect = self.frames_detected == 0 or self.lost_at_last_detection or not self.tracks
+        since, detected_car_box, detected_signature = (self.frames_since_detection, self.detected_car_box,
+                                                       self.detected_signature)
+        plan = []
+        for car_box, frame in zip(car_boxes, frames):
+            signature = car_signature(frame, car_box) if frame is not None and car_box is not None else None
+            detect = must_detect or self.scene_changed(since, detected_car_box, detected_signature, car_box, signature)
+            if detect:
+                since, detected_car_box, detected_signature = 0, car_box, signature
+                must_detect = not expect_tracks
+            else:
+                since += 1
+            plan.append(detect)
+        return plan
+
+    def update(self, frame_index, boxes, scores, car_box=None, signature=None):
+        """Match a frame's detections to the predicted tracks and return the live tracks.
+
+        car_box and signature (car_signature() of the frame, taken before anything is drawn on
+        it) are remembered as the reference for needs_detection().
+        """
+        self.frames_detected += 1
+        self.frames_since_detection = 0
+        predicted = np.array([track.predict() for track in self.tracks], dtype=np.float32).reshape(-1, 4)
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+
+        # Greedy matching on IoU, best pairs first
+        matched_tracks, matched_boxes = set(), set()
+        if len(predicted) and len(boxes):
+            iou = box_iou(predicted, boxes)
+            for t, d in zip(*np.unravel_index(np.argsort(-iou, axis=None), iou.shape)):
+                if iou[t, d] < self.iou_threshold:
+                    break
+                if t in matched_tracks or d in matched_boxes:
+                    continue
+                self.tracks[t].update(boxes[d], scores[d], frame_index)
+                matched_tracks.add(t)
+                matched_boxes.add(d)
+
+        live, lost = [], False
+        for t, track in enumerate(self.tracks):
+            if t not in matched_tracks:
+                # A missed track may be occluded or gone; detect again on the next frame to find out
+                track.misses += 1
+                lost = True
+            if track.misses > self.max_misses:
+                self.finished.append(track)
+            else:
+                live.append(track)
+
+        for d in range(len(boxes)):
+            if d not in matched_boxes:
+                live.append(KalmanBoxTrack(self.next_id, boxes[d], scores[d], frame_index))
+                self.next_id += 1
+
+        self.tracks = live
+        self.lost_at_last_detection = lost
+        self.detected_car_box = car_box
+        self.detected_signature = signature
+        return self.tracks
+
+    def carry_forward(self):
+        """Advance every track by its prediction for a frame that skipped detection."""
+        self.frames_tracked += 1
+        self.frames_since_detection += 1
+        for track in self.tracks:
+            track.predict()
+        return self.tracks
+
+    def instances(self):
+        """Every damage region seen in the video, once each, with its best detection."""
+        instances = []
+        for track in sorted(self.finished + self.tracks, key=lambda t: t.id):
+            if track.hits < self.min_hits:
+                continue
+            instances.append({
+                "id": track.id,
+                "box": [round(float(v), 1) for v in track.best_box],
+                "score": round(track.best_score, 4),
+                "first_frame": track.first_frame,
+                "last_frame": track.last_frame,
+                "detections": track.hits,
+            })
+        return instances
+
+    def report(self):
+        return {
+            "frames_detected": self.frames_detected,
+            "frames_tracked": self.frames_tracked,
+            "damage_instances": len(self.instances()),
+        }
@@ -4,17 +4,29 @@ import os
 import base64
 import torch
 from detectron2.config import get_cfg
-from detectron2.engine import DefaultPredictor
-from detectron2.utils.visualizer import Visualizer
 from detectron2.data import MetadataCatalog
 import numpy as np
 from process_video import YOLOModel, VGGModel, process_frame
+from frame_sampler import sample_frames, batch_frames, prefetch_frames
+from overlay import draw_damage_overlay
+from batch_predictor import BatchPredictor
+from damage_tracker import boxes_to_array
+from part_mapping import PART_CLASS_NAMES, assign_damage_to_parts
 from flask_cors import CORS
+from werkzeug.utils import secure_filename
+from contextlib import closing
+import uuid
 import traceback
 
 app = Flask(__name__)
 CORS(app)
 
+# Number of sampled frames sent through each Detectron2 forward pass
+inference_batch_size = int(os.environ.get('INFERENCE_BATCH_SIZE', '4'))
+
+# Sampled frames decoded ahead of inference on a background thread; 0 decodes inline
+decode_queue_size = int(os.environ.get('DECODE_QUEUE_SIZE', '8'))
+
 # Initialize YOLO and VGG models
 yolo_model = YOLOModel(r"D:\CarInsuranceClaim\CDIModel\yolo\yolov5s.onnx")
 vgg_model = VGGModel(r"D:\CarInsuranceClaim\CDIModel\vgg\vgg_damage_model.pth")
@@ -25,7 +37,7 @@ damage_cfg.merge_from_file(r"D:\CarInsuranceClaim\CDIModel\V_MODELS\damage\confi
 damage_cfg.MODEL.WEIGHTS = r"D:\CarInsuranceClaim\CDIModel\V_MODELS\damage\detectron_model.pth"
 damage_cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = 0.7
 damage_cfg.MODEL.DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-damage_predictor = DefaultPredictor(damage_cfg)
+damage_predictor = BatchPredictor(damage_cfg, batch_size=inference_batch_size)
 
 # Initialize Detectron2 model for car part detection
 parts_cfg = get_cfg()
@@ -33,16 +45,10 @@ parts_cfg.merge_from_file(r"D:\CarInsuranceClaim\CDIModel\V_MODELS\parts\config.
 parts_cfg.MODEL.WEIGHTS = r"D:\CarInsuranceClaim\CDIModel\V_MODELS\parts\parts_model_final.pth"
 parts_cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = 0.5
 parts_cfg.MODEL.DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-parts_predictor = DefaultPredictor(parts_cfg)
+parts_predictor = BatchPredictor(parts_cfg, batch_size=inference_batch_size)
 
 # Define car part class names
-class_names = [
-    "Car-parts", "Car boot", "Car hood", "Driver-s door - -F-R-", "Fender - -F-L-",
-    "Fender - -F-R-", "Fender - -R-L-", "Fender - -R-R-", "Front bumper",
-    "Headlight - -L-", "Headlight - -R-", "Passenger-s door - -F-L-", "Passenger-s door - -R-L-",
-    "Passenger-s door - -R-R-", "Rear bumper", "Rear light - -L-", "Rear light - -R-",
-    "Side bumper - -L-", "Side bumper - -R-", "Side mirror - -L-", "Side mirror - -R-"
-]
+class_names = PART_CLASS_NAMES
 
 # Assign class names to metadata
 parts_metadata = MetadataCatalog.get("my_dataset_test")
@@ -66,114 +72,61 @@ def encode_image_to_base64(image):
         print(f"Error encoding image: {e}")
         return None
 
-def detect_damage(frame):
-    """Run the Detectron2 model on the processed frame and return the annotated image and damage bounding boxes."""
-    outputs = damage_predictor(frame)
+def detect_damage(frame, outputs=None):
+    """Run the Detectron2 model on the processed frame and return the annotated image and damage bounding boxes.
+
+    Pass outputs to annotate predictions that were already computed in a batch.
+    """
+    if outputs is None:
+        outputs = damage_predictor(frame)
 
     # Extract predictions
-    instances = outputs["instances"]
-    scores = instances.scores
-    pred_classes = instances.pred_classes
-    pred_boxes = instances.pred_boxes
-
-    # Visualize results
-    v = Visualizer(frame[:, :, ::-1], MetadataCatalog.get(damage_cfg.DATASETS.TEST[0]), scale=0.5)
-    out = v.draw_instance_predictions(instances.to("cpu"))
-
-    # Annotate the damage on the frame
-    damage_count = len(pred_classes)
-    damage_boxes = []  # List to store damage bounding boxes
-
-    for i in range(damage_count):
-        score = scores[i].item()
-        label = pred_classes[i].item()
-        damage_text = f"Damage: {label}, {score*100:.2f}%"
-
-        # Get bounding box
-        box = pred_boxes[i].tensor.cpu().numpy().flatten()
+    instances = outputs["instances"].to("cpu")
+
+    # Store damage bounding boxes in frame coordinates
+    damage_boxes = []
+    for box in instances.pred_boxes.tensor.numpy():
         top_left = (int(box[0]), int(box[1]))
         bottom_right = (int(box[2]), int(box[3]))
-
-        # Store damage bounding box
         damage_boxes.append((top_left, bottom_right))
 
-        # Draw text
-        out.ax.text(top_left[0], top_left[1] - 10, damage_text, color='white', fontsize=10,
-                    bbox=dict(facecolor='black', alpha=0.5, boxstyle='round,pad=0.3'))
-
-    # Display total damage parts at the bottom
-    damage_count_text = f"Total Damage Parts: {damage_count}"
-    out.ax.text(0.5, 0.05, damage_count_text, color='white', fontsize=10, ha='center', va='bottom',
-                transform=out.ax.transAxes, bbox=dict(facecolor='black', alpha=0.7, boxstyle='round,pad=0.5')) 
+    # Draw masks, boxes, labels and the damage count straight into the frame buffer
+    return draw_damage_overlay(frame, instances), damage_boxes
 
-    return out.get_image()[:, :, ::-1], damage_boxes
+def detect_parts_in_damage(frame, damage_boxes, outputs=None):
+    """Find the parts the damage boxes lie on and return the annotated image and the damaged parts.
 
-def detect_parts_in_damage(frame, damage_boxes):
-    """Run the car part detection model on the damage regions of the frame and return the annotated image."""
+    The parts model runs once on the whole frame (pass outputs if it already ran in a batch),
+    and each damage box is attributed to the part covering most of it. Returns the frame and
+    a list of {"part", "part_box", "part_score", "damage"} entries, see assign_damage_to_parts.
+    """
     # Ensure the frame is a valid NumPy array in BGR format
     if frame is None or not isinstance(frame, np.ndarray):
         print("Invalid frame detected in detect_parts_in_damage")
-        return frame
+        return frame, []
 
     # Ensure the frame is contiguous and of type uint8
     frame = np.ascontiguousarray(frame, dtype=np.uint8)
 
-    # Iterate over each damage region
-    for (top_left, bottom_right) in damage_boxes:
-        x1, y1 = top_left
-        x2, y2 = bottom_right
-
-        # Crop the damage region
-        damage_region = frame[y1:y2, x1:x2]
-
-        # Run the part detection model on the damage region
-        outputs = parts_predictor(damage_region)
-
-        # Extract predictions
-        instances = outputs["instances"].to("cpu")
-        pred_classes = instances.pred_classes.numpy()
-        pred_boxes = instances.pred_boxes.tensor.numpy()
-        scores = instances.scores.numpy()
-
-        # Get damage region dimensions
-        region_height, region_width = damage_region.shape[:2]
-
-        # Draw bounding boxes with labels and confidence scores
-        for i, box in enumerate(pred_boxes):
-            bx1, by1, bx2, by2 = map(int, box)
+    if outputs is None:
+        outputs = parts_predictor(frame)
 
-            # Adjust coordinates to the original frame
-            bx1 += x1
-            by1 += y1
-            bx2 += x1
-            by2 += y1
-
-            # Validate bounding box coordinates
-            if not (0 <= bx1 < frame.shape[1] and 0 <= by1 < frame.shape[0] and 0 <= bx2 < frame.shape[1] and 0 <= by2 < frame.shape[0]):
-                print(f"Invalid bounding box: {box}, frame dimensions: {frame.shape[1]}x{frame.shape[0]}")
-                continue
-
-            class_name = class_names[pred_classes[i]]
-            score = scores[i] * 100  # Convert to percentage
-
-            label = f"{class_name} {int(score)}%"
-            color = (0, 255, 0)  # Green box for better visibility
-
-            # Draw rectangle
-            try:
-                cv2.rectangle(frame, (bx1, by1), (bx2, by2), color, 2)
-            except Exception as e:
-                print(f"Error drawing rectangle: {e}")
-                continue
-
-            # Put label text
-            try:
-                cv2.putText(frame, label, (bx1, by1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
-            except Exception as e:
-                print(f"Error drawing text: {e}")
-                continue
-
-    return frame
+    # Extract predictions
+    instances = outputs["instances"].to("cpu")
+    damaged_parts, _ = assign_damage_to_parts(
+        boxes_to_array(damage_boxes), instances.pred_boxes.tensor.numpy(),
+        instances.pred_classes.numpy(), instances.scores.numpy(), class_names
+    )
+
+    # Draw only the parts that have damage on them, with how many damage regions each has
+    color = (0, 255, 0)  # Green box for better visibility
+    for part in damaged_parts:
+        x1, y1, x2, y2 = map(int, part["part_box"])
+        label = f"{part['part']} {int(part['part_score'] * 100)}% ({len(part['damage'])} damage)"
+        cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
+        cv2.putText(frame, label, (x1, max(y1 - 10, 10)), cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
+
+    return frame, damaged_parts
 
 @app.route('/upload_video', methods=['POST'])
 def upload_video():
@@ -185,71 +138,100 @@ def upload_video():
     if video_file.filename == '':
         return jsonify({"error": "No selected file"}), 400
 
+    # Unique name per upload so concurrent requests never overwrite each other's video; removed when done
+    filename = f"{uuid.uuid4().hex}_{secure_filename(video_file.filename) or 'video.mp4'}"
+    video_path = os.path.join(uploaded_videos_folder, filename)
     try:
-        video_path = os.path.join(uploaded_videos_folder, video_file.filename)
         video_file.save(video_path)
 
         cap = cv2.VideoCapture(video_path)
         if not cap.isOpened():
             return jsonify({"error": "Failed to open video file"}), 400
 
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        frame_interval = int(fps * 1)  # Process one frame per second
-
         processed_frames = []
         labels = []
-
-        for i in range(0, frame_count, frame_interval):
-            cap.set(cv2.CAP_PROP_POS_FRAMES, i)
-            ret, frame = cap.read()
-            if not ret or frame is None:
-                print(f"Skipping frame {i} (empty or corrupted)")
-                continue
-
-            print(f"Processing frame {i} with dimensions: {frame.shape}")
-
-            # Process frame using YOLO and VGG models
-            processed_frame, label = process_frame(frame, yolo_model, vgg_model)
-
-            if label == "No car detected":
-                labels.append("No car detected")
-                encoded_frame = encode_image_to_base64(processed_frame)
-                if encoded_frame:
-                    processed_frames.append(encoded_frame)
-                continue
-
-            # Run damage detection on the processed frame
-            try:
-                damage_frame, damage_boxes = detect_damage(processed_frame)
-            except Exception as e:
-                print(f"Error in damage detection: {e}")
-                print(traceback.format_exc())
-                continue
-
-            # Run car part detection only in damage regions
-            try:
-                final_frame = detect_parts_in_damage(damage_frame, damage_boxes)
-            except Exception as e:
-                print(f"Error in part detection: {e}")
-                print(traceback.format_exc())
-                continue
-
-            # Encode the final frame
-            encoded_frame = encode_image_to_base64(final_frame)
-            if encoded_frame:
-                processed_frames.append(encoded_frame)
-                labels.append(label)
-                print(f"Frame {i} processed and added to response")
-            else:
-                print(f"Frame {i} could not be encoded, skipping...")
-
-        cap.release()
+        frame_damaged_parts = []
+
+        # Process one frame per second, decoding the file once in order; closing() joins the
+        # decoder before the capture is released, also when a batch fails
+        try:
+            with closing(prefetch_frames(sample_frames(cap, interval_seconds=1.0), decode_queue_size)) as samples:
+                for batch in batch_frames(samples, inference_batch_size):
+                    batch_results = []  # (frame_index, encoded_frame, label, damaged_parts)
+                    car_frames = []
+
+                    for i, _, frame in batch:
+                        print(f"Processing frame {i} with dimensions: {frame.shape}")
+
+                        # Process frame using YOLO and VGG models
+                        processed_frame, label = process_frame(frame, yolo_model, vgg_model)
+
+                        if label == "No car detected":
+                            encoded_frame = encode_image_to_base64(processed_frame)
+                            if encoded_frame:
+                                batch_results.append((i, encoded_frame, label, []))
+                            continue
+
+                        car_frames.append((i, processed_frame, label))
+
+                    # Run damage detection on all processed frames of the batch in one forward pass
+                    damage_outputs = []
+                    if car_frames:
+                        try:
+                            damage_outputs = damage_predictor.predict_batch([item[1] for item in car_frames])
+                        except Exception as e:
+                            print(f"Error in damage detection: {e}")
+                            print(traceback.format_exc())
+
+                    damage_items = []  # (frame_index, damage_frame, damage_boxes, label)
+                    for (i, processed_frame, label), outputs in zip(car_frames, damage_outputs):
+                        try:
+                            damage_frame, damage_boxes = detect_damage(processed_frame, outputs)
+                        except Exception as e:
+                            print(f"Error in damage detection: {e}")
+                            print(traceback.format_exc())
+                            continue
+                        damage_items.append((i, np.ascontiguousarray(damage_frame, dtype=np.uint8), damage_boxes, label))
+
+                    # Run car part detection once per frame, for the whole batch in one forward pass
+                    parts_outputs = []
+                    if damage_items:
+                        try:
+                            parts_outputs = parts_predictor.predict_batch([item[1] for item in damage_items])
+                        except Exception as e:
+                            print(f"Error in part detection: {e}")
+                            print(traceback.format_exc())
+
+                    for (i, damage_frame, damage_boxes, label), outputs in zip(damage_items, parts_outputs):
+                        # Attribute the damage regions to the detected parts
+                        try:
+                            final_frame, damaged_parts = detect_parts_in_damage(damage_frame, damage_boxes, outputs)
+                        except Exception as e:
+                            print(f"Error in part detection: {e}")
+                            print(traceback.format_exc())
+                            continue
+
+                        # Encode the final frame
+                        encoded_frame = encode_image_to_base64(final_frame)
+                        if encoded_frame:
+                            batch_results.append((i, encoded_frame, label, damaged_parts))
+                            print(f"Frame {i} processed and added to response")
+                        else:
+                            print(f"Frame {i} could not be encoded, skipping...")
+
+                    # Keep the response in sampling order
+                    for _, encoded_frame, label, damaged_parts in sorted(batch_results, key=lambda item: item[0]):
+                        processed_frames.append(encoded_frame)
+                        labels.append(label)
+                        frame_damaged_parts.append(damaged_parts)
+        finally:
+            cap.release()
 
         return jsonify({
             "message": "Processing complete!",
             "frames": processed_frames,
-            "labels": labels
+            "labels": labels,
+            "damaged_parts": frame_damaged_parts
         })
 
     except Exception as e:
@@ -257,6 +239,14 @@ def upload_video():
         print(traceback.format_exc())
         return jsonify({"error": str(e)}), 500
 
+    finally:
+        try:
+            os.remove(video_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Could not remove {video_path}: {e}")
+
 @app.route('/processed_frames/<filename>')
 def serve_processed_frame(filename):
     return send_from_directory(processed_frame_folder, filename)
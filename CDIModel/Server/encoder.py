@@ -0,0 +1,136 @@
+import base64
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+import metrics
+from metrics import stage_timer
+
+# format -> (extension, mimetype, cv2 quality flag)
+IMAGE_FORMATS = {
+    "jpeg": (".jpg", "image/jpeg", cv2.IMWRITE_JPEG_QUALITY),
+    "webp": (".webp", "image/webp", cv2.IMWRITE_WEBP_QUALITY),
+}
+# cv2.imencode's own JPEG default, so frames look the same whichever library encodes them
+DEFAULT_QUALITY = 95
+
+
+def fit_within(image, max_dim, dst=None):
+    """Downscale so the longer side is at most max_dim; 0 or a smaller image leaves it untouched.
+
+    dst, if given, is a buffer of the right shape and dtype to resize into.
+    """
+    h, w = image.shape[:2]
+    if not max_dim or max(h, w) <= max_dim:
+        return image
+    scale = max_dim / max(h, w)
+    size = (max(1, round(w * scale)), max(1, round(h * scale)))
+    return cv2.resize(image, size, dst=dst, interpolation=cv2.INTER_AREA)
+
+
+def load_turbojpeg():
+    """A TurboJPEG encoder if PyTurboJPEG and libjpeg-turbo are installed, else None."""
+    try:
+        from turbojpeg import TurboJPEG
+        return TurboJPEG()
+    except (ImportError, OSError, RuntimeError) as e:
+        print(f"TurboJPEG unavailable, encoding JPEG with OpenCV: {e}")
+        return None
+
+
+class FrameEncoder:
+    """Encodes frames to JPEG/WebP on a thread pool; submit() returns a Future of the bytes.
+
+    Both cv2 and libjpeg-turbo release the GIL, so encodes run in parallel with each other and
+    with inference. Every worker thread keeps its own scratch buffers for downscaling and for
+    making non-contiguous frames (crops, views) contiguous, reused for frames of the same size.
+    JPEG goes through libjpeg-turbo when turbojpeg is set and available, otherwise cv2. An
+    image handed to submit() must not be modified until its future is done.
+    """
+
+    def __init__(self, workers=2, quality=DEFAULT_QUALITY, progressive=False, turbojpeg=False):
+        self.quality = quality
+        self.progressive = progressive
+        self.turbojpeg = load_turbojpeg() if turbojpeg else None
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="frame-encoder")
+        self.local = threading.local()
+
+    def scratch(self, shape, dtype):
+        """This thread's reusable buffer of the given shape."""
+        buffers = getattr(self.local, "buffers", None)
+        if buffers is None:
+            buffers = self.local.buffers = {}
+        key = (shape, np.dtype(dtype).str)
+        buffer = buffers.get(key)
+        if buffer is None:
+            if len(buffers) >= 8:
+                buffers.clear()  # frame sizes changed; don't hold on to every size seen
+            buffer = buffers[key] = np.empty(shape, dtype=dtype)
+        return buffer
+
+    def prepare(self, image, max_dim):
+        h, w = image.shape[:2]
+        if max_dim and max(h, w) > max_dim:
+            scale = max_dim / max(h, w)
+            shape = (max(1, round(h * scale)), max(1, round(w * scale))) + image.shape[2:]
+            return fit_within(image, max_dim, dst=self.scratch(shape, image.dtype))
+        if not image.flags.c_contiguous:
+            buffer = self.scratch(image.shape, image.dtype)
+            np.copyto(buffer, image)
+            return buffer
+        return image
+
+    def encode(self, image, image_format="jpeg", quality=None, max_dim=0, progressive=None):
+        """Encoded bytes of the image on the calling thread, or None if encoding failed."""
+        quality = int(quality if quality is not None else self.quality)
+        progressive = self.progressive if progressive is None else progressive
+        with stage_timer("encode"):
+            image = self.prepare(image, max_dim)
+            if image_format == "jpeg" and self.turbojpeg is not None:
+                from turbojpeg import TJFLAG_PROGRESSIVE, TJPF_BGR
+                return self.turbojpeg.encode(image, quality=quality, pixel_format=TJPF_BGR,
+                                             flags=TJFLAG_PROGRESSIVE if progressive else 0)
+            extension, _, quality_flag = IMAGE_FORMATS[image_format]
+            params = [quality_flag, quality]
+            if image_format == "jpeg" and progressive:
+                params += [cv2.IMWRITE_JPEG_PROGRESSIVE, 1]
+            ok, encoded = cv2.imencode(extension, image, params)
+            if not ok or encoded is None:
+                return None
+            return encoded.tobytes()
+
+    def encode_base64(self, image, image_format="jpeg", quality=None, max_dim=0, progressive=None):
+        encoded = self.encode(image, image_format, quality, max_dim, progressive)
+        return base64.b64encode(encoded).decode('utf-8') if encoded is not None else None
+
+    def submit(self, image, image_format="jpeg", quality=None, max_dim=0, progressive=None):
+        """Future of encode(); the encode runs into the caller's trace."""
+        return self.pool.submit(self._traced(self.encode), image, image_format, quality, max_dim, progressive)
+
+    def submit_base64(self, image, image_format="jpeg", quality=None, max_dim=0, progressive=None):
+        """Future of encode_base64()."""
+        return self.pool.submit(self._traced(self.encode_base64), image, image_format, quality, max_dim, progressive)
+
+    def _traced(self, fn):
+        trace = metrics.current_trace()
+
+        def run(*args):
+            metrics.use_trace(trace)
+            return fn(*args)
+        return run
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+
+def create_frame_encoder():
+    """Encoder configured from ENCODER_WORKERS, JPEG_QUALITY, JPEG_PROGRESSIVE and TURBOJPEG."""
+    return FrameEncoder(
+        workers=int(os.environ.get('ENCODER_WORKERS', '2')),
+        quality=int(os.environ.get('JPEG_QUALITY', str(DEFAULT_QUALITY))),
+        progressive=os.environ.get('JPEG_PROGRESSIVE', '0') == '1',
+        turbojpeg=os.environ.get('TURBOJPEG', '1') == '1',
+    )
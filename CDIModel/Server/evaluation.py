@@ -0,0 +1,112 @@
+import json
+import os
+
+import numpy as np
+
+from damage_tracker import box_iou
+
+
+class CocoGroundTruth:
+    """Boxes from a COCO annotation file, indexed by image file name.
+
+    Boxes are converted from COCO's x, y, w, h to x1, y1, x2, y2.
+    """
+
+    def __init__(self, annotations_path):
+        with open(annotations_path) as f:
+            data = json.load(f)
+        self.images_dir = os.path.dirname(annotations_path)
+        self.categories = {c["id"]: c["name"] for c in data["categories"]}
+        self.file_names = {image["id"]: image["file_name"] for image in data["images"]}
+
+        self.boxes = {name: [] for name in self.file_names.values()}  # file name -> [(x1, y1, x2, y2, category_id)]
+        for ann in data["annotations"]:
+            if ann.get("iscrowd", 0):
+                continue
+            x, y, w, h = ann["bbox"]
+            self.boxes[self.file_names[ann["image_id"]]].append((x, y, x + w, y + h, ann["category_id"]))
+
+    def image_paths(self):
+        """(file name, path) for every annotated image that exists on disk."""
+        for name in sorted(self.boxes):
+            path = os.path.join(self.images_dir, name)
+            if os.path.exists(path):
+                yield name, path
+
+
+def average_precision(ground_truth, predictions, category_id, iou_threshold):
+    """COCO-style AP (101-point interpolated) for one category at one IoU threshold.
+
+    ground_truth is a CocoGroundTruth; predictions maps file name -> [(x1, y1, x2, y2, score,
+    category_id)]. Returns None when the category has no ground truth boxes.
+    """
+    gt = {name: np.array([b[:4] for b in boxes if b[4] == category_id], dtype=np.float32).reshape(-1, 4)
+          for name, boxes in ground_truth.boxes.items()}
+    total_gt = sum(len(boxes) for boxes in gt.values())
+    if total_gt == 0:
+        return None
+
+    detections = [(score, name, (x1, y1, x2, y2))
+                  for name, preds in predictions.items()
+                  for x1, y1, x2, y2, score, cls in preds if cls == category_id]
+    detections.sort(key=lambda d: -d[0])
+
+    matched = {name: np.zeros(len(boxes), dtype=bool) for name, boxes in gt.items()}
+    true_positive = np.zeros(len(detections))
+    for n, (_, name, box) in enumerate(detections):
+        gt_boxes = gt.get(name)
+        if gt_boxes is None or len(gt_boxes) == 0:
+            continue
+        iou = box_iou(box, gt_boxes)[0]
+        iou[matched[name]] = -1  # each ground truth box can only be found once
+        best = int(iou.argmax())
+        if iou[best] >= iou_threshold:
+            matched[name][best] = True
+            true_positive[n] = 1
+
+    tp = np.cumsum(true_positive)
+    recall = tp / total_gt
+    precision = tp / np.arange(1, len(detections) + 1) if len(detections) else np.zeros(0)
+
+    # Precision envelope, then sample it at 101 recall points
+    precision = np.maximum.accumulate(precision[::-1])[::-1] if len(precision) else precision
+    samples = []
+    for r in np.linspace(0, 1, 101):
+        above = np.flatnonzero(recall >= r)
+        samples.append(precision[above[0]] if len(above) else 0.0)
+    return float(np.mean(samples))
+
+
+def coco_map(ground_truth, predictions, category_ids=None):
+    """mAP over IoU 0.50:0.95 plus AP50 and AP75, averaged over categories with ground truth."""
+    category_ids = category_ids or list(ground_truth.categories)
+    thresholds = np.linspace(0.5, 0.95, 10)
+
+    per_category = {}
+    for category_id in category_ids:
+        aps = [average_precision(ground_truth, predictions, category_id, t) for t in thresholds]
+        if aps[0] is None:
+            continue
+        per_category[ground_truth.categories[category_id]] = {
+            "mAP": float(np.mean(aps)), "AP50": aps[0], "AP75": aps[5]
+        }
+
+    if not per_category:
+        return {"mAP": None, "AP50": None, "AP75": None, "per_category": {}}
+    return {
+        "mAP": float(np.mean([c["mAP"] for c in per_category.values()])),
+        "AP50": float(np.mean([c["AP50"] for c in per_category.values()])),
+        "AP75": float(np.mean([c["AP75"] for c in per_category.values()])),
+        "per_category": per_category,
+    }
+
+
+def instances_to_predictions(instances, category_map):
+    """Detectron2 Instances -> [(x1, y1, x2, y2, score, category_id)], mapping model class ids
+    to annotation category ids with category_map (classes missing from it are dropped)."""
+    instances = instances.to("cpu")
+    boxes = instances.pred_boxes.tensor.numpy()
+    scores = instances.scores.numpy()
+    classes = instances.pred_classes.numpy()
+    return [(*map(float, box), float(score), category_map[int(cls)])
+            for box, score, cls in zip(boxes, scores, classes) if int(cls) in category_map]
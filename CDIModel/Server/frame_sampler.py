@@ -0,0 +1,212 @@
+import queue
+import threading
+
+import cv2
+
+# Anything outside this range is treated as a missing/garbage FPS value from the container
+MIN_VALID_FPS = 1.0
+MAX_VALID_FPS = 240.0
+
+
+def get_video_fps(cap, fallback_fps=30.0):
+    """Return the FPS reported by the capture, or fallback_fps when it is missing or implausible."""
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    if not fps or fps != fps or not (MIN_VALID_FPS <= fps <= MAX_VALID_FPS):
+        return fallback_fps
+    return fps
+
+
+def sample_frames(cap, interval_seconds=1.0, every_n_frames=None, fallback_fps=30.0):
+    """Yield (frame_index, timestamp, frame) for sampled frames, reading the video once in order.
+
+    Every frame is grab()'ed so the decoder never has to seek; only sampled frames are
+    retrieve()'d into a BGR image. By default one frame is sampled every interval_seconds
+    of presentation time. Pass every_n_frames to sample by frame index instead.
+    """
+    if not every_n_frames and interval_seconds <= 0:
+        raise ValueError("interval_seconds must be positive")
+
+    fps = get_video_fps(cap, fallback_fps)
+    next_sample_time = 0.0
+    last_timestamp = -1.0
+    frame_index = -1
+
+    while True:
+        if not cap.grab():
+            break
+        frame_index += 1
+
+        # Prefer the container timestamp; fall back to index / fps when the backend doesn't provide it
+        timestamp = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+        if frame_index > 0 and timestamp <= last_timestamp:
+            timestamp = frame_index / fps
+        last_timestamp = timestamp
+
+        if every_n_frames:
+            if frame_index % every_n_frames != 0:
+                continue
+        else:
+            # Small tolerance so rounding in the timestamps doesn't push a sample to the next frame
+            if timestamp + 0.5 / fps < next_sample_time:
+                continue
+            while next_sample_time <= timestamp + 0.5 / fps:
+                next_sample_time += interval_seconds
+
+        ret, frame = cap.retrieve()
+        if not ret or frame is None:
+            print(f"Skipping frame {frame_index} (empty or corrupted)")
+            continue
+
+        yield frame_index, timestamp, frame
+
+
+def batch_frames(samples, batch_size):
+    """Group sampled frames into lists of up to batch_size items for batched inference."""
+    batch = []
+    for sample in samples:
+        batch.append(sample)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class DecodeError:
+    """Carries an exception from the decoder thread to the consumer."""
+
+    def __init__(self, error):
+        self.error = error
+
+
+END_OF_VIDEO = object()
+
+
+def prefetch_frames(samples, max_queued=4):
+    """Decode on a background thread, max_queued frames ahead of the consumer.
+
+    cv2 decoding and the models both release the GIL, so the next frames are decoded while the
+    current ones are in inference. The bounded queue applies backpressure: the decoder blocks
+    once max_queued frames are waiting, so memory stays at max_queued frames. An exception
+    in the decoder is re-raised in the consumer. If the consumer stops early, the decoder is
+    stopped and joined before this generator closes, so the capture can be released safely
+    afterwards. max_queued <= 0 decodes inline.
+    """
+    if max_queued <= 0:
+        return iter(samples)
+    return _prefetch(samples, max_queued)
+
+
+def _prefetch(samples, max_queued):
+    frames = queue.Queue(maxsize=max_queued)
+    stop = threading.Event()
+
+    def put(item):
+        # Poll so a consumer that has gone away can't leave the decoder blocked forever
+        while not stop.is_set():
+            try:
+                frames.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def decode():
+        try:
+            for sample in samples:
+                if not put(sample):
+                    return
+        except Exception as e:
+            put(DecodeError(e))
+            return
+        put(END_OF_VIDEO)
+
+    decoder = threading.Thread(target=decode, name="frame-decoder", daemon=True)
+    decoder.start()
+    try:
+        while True:
+            item = frames.get()
+            if item is END_OF_VIDEO:
+                return
+            if isinstance(item, DecodeError):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        decoder.join()
+
+
+def sample_growing_video(upload, interval_seconds=1.0, fallback_fps=30.0, wait_seconds=5.0, stall_seconds=300.0):
+    """sample_frames() for a video that is still being uploaded; upload is an uploads.Upload.
+
+    Frames are sampled as soon as their bytes have arrived. When the decoder runs out of data
+    before the upload is complete, this waits for more and reopens the file at the first frame
+    it hasn't fully read. A sampled frame is only yielded once the decoder has moved past it,
+    so a frame cut off by the end of the received data is never used. This needs the
+    container's index at the front of the file (MP4 "faststart", as phone cameras and most
+    encoders write for streaming, or MKV/fragmented MP4); with the index at the end nothing
+    can be decoded before the upload completes, and sampling starts then. Raises TimeoutError
+    if no bytes arrive for stall_seconds.
+    """
+    if interval_seconds <= 0:
+        raise ValueError("interval_seconds must be positive")
+
+    next_index = 0  # first frame not read to the end yet
+    next_sample_time = 0.0
+    held = None  # sampled frame waiting for the decoder to move past it
+    while True:
+        received, complete = upload.received, upload.complete
+        cap = cv2.VideoCapture(upload.path)
+        try:
+            if not cap.isOpened():
+                if complete:
+                    raise ValueError("Failed to open video file")
+            else:
+                fps = get_video_fps(cap, fallback_fps)
+                if next_index:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, next_index)
+                frame_index = next_index - 1
+                last_timestamp = -1.0
+                previous_sample_time = next_sample_time
+                while cap.grab():
+                    frame_index += 1
+                    if held is not None:
+                        yield held
+                        held = None
+
+                    timestamp = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+                    if frame_index > 0 and timestamp <= last_timestamp:
+                        timestamp = frame_index / fps
+                    last_timestamp = timestamp
+
+                    # Sampling state before this frame, to roll back to if it turns out to be cut off
+                    previous_sample_time = next_sample_time
+                    if timestamp + 0.5 / fps < next_sample_time:
+                        continue
+                    while next_sample_time <= timestamp + 0.5 / fps:
+                        next_sample_time += interval_seconds
+
+                    ret, frame = cap.retrieve()
+                    if not ret or frame is None:
+                        print(f"Skipping frame {frame_index} (empty or corrupted)")
+                        continue
+                    held = (frame_index, timestamp, frame)
+
+                if complete:
+                    if held is not None:
+                        yield held
+                    return
+
+                # The last frame read may be incomplete: drop it and read it again next time
+                if frame_index >= next_index:
+                    next_index = frame_index
+                    next_sample_time = previous_sample_time
+                    held = None
+        finally:
+            cap.release()
+
+        stalled = 0.0
+        while upload.wait(received, timeout=wait_seconds) == (received, False):
+            stalled += wait_seconds
+            if stalled >= stall_seconds:
+                raise TimeoutError(f"Upload {upload.upload_id} stalled at {received} bytes")
@@ -0,0 +1,164 @@
+import json
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobStore:
+    """Job queue and job records kept in SQLite.
+
+    The default ':memory:' database keeps everything in-process; pass a file path to keep
+    jobs across restarts. Jobs that were running when the process died are re-queued.
+    """
+
+    def __init__(self, db_path=":memory:"):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock, self.connection:
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    progress REAL NOT NULL DEFAULT 0,
+                    message TEXT,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )"""
+            )
+            self.connection.execute("UPDATE jobs SET status = ? WHERE status = ?", (QUEUED, RUNNING))
+
+    def _update(self, job_id, **fields):
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self.lock, self.connection:
+            self.connection.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def create_job(self, payload):
+        """Queue a job and return its id."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO jobs (id, status, payload, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, QUEUED, json.dumps(payload), now, now)
+            )
+        return job_id
+
+    def claim_next_job(self):
+        """Mark the oldest queued job as running and return (job_id, payload), or None if the queue is empty."""
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                "SELECT id, payload FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1", (QUEUED,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.connection.execute(
+                "UPDATE jobs SET status = ?, updated_at = ? WHERE id = ?", (RUNNING, time.time(), row["id"])
+            )
+        return row["id"], json.loads(row["payload"])
+
+    def update_progress(self, job_id, progress, message=None):
+        self._update(job_id, progress=min(max(progress, 0.0), 1.0), message=message)
+
+    def finish_job(self, job_id, result):
+        self._update(job_id, status=DONE, progress=1.0, result=json.dumps(result))
+
+    def fail_job(self, job_id, error):
+        self._update(job_id, status=FAILED, error=error)
+
+    def get_job(self, job_id):
+        """Return the job as a JSON-serialisable dict, or None if it doesn't exist."""
+        with self.lock:
+            row = self.connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+
+        job = {
+            "job_id": row["id"],
+            "status": row["status"],
+            "progress": row["progress"],
+            "message": row["message"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+        if row["result"] is not None:
+            job["result"] = json.loads(row["result"])
+        if row["error"] is not None:
+            job["error"] = row["error"]
+        return job
+
+
+class WorkerPool:
+    """A fixed number of threads that drain a JobStore.
+
+    handler(job_id, payload, report_progress) does the work and returns the job result;
+    report_progress(fraction, message=None) can be called as it goes. An exception marks
+    the job as failed.
+    """
+
+    def __init__(self, store, handler, num_workers=1, poll_interval=1.0):
+        self.store = store
+        self.handler = handler
+        self.num_workers = num_workers
+        self.poll_interval = poll_interval
+        self.wakeup = threading.Condition()
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def start(self):
+        """Start the worker threads; calling it again is a no-op."""
+        with self.wakeup:
+            if self.threads:
+                return
+            for n in range(self.num_workers):
+                thread = threading.Thread(target=self._run, name=f"job-worker-{n}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def notify(self):
+        """Wake an idle worker after a job has been queued."""
+        with self.wakeup:
+            self.wakeup.notify()
+
+    def stop(self, timeout=None):
+        self.stopping.set()
+        with self.wakeup:
+            self.wakeup.notify_all()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def _run(self):
+        while not self.stopping.is_set():
+            job = self.store.claim_next_job()
+            if job is None:
+                # Poll as well as wait so jobs queued by another process sharing the DB get picked up
+                with self.wakeup:
+                    self.wakeup.wait(self.poll_interval)
+                continue
+
+            job_id, payload = job
+            print(f"Worker {threading.current_thread().name} running job {job_id}")
+
+            def report_progress(fraction, message=None):
+                self.store.update_progress(job_id, fraction, message)
+
+            try:
+                result = self.handler(job_id, payload, report_progress)
+            except Exception as e:
+                print(f"Job {job_id} failed: {e}")
+                print(traceback.format_exc())
+                self.store.fail_job(job_id, str(e))
+            else:
+                self.store.finish_job(job_id, result)
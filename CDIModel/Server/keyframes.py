@@ -0,0 +1,67 @@
+import cv2
+import numpy as np
+
+
+def diff_signature(frame, size=32):
+    """Grayscale thumbnail of the frame, scaled to 0..1."""
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, (size, size), interpolation=cv2.INTER_AREA).astype(np.float32) / 255.0
+
+
+def dhash_signature(frame, size=8):
+    """Difference hash: size x size bits saying whether each pixel is brighter than its right neighbour."""
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (size + 1, size), interpolation=cv2.INTER_AREA)
+    return small[:, 1:] > small[:, :-1]
+
+
+def signature_distance(a, b, method):
+    """Distance in 0..1 between two signatures of the same method."""
+    if method == "dhash":
+        return float(np.count_nonzero(a != b)) / a.size
+    return float(np.abs(a - b).mean())
+
+
+class KeyframeSelector:
+    """Drops sampled frames that look almost the same as the last frame that was processed.
+
+    method="diff" compares downsampled grayscale thumbnails by mean absolute difference;
+    method="dhash" compares perceptual difference hashes by Hamming distance. Both distances
+    are in 0..1, and a frame is a keyframe when its distance reaches threshold. A threshold of
+    0 keeps every frame.
+    """
+
+    def __init__(self, threshold=0.04, method="diff"):
+        if method not in ("diff", "dhash"):
+            raise ValueError(f"Unknown keyframe method: {method}")
+        self.threshold = threshold
+        self.method = method
+        self.last_signature = None
+        self.frames_seen = 0
+        self.frames_skipped = 0
+
+    def signature(self, frame):
+        if self.method == "dhash":
+            return dhash_signature(frame)
+        return diff_signature(frame)
+
+    def is_keyframe(self, frame):
+        """True if the frame should go through inference; False if it can reuse the last keyframe's results."""
+        self.frames_seen += 1
+        signature = self.signature(frame)
+        if (self.last_signature is not None and
+                signature_distance(signature, self.last_signature, self.method) < self.threshold):
+            self.frames_skipped += 1
+            return False
+        self.last_signature = signature
+        return True
+
+    def report(self):
+        """How many sampled frames were processed and how many reused an earlier frame's results."""
+        return {
+            "method": self.method,
+            "threshold": self.threshold,
+            "frames_sampled": self.frames_seen,
+            "frames_processed": self.frames_seen - self.frames_skipped,
+            "frames_skipped": self.frames_skipped,
+        }
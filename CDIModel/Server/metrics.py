@@ -0,0 +1,239 @@
+import os
+import threading
+import time
+import uuid
+from functools import wraps
+
+# METRICS_ENABLED=0 turns every timer into a no-op and hides /metrics
+enabled = os.environ.get('METRICS_ENABLED', '1') == '1'
+
+# Seconds; covers everything from a JPEG encode to a CPU Mask R-CNN batch
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Frames per video
+FRAME_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class Histogram:
+    """Prometheus histogram with optional labels; observations are cumulative, like the real client."""
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.series = {}  # label tuple -> [bucket counts..., count, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * (len(self.buckets) + 2)
+            for n, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[n] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, series in sorted(self.series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{format_labels(key + (('le', bound),))} {count}")
+                lines.append(f"{self.name}_bucket{format_labels(key + (('le', '+Inf'),))} {series[-2]}")
+                lines.append(f"{self.name}_count{format_labels(key)} {series[-2]}")
+                lines.append(f"{self.name}_sum{format_labels(key)} {series[-1]}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(key)} {value}")
+        return lines
+
+
+stage_seconds = Histogram("claimswift_stage_seconds", "Time spent in each pipeline stage per call.")
+video_frames_processed = Histogram("claimswift_video_frames_processed", "Sampled frames that went through inference, per video.", FRAME_BUCKETS)
+video_frames_skipped = Histogram("claimswift_video_frames_skipped", "Sampled frames that reused earlier results, per video.", FRAME_BUCKETS)
+frames_total = Counter("claimswift_frames_total", "Sampled frames by outcome.")
+requests_total = Counter("claimswift_requests_total", "Requests by endpoint and status.")
+registry = [stage_seconds, video_frames_processed, video_frames_skipped, frames_total, requests_total]
+
+
+class Trace:
+    """One request's id and the total time it spent in each stage."""
+
+    def __init__(self, trace_id=None):
+        self.id = trace_id or uuid.uuid4().hex[:16]
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def summary(self):
+        """{stage: total ms} for this trace."""
+        with self.lock:
+            return {stage: round(seconds * 1000, 2) for stage, seconds in self.stages.items()}
+
+
+local = threading.local()
+
+
+def start_trace(trace_id=None):
+    """Make a new trace current for this thread and return it."""
+    local.trace = Trace(trace_id)
+    return local.trace
+
+
+def use_trace(trace):
+    """Make an existing trace current for this thread, e.g. in a worker handling the request's job."""
+    local.trace = trace
+
+
+def current_trace():
+    return getattr(local, "trace", None)
+
+
+def trace_report():
+    """{"trace_id", "timings"} for the current trace, to add to a response; empty without one."""
+    trace = current_trace()
+    if trace is None:
+        return {}
+    return {"trace_id": trace.id, "timings": trace.summary()}
+
+
+class StageTimer:
+    """Context manager timing one stage into the histogram and the current trace."""
+
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        stage_seconds.observe(elapsed, stage=self.stage)
+        trace = current_trace()
+        if trace is not None:
+            trace.add(self.stage, elapsed)
+        return False
+
+
+class NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+null_timer = NullTimer()
+
+
+def stage_timer(stage):
+    """`with stage_timer("damage"): ...` times the block; a shared no-op when metrics are disabled."""
+    return StageTimer(stage) if enabled else null_timer
+
+
+def timed(stage):
+    """Decorator form of stage_timer; leaves the function untouched when metrics are disabled."""
+    def decorator(fn):
+        if not enabled:
+            return fn
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with StageTimer(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_iter(iterable, stage):
+    """Yield from iterable, timing each step (e.g. decoding the next sampled frame) as stage."""
+    if not enabled:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    while True:
+        with StageTimer(stage):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def record_video(frames_processed, frames_skipped, frames_without_car=0):
+    """Per-video frame counts, from a keyframe report or equivalent.
+
+    frames_skipped are frames that reused earlier results; frames_without_car were looked at
+    but dropped because no car was found, and only count towards the "no_car" outcome.
+    """
+    if not enabled:
+        return
+    video_frames_processed.observe(frames_processed)
+    video_frames_skipped.observe(frames_skipped)
+    frames_total.inc(frames_processed, outcome="processed")
+    frames_total.inc(frames_skipped, outcome="skipped")
+    if frames_without_car:
+        frames_total.inc(frames_without_car, outcome="no_car")
+
+
+def render_prometheus():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def init_app(app):
+    """Add /metrics and per-request trace ids (X-Request-ID in, X-Trace-Id out) to a Flask app."""
+    if not enabled:
+        return
+    from flask import Response, request
+
+    @app.before_request
+    def begin_trace():
+        start_trace(request.headers.get("X-Request-ID"))
+
+    @app.after_request
+    def end_trace(response):
+        trace = current_trace()
+        if trace is not None:
+            response.headers["X-Trace-Id"] = trace.id
+        requests_total.inc(endpoint=request.endpoint or "unknown", status=response.status_code)
+        return response
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        return Response(render_prometheus(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,106 @@
+import os
+import queue
+import threading
+from contextlib import contextmanager
+
+import torch
+
+
+def available_cores():
+    """CPU ids this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def partition_cores(replicas, cores=None):
+    """Split the cores into `replicas` contiguous slices of near-equal size; with more replicas than cores they share."""
+    cores = list(cores or available_cores())
+    if replicas >= len(cores):
+        return [[cores[i % len(cores)]] for i in range(replicas)]
+
+    size, extra = divmod(len(cores), replicas)
+    slices, start = [], 0
+    for i in range(replicas):
+        end = start + size + (1 if i < extra else 0)
+        slices.append(cores[start:end])
+        start = end
+    return slices
+
+
+def pin_current_thread(cores):
+    """Restrict the calling thread to the given cores.
+
+    Returns the previous affinity so it can be restored. Thread pools created while pinned
+    (onnxruntime sessions, torch's OpenMP team for this thread) inherit the affinity. torch's
+    intra-op thread count can't follow: torch.set_num_threads is process-wide, so setting it
+    here would change it under every other replica's running request. ModelPool sets it once.
+    """
+    previous = None
+    if hasattr(os, "sched_setaffinity"):
+        previous = os.sched_getaffinity(0)
+        os.sched_setaffinity(0, cores)  # pid 0 is the calling thread on Linux
+    return previous
+
+
+class ModelReplica:
+    """One copy of every model a request needs, and the cores it runs on."""
+
+    def __init__(self, index, models, cores):
+        self.index = index
+        self.models = models
+        self.cores = cores
+
+
+class ModelPool:
+    """N model replicas, each pinned to its own slice of cores, handed out to requests one at a time.
+
+    build_models(num_threads) must return a fresh dict of models and is called once per replica
+    while the building thread is pinned to that replica's cores. Requests check a replica out,
+    run on its cores, and check it back in; if every replica is busy the request waits for the
+    next free one. onnxruntime sessions get their own thread count per replica, but torch has one
+    intra-op thread count for the whole process, set once to the smallest replica's core count.
+    """
+
+    def __init__(self, build_models, replicas=1, cores=None):
+        self.free = queue.Queue()
+        self.replicas = []
+
+        for index, replica_cores in enumerate(partition_cores(replicas, cores)):
+            previous = pin_current_thread(replica_cores)
+            try:
+                print(f"Loading model replica {index} on cores {replica_cores}")
+                replica = ModelReplica(index, build_models(len(replica_cores)), replica_cores)
+            finally:
+                if previous is not None:
+                    os.sched_setaffinity(0, previous)
+            self.replicas.append(replica)
+            self.free.put(replica)
+
+        # Process-wide, so sized for one replica rather than reset on every checkout
+        torch.set_num_threads(min(len(replica.cores) for replica in self.replicas))
+        self.local = threading.local()
+
+    @contextmanager
+    def checkout(self, timeout=None):
+        """Yield a replica's models dict, pinning the calling thread to its cores for the duration."""
+        # Nested checkouts on the same thread reuse the replica it already holds
+        held = getattr(self.local, "replica", None)
+        if held is not None:
+            yield held.models
+            return
+
+        try:
+            replica = self.free.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError("No model replica became free in time")
+
+        previous = pin_current_thread(replica.cores)
+        self.local.replica = replica
+        try:
+            yield replica.models
+        finally:
+            self.local.replica = None
+            if previous is not None:
+                os.sched_setaffinity(0, previous)
+            self.free.put(replica)
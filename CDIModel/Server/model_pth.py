@@ -1,2 +1,7 @@
 from ultralytics import YOLO
-parts_model=YOLO(r"D:\CarInsuranceClaim\CDIModel\flask_server\models\model weights\best.pt")
\ No newline at end of file
+
+parts_model_path = r"D:\CarInsuranceClaim\CDIModel\flask_server\models\model weights\best.pt"
+
+def load_parts_model():
+    """Load a fresh copy of the ultralytics parts model; ultralytics models aren't safe to share between threads."""
+    return YOLO(parts_model_path)
@@ -1,38 +1,78 @@
 from flask import Flask, request, jsonify, send_from_directory
 import cv2
 import os
-import base64
 import torch
 from detectron2.config import get_cfg
 from detectron2.engine import DefaultPredictor
-from detectron2.utils.visualizer import Visualizer
-from detectron2.data import MetadataCatalog
 import numpy as np
-from model_pth import parts_model
+from model_pth import load_parts_model, parts_model_path
 from process_video import YOLOModel, VGGModel, process_frame
+from frame_sampler import sample_frames, prefetch_frames
+from overlay import draw_damage_overlay
 from flask_cors import CORS
-import matplotlib.pyplot as plt
-import mysql.connector as connector
 from werkzeug.utils import secure_filename
 from collections import Counter
 import numpy as np
 import math
+import heapq
+from contextlib import closing
+import uuid
+from jobs import JobStore, WorkerPool
+from price_store import create_price_store, PriceLookupError
+from model_pool import ModelPool
+from quantization import quantize_torch_linear
+import metrics
+from metrics import stage_timer, timed_iter
+from result_cache import create_result_cache, file_digest, cache_key, model_version
+from encoder import create_frame_encoder
 
 app = Flask(__name__)
 CORS(app)
-# Initialize YOLO and VGG models
-yolo_model = YOLOModel(r"D:\CarInsuranceClaim\CDIModel\yolo\yolov5s.onnx")
-vgg_model = VGGModel(r"D:\CarInsuranceClaim\CDIModel\vgg\vgg_damage_model.pth")
-# Initialize Detectron2 model
+# /metrics and per-request trace ids
+metrics.init_app(app)
+# Damage detection config
 cfg = get_cfg()
 cfg.merge_from_file(r"D:\CarInsuranceClaim\CDIModel\V_MODELS\damage\config_detectron.yaml")
 cfg.MODEL.WEIGHTS = r"D:\CarInsuranceClaim\CDIModel\V_MODELS\damage\detectron_model.pth"
 cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = 0.7
 cfg.MODEL.DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-predictor = DefaultPredictor(cfg)
 
-# Initialize YOLO model for damage detection
-parts_identifier_model = parts_model
+yolo_weights = r"D:\CarInsuranceClaim\CDIModel\yolo\yolov5s.onnx"
+vgg_weights = r"D:\CarInsuranceClaim\CDIModel\vgg\vgg_damage_model.pth"
+
+# INT8_INFERENCE=1 runs int8 copies of the models on CPU; YOLO is calibrated on the QUANT_CALIBRATION_DIR images
+int8_inference = os.environ.get('INT8_INFERENCE', '0') == '1'
+quant_calibration_dir = os.environ.get('QUANT_CALIBRATION_DIR', r"D:\CarInsuranceClaim\CDIModel\data\img")
+
+def build_damage_predictor():
+    predictor = DefaultPredictor(cfg)
+    if int8_inference and cfg.MODEL.DEVICE == "cpu":
+        # int8 box head; the convolutional backbone stays fp32
+        predictor.model = quantize_torch_linear(predictor.model)
+    return predictor
+
+def build_models(num_threads):
+    """Load one replica of YOLO, VGG, the Detectron2 damage model and the ultralytics parts model."""
+    return {
+        "yolo": YOLOModel(yolo_weights, intra_op_threads=num_threads,
+                          quantize=int8_inference, calibration_dir=quant_calibration_dir),
+        # VGG_BACKEND=onnx runs the classifier through onnxruntime
+        "vgg": VGGModel(vgg_weights,
+                        backend=os.environ.get('VGG_BACKEND', 'torch'),
+                        intra_op_threads=int(os.environ.get('VGG_THREADS', '0')) or num_threads,
+                        quantize=int8_inference),
+        "damage": build_damage_predictor(),
+        "parts": load_parts_model(),
+    }
+
+# MODEL_REPLICAS copies of the models, each on its own slice of the CPU cores
+model_replicas = int(os.environ.get('MODEL_REPLICAS', '1'))
+model_pool = ModelPool(build_models, replicas=model_replicas)
+
+# Best-frame detections per uploaded video, keyed by the video's hash and the weights in use
+video_cache = create_result_cache('upload_video')
+vision_version = model_version(yolo_weights, vgg_weights, cfg.MODEL.WEIGHTS, parts_model_path,
+                               os.environ.get('VGG_BACKEND', 'torch'), f"int8={int8_inference}")
 
 # Database configuration
 db_config = {
@@ -42,61 +82,49 @@ db_config = {
     'database': 'vehicle_damage_detection'
 }
 
-def connect_to_db():
-    try:
-        connection = connector.connect(**db_config)
-        return connection
-    except connector.Error as e:
-        print(f"Error connecting to database: {e}")
-        return None
+# Pooled, cached price lookups (PRICE_DB_PATH switches to a local SQLite copy)
+price_store = create_price_store(db_config)
 
 def get_part_prices(car_name, car_model, class_counts, bounding_boxes):
-    connection = connect_to_db()
-    if connection:
-        try:
-            with connection.cursor(dictionary=True) as cursor:
-                prices = {}
-                total_area = sum(box[2] * box[3] for box in bounding_boxes)  # Total area of all bounding boxes
-                for class_id, box in zip(class_counts.keys(), bounding_boxes):
-                    part_name = get_part_name_from_id(class_id)
-                    if part_name:
-                        cursor.execute(
-                            "SELECT price FROM car_models WHERE brand = %s AND model = %s AND part = %s",
-                            (car_name, car_model, part_name)
-                        )
-                        price_data = cursor.fetchone()
-                        if price_data:
-                            price_per_part = float(price_data['price'])  # Ensure price is a standard float
-                            box_area = float(box[2] * box[3])  # Width * Height, converted to float
-                            percentage = float((box_area / total_area) * 100)  # Convert to standard float
-
-                            # Determine repair or replace
-                            if part_name in ["Light", "Windshield"]:
-                                # Fixed price for Light and Windshield
-                                total_price = price_per_part
-                                repair_or_replace = "replace"
-                            else:
-                                if percentage > 80:
-                                    # Replace the part (full price)
-                                    total_price = price_per_part
-                                    repair_or_replace = "replace"
-                                else:
-                                    # Repair the part (percentage of price)
-                                    total_price = price_per_part * (percentage / 100)
-                                    total_price = math.ceil(total_price)
-                                    repair_or_replace = "repair"
-
-                            prices[part_name] = {
-                                'price': price_per_part,
-                                'total': float(total_price),  # Ensure total is a standard float
-                                'repair_or_replace': repair_or_replace,
-                                'percentage': percentage
-                            }
-                return prices
-        except connector.Error as e:
-            print(f"Error executing query: {e}")
-            return {}
-    return {}
+    part_names = [get_part_name_from_id(class_id) for class_id in class_counts.keys()]
+    try:
+        # One query for every detected part instead of one per part
+        price_table = price_store.get_prices(car_name, car_model, [name for name in part_names if name])
+    except PriceLookupError as e:
+        print(f"Error executing query: {e}")
+        return {}
+
+    prices = {}
+    total_area = sum(box[2] * box[3] for box in bounding_boxes)  # Total area of all bounding boxes
+    for part_name, box in zip(part_names, bounding_boxes):
+        if part_name in price_table:
+            price_per_part = float(price_table[part_name])  # Ensure price is a standard float
+            box_area = float(box[2] * box[3])  # Width * Height, converted to float
+            percentage = float((box_area / total_area) * 100)  # Convert to standard float
+
+            # Determine repair or replace
+            if part_name in ["Light", "Windshield"]:
+                # Fixed price for Light and Windshield
+                total_price = price_per_part
+                repair_or_replace = "replace"
+            else:
+                if percentage > 80:
+                    # Replace the part (full price)
+                    total_price = price_per_part
+                    repair_or_replace = "replace"
+                else:
+                    # Repair the part (percentage of price)
+                    total_price = price_per_part * (percentage / 100)
+                    total_price = math.ceil(total_price)
+                    repair_or_replace = "repair"
+
+            prices[part_name] = {
+                'price': price_per_part,
+                'total': float(total_price),  # Ensure total is a standard float
+                'repair_or_replace': repair_or_replace,
+                'percentage': percentage
+            }
+    return prices
 
 def get_part_name_from_id(class_id):
     class_names = ['Bonnet', 'Bumper', 'Dickey', 'Door', 'Fender', 'Light', 'Windshield']
@@ -111,52 +139,190 @@ processed_frame_folder = './processed_frames'
 os.makedirs(uploaded_videos_folder, exist_ok=True)
 os.makedirs(processed_frame_folder, exist_ok=True)
 
-def encode_image_to_base64(image):
-    """Convert an image to a Base64 string."""
-    _, img_encoded = cv2.imencode('.jpg', image)
-    return base64.b64encode(img_encoded).decode('utf-8')
+# Sampled frames decoded ahead of inference on a background thread; 0 decodes inline
+decode_queue_size = int(os.environ.get('DECODE_QUEUE_SIZE', '8'))
+
+# Frames that get damage masking, rendering and pricing; top_k in the request overrides it
+default_top_k = int(os.environ.get('BEST_FRAME_TOP_K', '1'))
+max_top_k = int(os.environ.get('BEST_FRAME_MAX_TOP_K', '5'))
+
+# Thread pool that encodes the top frames' images while the next ones are rendered
+frame_encoder = create_frame_encoder()
 
-def detect_damage(frame):
+# DEBUG_DUMP_FRAMES=1 also writes the intermediate and detected frames to processed_frames/
+debug_dump_frames = os.environ.get('DEBUG_DUMP_FRAMES', '0') == '1'
+
+def detect_damage(frame, predictor):
     """Run the Detectron2 model on the processed frame and return the annotated image."""
-    outputs = predictor(frame)
+    with stage_timer("detect_damage"):
+        outputs = predictor(frame)
 
     # Extract predictions
     instances = outputs["instances"]
-    scores = instances.scores
-    pred_classes = instances.pred_classes
-    pred_boxes = instances.pred_boxes
 
-    # Visualize results
-    v = Visualizer(frame[:, :, ::-1], MetadataCatalog.get(cfg.DATASETS.TEST[0]), scale=0.5)
-    out = v.draw_instance_predictions(instances.to("cpu"))
+    # Draw masks, boxes, labels and the damage count straight into the frame buffer
+    with stage_timer("render"):
+        return draw_damage_overlay(frame, instances)
 
-    # Annotate the damage on the frame
-    damage_count = len(pred_classes)
-    for i in range(damage_count):
-        score = scores[i].item()
-        label = pred_classes[i].item()
-        damage_text = f"Damage: {label}, {score*100:.2f}%"
+def frame_score(boxes):
+    """Ranking of a frame for best-frame selection: more detected parts first, then higher total confidence."""
+    return (len(boxes), round(float(boxes.conf.sum()), 4) if len(boxes) else 0.0)
 
-        # Get bounding box
-        box = pred_boxes[i].tensor.cpu().numpy().flatten()
-        top_left = (int(box[0]), int(box[1]))
-        bottom_right = (int(box[2]), int(box[3]))
+def find_best_frames(video_path, models, report_progress=None, top_k=1):
+    """Find the top_k frames with the most detected parts, best first.
 
-        # Draw text
-        out.ax.text(top_left[0], top_left[1] - 10, damage_text, color='white', fontsize=10,
-                    bbox=dict(facecolor='black', alpha=0.5, boxstyle='round,pad=0.3'))
+    Two passes: every sampled frame gets only YOLO/VGG and the parts model, and the top_k
+    candidates are kept by frame_score(). Damage masking, rendering and encoding then run on
+    those top_k frames alone. Returns the vision results for each (JSON-serialisable, so they
+    can be cached); empty if no frame had a car. models is a replica checked out of model_pool.
+    """
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise ValueError("Failed to open video file")
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
 
-    # Display total damage parts at the bottom
-    damage_count_text = f"Total Damage Parts: {damage_count}"
-    out.ax.text(0.5, 0.05, damage_count_text, color='white', fontsize=10, ha='center', va='bottom',
-                transform=out.ax.transAxes, bbox=dict(facecolor='black', alpha=0.7, boxstyle='round,pad=0.5'))
+    frames_with_car, frames_without_car = 0, 0
+    candidates = []  # min-heap of (score, -frame_index, frame_index, processed_frame, label, parts_result)
 
-    return out.get_image()[:, :, ::-1]
+    # Pass 1: score every frame, decoding the file once in order, one frame per second;
+    # closing() joins the decoder thread before the capture goes away, also on errors
+    try:
+        with closing(prefetch_frames(sample_frames(cap, interval_seconds=1.0), decode_queue_size)) as samples:
+            for i, _, frame in timed_iter(samples, "decode"):
+                if report_progress and frame_count > 0:
+                    # Frame count is only an estimate from the container, so never report 100% before the end
+                    report_progress(min(i / frame_count, 0.99), f"Processing frame {i}")
+
+                # Process frame using YOLO and VGG models
+                with stage_timer("process_frame"):
+                    processed_frame, label = process_frame(frame, models["yolo"], models["vgg"])
+
+                if label == "No car detected":
+                    frames_without_car += 1
+                    continue  # Skip frames with no car detected
+                frames_with_car += 1
+
+                # Run the parts model on the in-memory frame; ultralytics takes BGR NumPy arrays directly
+                if debug_dump_frames:
+                    cv2.imwrite(os.path.join(processed_frame_folder, f"temp_frame_{i}.jpg"), processed_frame)
+                with stage_timer("detect_parts"):
+                    result = models["parts"](processed_frame, verbose=False)[0]
+
+                # Frames without any part never made it to the response before either
+                if not len(result.boxes):
+                    continue
+                # Ties go to the earlier frame, which is what the old "first new maximum" rule picked
+                candidate = (frame_score(result.boxes), -i, i, processed_frame, label, result)
+                if len(candidates) < top_k:
+                    heapq.heappush(candidates, candidate)
+                elif candidate[:2] > candidates[0][:2]:
+                    heapq.heapreplace(candidates, candidate)
+    finally:
+        cap.release()
+    # Every frame is looked at, none reuses another's results; frames without a car are their own outcome
+    metrics.record_video(frames_with_car, 0, frames_without_car=frames_without_car)
+
+    # Pass 2: the expensive work, on the winners only
+    best_frames = []
+    for _, _, i, processed_frame, label, result in sorted(candidates, key=lambda c: c[:2], reverse=True):
+        class_ids = [box.cls.item() for box in result.boxes]
+        bounding_boxes = [box.xywh.cpu().numpy().flatten().tolist() for box in result.boxes]  # Get bounding boxes as floats
+
+        # Draw the detections and encode them for the response straight from memory
+        with stage_timer("render"):
+            detected_image = result.plot()
+        encodes = {"frame": frame_encoder.submit_base64(detected_image)}
+        if debug_dump_frames:
+            cv2.imwrite(os.path.join(processed_frame_folder, f"detected_frame_{i}.jpg"), detected_image)
+
+        # Generate masked image
+        masked_image = detect_damage(processed_frame, models["damage"])
+        encodes["masked_image"] = frame_encoder.submit_base64(masked_image)
+
+        best_frames.append((encodes, {
+            "index": i,
+            "label": label,
+            "class_ids": class_ids,
+            "bounding_boxes": bounding_boxes,
+            "total_detected_parts": len(class_ids)
+        }))
+
+    return [dict(data, **{name: future.result() for name, future in encodes.items()}) for encodes, data in best_frames]
+
+def price_frame(frame, car_name, car_model):
+    """Response entry for one frame, with its parts priced for this car."""
+    # Fetch part prices from the database
+    class_counts = Counter(frame["class_ids"])
+    part_prices = get_part_prices(car_name, car_model, class_counts, frame["bounding_boxes"])
+
+    return {
+        "frame": frame["frame"],
+        "label": frame["label"],
+        "part_prices": part_prices,
+        "masked_image": frame["masked_image"],
+        "total_detected_parts": frame["total_detected_parts"]
+    }
+
+def price_best_frames(best_frames, car_name, car_model):
+    """Build the response body for the top frames, best first; with more than one, all of them are in "top_frames"."""
+    if not best_frames:
+        return {
+            "message": "No car detected in any frame. Please Upload a Video that belongs to a Car"
+        }
+
+    priced = [price_frame(frame, car_name, car_model) for frame in best_frames]
+    response = {
+        "message": "Processing complete!",
+        "best_frame": priced[0]
+    }
+    if len(priced) > 1:
+        response["top_frames"] = priced
+    return response
+
+def run_video_job(job_id, payload, report_progress):
+    """Worker entry point for queued upload_video jobs.
+
+    A video that was analysed before with the same models skips inference and is only re-priced.
+    Stage timings go to the trace of the request that queued the job. The uploaded video is
+    deleted once the job is done, whether it succeeded or not.
+    """
+    try:
+        metrics.start_trace(payload.get('trace_id'))
+        key = payload.get('cache_key')
+        cached = video_cache.get(key)
+        if cached is not None:
+            print(f"Job {job_id}: reusing cached detections")
+            return dict(price_best_frames(cached['best_frames'], payload['car_name'], payload['car_model']),
+                        **metrics.trace_report())
+
+        with model_pool.checkout() as models:
+            best_frames = find_best_frames(payload['video_path'], models, report_progress, payload.get('top_k', 1))
+        video_cache.put(key, {'best_frames': best_frames})
+        return dict(price_best_frames(best_frames, payload['car_name'], payload['car_model']), **metrics.trace_report())
+    finally:
+        try:
+            os.remove(payload['video_path'])
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Job {job_id}: could not remove {payload['video_path']}: {e}")
+
+# Background inference workers; the queue lives in SQLite (in memory unless JOB_DB_PATH is set).
+# They start right away so jobs re-queued after a restart run without waiting for a new upload.
+job_store = JobStore(os.environ.get('JOB_DB_PATH', ':memory:'))
+job_workers = WorkerPool(job_store, run_video_job, num_workers=int(os.environ.get('JOB_WORKERS', model_replicas)))
+job_workers.start()
 
 @app.route('/upload_video', methods=['POST'])
 def upload_video():
-    """Upload and process video, then run damage detection on frames."""
+    """Save the uploaded video and queue it for processing; poll /jobs/<job_id> for the result.
+
+    top_k (default BEST_FRAME_TOP_K) is how many of the best frames get damage masks and prices.
+    """
     print('Uploading video')
+    if 'video' not in request.files:
+        return jsonify({'error': 'No video file uploaded'}), 400
+
     video_file = request.files['video']
     car_name = request.form.get('car_name')
     car_model = request.form.get('car_model')
@@ -164,81 +330,38 @@ def upload_video():
     if not car_name or not car_model:
         return jsonify({'error': 'Car name and model are required.'}), 400
 
-    video_path = os.path.join(uploaded_videos_folder, video_file.filename)
-    video_file.save(video_path)
+    top_k = request.form.get('top_k', default_top_k, type=int)
+    if not 1 <= top_k <= max_top_k:
+        return jsonify({'error': f'top_k must be between 1 and {max_top_k}.'}), 400
 
-    cap = cv2.VideoCapture(video_path)
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    frame_interval = int(fps * 1)  # Process one frame per second
-
-    max_detected_parts = 0  # Track the maximum number of detected parts
-    best_frame_data = None  # Store data for the frame with the most detected parts
-
-    for i in range(0, frame_count, frame_interval):
-        cap.set(cv2.CAP_PROP_POS_FRAMES, i)
-        ret, frame = cap.read()
-        if not ret:
-            break
-
-        # Process frame using YOLO and VGG models
-        processed_frame, label = process_frame(frame, yolo_model, vgg_model)
-
-        if label == "No car detected":
-            continue  # Skip frames with no car detected
-
-        # Save the frame temporarily
-        temp_frame_path = os.path.join(processed_frame_folder, f"temp_frame_{i}.jpg")
-        cv2.imwrite(temp_frame_path, processed_frame)
-        result = parts_identifier_model(temp_frame_path)
-        detected_objects = result[0].boxes
-        class_ids = [box.cls.item() for box in detected_objects]
-        bounding_boxes = [box.xywh.cpu().numpy().flatten() for box in detected_objects]  # Get bounding boxes
-        bounding_boxes = [box.astype(float) for box in bounding_boxes]  # Convert to standard float
-        class_counts = Counter(class_ids)
-
-        # Count the total number of detected parts
-        total_detected_parts = sum(class_counts.values())
-
-        # Check if this frame has the highest number of detected parts
-        if total_detected_parts > max_detected_parts:
-            max_detected_parts = total_detected_parts
-
-            # Fetch part prices from the database
-            part_prices = get_part_prices(car_name, car_model, class_counts, bounding_boxes)
-
-            # Save the detected image
-            detected_image_path = os.path.join(processed_frame_folder, f"detected_frame_{i}.jpg")
-            result[0].save(detected_image_path)
-
-            # Encode for response
-            with open(detected_image_path, "rb") as img_file:
-                detected_image_base64 = base64.b64encode(img_file.read()).decode('utf-8')
-
-            # Generate masked image
-            masked_image = detect_damage(processed_frame)
-            masked_image_base64 = encode_image_to_base64(masked_image)
-
-            # Store the best frame data
-            best_frame_data = {
-                "frame": detected_image_base64,
-                "label": label,
-                "part_prices": part_prices,
-                "masked_image": masked_image_base64,
-                "total_detected_parts": total_detected_parts
-            }
-
-    cap.release()
+    # Unique name per upload so concurrent jobs never overwrite each other's video
+    filename = f"{uuid.uuid4().hex}_{secure_filename(video_file.filename) or 'video.mp4'}"
+    video_path = os.path.join(uploaded_videos_folder, filename)
+    video_file.save(video_path)
 
-    if best_frame_data:
-        return jsonify({
-            "message": "Processing complete!",
-            "best_frame": best_frame_data
-        })
-    else:
-        return jsonify({
-            "message": "No car detected in any frame. Please Upload a Video that belongs to a Car"
-        })
+    job_id = job_store.create_job({
+        'video_path': video_path,
+        'cache_key': cache_key(file_digest(video_path), vision_version, top_k=top_k),
+        'top_k': top_k,
+        'trace_id': metrics.trace_report().get('trace_id'),
+        'car_name': car_name,
+        'car_model': car_model
+    })
+    job_workers.notify()
+
+    return jsonify({
+        'job_id': job_id,
+        'status': 'queued',
+        'status_url': f'/jobs/{job_id}'
+    }), 202
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    """Report progress, and the result once finished, for a queued video job."""
+    job = job_store.get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job id'}), 404
+    return jsonify(job)
 
 @app.route('/processed_frames/<filename>')
 def serve_processed_frame(filename):
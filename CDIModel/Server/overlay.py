@@ -0,0 +1,84 @@
+import cv2
+import numpy as np
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+# Fixed BGR palette so an instance keeps the same colour from frame to frame
+PALETTE = [
+    (75, 25, 230), (75, 180, 60), (25, 225, 255), (200, 130, 0), (48, 130, 245),
+    (180, 30, 145), (240, 240, 70), (230, 50, 240), (60, 245, 210), (212, 190, 250),
+]
+
+
+def draw_text_box(image, text, origin, font_scale=0.5, bg_alpha=0.5, padding=4):
+    """Draw white text on a translucent black box whose bottom-left corner is at origin."""
+    (text_w, text_h), baseline = cv2.getTextSize(text, FONT, font_scale, 1)
+    h, w = image.shape[:2]
+    x1 = int(min(max(origin[0], 0), max(w - text_w - 2 * padding, 0)))
+    y2 = int(min(max(origin[1], text_h + baseline + 2 * padding), h))
+    x2 = min(x1 + text_w + 2 * padding, w)
+    y1 = max(y2 - text_h - baseline - 2 * padding, 0)
+
+    # Blending with black is just a scale of the pixels underneath
+    region = image[y1:y2, x1:x2]
+    region[:] = (region * (1.0 - bg_alpha)).astype(np.uint8)
+    cv2.putText(image, text, (x1 + padding, y2 - baseline - padding), FONT, font_scale, (255, 255, 255), 1, cv2.LINE_AA)
+
+
+def draw_damage_overlay(frame, instances, mask_alpha=0.5):
+    """Draw Detectron2 damage predictions straight into a copy of the frame buffer.
+
+    Alpha-blends each instance mask, outlines it, draws its box and "Damage: class, score%"
+    label, and adds the "Total Damage Parts" banner at the bottom. Output stays at the
+    input resolution.
+    """
+    output = np.ascontiguousarray(frame, dtype=np.uint8).copy()
+    h, w = output.shape[:2]
+    instances = instances.to("cpu")
+
+    boxes = instances.pred_boxes.tensor.numpy() if instances.has("pred_boxes") else np.empty((0, 4))
+    masks = instances.pred_masks.numpy() if instances.has("pred_masks") else None
+    scores = instances.scores.numpy() if instances.has("scores") else np.ones(len(boxes))
+    classes = instances.pred_classes.numpy() if instances.has("pred_classes") else np.zeros(len(boxes), dtype=int)
+    font_scale = max(0.4, min(h, w) / 1200)
+
+    for i, box in enumerate(boxes):
+        color = PALETTE[i % len(PALETTE)]
+        x1, y1, x2, y2 = np.clip(box, 0, [w, h, w, h]).astype(int)
+
+        if masks is not None:
+            # Only touch the pixels inside the box; the mask is zero everywhere else
+            mask = masks[i][y1:y2, x1:x2].astype(bool)
+            region = output[y1:y2, x1:x2]
+            region[mask] = (region[mask] * (1.0 - mask_alpha) + np.array(color) * mask_alpha).astype(np.uint8)
+            contours, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            cv2.drawContours(output, contours, -1, color, 1, cv2.LINE_AA, offset=(int(x1), int(y1)))
+
+        cv2.rectangle(output, (int(x1), int(y1)), (int(x2), int(y2)), color, 2)
+        draw_text_box(output, f"Damage: {classes[i]}, {scores[i] * 100:.2f}%", (x1, y1 - 10), font_scale, 0.5)
+
+    # Display total damage parts at the bottom
+    banner = f"Total Damage Parts: {len(boxes)}"
+    (text_w, _), _ = cv2.getTextSize(banner, FONT, font_scale, 1)
+    draw_text_box(output, banner, ((w - text_w) // 2, int(h * 0.95)), font_scale, 0.7)
+
+    return output
+
+
+def draw_tracked_damage(frame, tracks):
+    """Draw tracked damage boxes, coloured by track id, for frames that reused earlier detections."""
+    output = np.ascontiguousarray(frame, dtype=np.uint8).copy()
+    h, w = output.shape[:2]
+    font_scale = max(0.4, min(h, w) / 1200)
+
+    for track in tracks:
+        color = PALETTE[track.id % len(PALETTE)]
+        x1, y1, x2, y2 = np.clip(track.box, 0, [w, h, w, h]).astype(int)
+        cv2.rectangle(output, (int(x1), int(y1)), (int(x2), int(y2)), color, 2)
+        draw_text_box(output, f"Damage #{track.id} (tracked)", (x1, y1 - 10), font_scale, 0.5)
+
+    banner = f"Total Damage Parts: {len(tracks)}"
+    (text_w, _), _ = cv2.getTextSize(banner, FONT, font_scale, 1)
+    draw_text_box(output, banner, ((w - text_w) // 2, int(h * 0.95)), font_scale, 0.7)
+
+    return output
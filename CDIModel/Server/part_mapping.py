@@ -0,0 +1,71 @@
+import numpy as np
+
+# Classes of the Detectron2 parts model (V_MODELS/parts)
+PART_CLASS_NAMES = [
+    "Car-parts", "Car boot", "Car hood", "Driver-s door - -F-R-", "Fender - -F-L-",
+    "Fender - -F-R-", "Fender - -R-L-", "Fender - -R-R-", "Front bumper",
+    "Headlight - -L-", "Headlight - -R-", "Passenger-s door - -F-L-", "Passenger-s door - -R-L-",
+    "Passenger-s door - -R-R-", "Rear bumper", "Rear light - -L-", "Rear light - -R-",
+    "Side bumper - -L-", "Side bumper - -R-", "Side mirror - -L-", "Side mirror - -R-"
+]
+
+
+def box_overlaps(damage_boxes, part_boxes):
+    """IoU and coverage between every damage box (N x 4) and every part box (M x 4).
+
+    Coverage is the share of the damage box's area that lies inside the part box; it is what
+    decides which part a small dent belongs to, since its IoU with a whole door is always low.
+    Returns two N x M arrays.
+    """
+    d = np.asarray(damage_boxes, dtype=np.float32).reshape(-1, 4)
+    p = np.asarray(part_boxes, dtype=np.float32).reshape(-1, 4)
+    x1 = np.maximum(d[:, None, 0], p[None, :, 0])
+    y1 = np.maximum(d[:, None, 1], p[None, :, 1])
+    x2 = np.minimum(d[:, None, 2], p[None, :, 2])
+    y2 = np.minimum(d[:, None, 3], p[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_d = (d[:, 2] - d[:, 0]) * (d[:, 3] - d[:, 1])
+    area_p = (p[:, 2] - p[:, 0]) * (p[:, 3] - p[:, 1])
+    iou = inter / np.maximum(area_d[:, None] + area_p[None, :] - inter, 1e-6)
+    coverage = inter / np.maximum(area_d[:, None], 1e-6)
+    return iou, coverage
+
+
+def assign_damage_to_parts(damage_boxes, part_boxes, part_classes, part_scores, class_names, min_coverage=0.3):
+    """Attribute each damage box to the part that contains most of it.
+
+    Ties on coverage go to the part with the higher IoU. Damage covered less than min_coverage
+    by every part is left unassigned. Returns (damaged_parts, unassigned): damaged_parts is a
+    list of {"part", "part_box", "part_score", "damage": [{"index", "box", "coverage"}]} for
+    every part with damage on it, most damaged first; unassigned lists damage indices.
+    """
+    damage_boxes = np.asarray(damage_boxes, dtype=np.float32).reshape(-1, 4)
+    part_boxes = np.asarray(part_boxes, dtype=np.float32).reshape(-1, 4)
+    if len(damage_boxes) == 0:
+        return [], []
+    if len(part_boxes) == 0:
+        return [], list(range(len(damage_boxes)))
+
+    iou, coverage = box_overlaps(damage_boxes, part_boxes)
+    # Coverage decides; IoU (always < 1) only breaks ties between equal coverage
+    best = np.argmax(np.round(coverage, 3) + iou * 1e-4, axis=1)
+    best_coverage = coverage[np.arange(len(damage_boxes)), best]
+    assigned = best_coverage >= min_coverage
+
+    damaged_parts = {}
+    for d in np.flatnonzero(assigned):
+        p = int(best[d])
+        entry = damaged_parts.setdefault(p, {
+            "part": class_names[int(part_classes[p])],
+            "part_box": [round(float(v), 1) for v in part_boxes[p]],
+            "part_score": round(float(part_scores[p]), 4),
+            "damage": []
+        })
+        entry["damage"].append({
+            "index": int(d),
+            "box": [round(float(v), 1) for v in damage_boxes[d]],
+            "coverage": round(float(best_coverage[d]), 3)
+        })
+
+    ordered = sorted(damaged_parts.values(), key=lambda entry: -len(entry["damage"]))
+    return ordered, [int(d) for d in np.flatnonzero(~assigned)]
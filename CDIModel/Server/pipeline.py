@@ -0,0 +1,183 @@
+import queue
+import threading
+
+import metrics
+
+# Seconds a blocked get/put waits before checking whether the pipeline was stopped
+POLL_SECONDS = 0.1
+
+
+class Stage:
+    """One step of a Pipeline: fn(item) -> item, run by `workers` threads."""
+
+    def __init__(self, name, fn, workers=1):
+        if workers < 1:
+            raise ValueError(f"Stage {name} needs at least one worker")
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+
+
+class StageError:
+    """Carries an exception from a stage to the consumer, in the failed item's place."""
+
+    def __init__(self, stage, error):
+        self.stage = stage
+        self.error = error
+
+
+END = object()
+
+
+class Stopped(Exception):
+    """The consumer went away; raised inside workers to unwind them."""
+
+
+class InOrder:
+    """Forwards (seq, item) pairs to a queue in sequence order, whichever worker finishes first."""
+
+    def __init__(self, out, stop):
+        self.out = out
+        self.stop = stop
+        self.pending = {}
+        self.next_seq = 0
+        self.lock = threading.Lock()
+
+    def deliver(self, seq, item):
+        with self.lock:
+            if seq < self.next_seq or seq in self.pending:
+                return  # END is re-delivered by every worker of the stage
+            self.pending[seq] = item
+            while self.next_seq in self.pending:
+                put(self.out, (self.next_seq, self.pending.pop(self.next_seq)), self.stop)
+                self.next_seq += 1
+
+
+def put(q, entry, stop):
+    while not stop.is_set():
+        try:
+            q.put(entry, timeout=POLL_SECONDS)
+            return
+        except queue.Full:
+            continue
+    raise Stopped()
+
+
+def get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=POLL_SECONDS)
+        except queue.Empty:
+            continue
+    raise Stopped()
+
+
+class Pipeline:
+    """Run items through a chain of stages, each on its own threads, joined by bounded queues.
+
+    While stage k works on item n, stage k-1 can already work on item n+1, so with stages
+    that release the GIL (onnxruntime, torch, cv2) the models overlap instead of taking turns.
+    Every stage sees its input in the original order, even after a stage with several
+    workers, so stateful stages (trackers) stay correct as long as they have one worker.
+    Each queue holds at most max_queued items, which bounds memory and applies backpressure
+    all the way back to the source.
+
+    An exception in a stage is re-raised from run() at the failed item's position. Closing
+    run()'s generator early stops and joins every thread. Worker threads record their stage
+    timers into the trace of the thread that called run(), and inherit its CPU affinity.
+    With threaded=False the stages run one after another on the calling thread instead.
+    """
+
+    def __init__(self, stages, max_queued=2, threaded=True):
+        self.stages = list(stages)
+        self.max_queued = max(1, max_queued)
+        self.threaded = threaded
+
+    def run(self, items):
+        """Yield each item after it has passed through every stage, in input order."""
+        if not self.threaded:
+            return self._run_inline(items)
+        return self._run_threaded(items)
+
+    def _run_inline(self, items):
+        for item in items:
+            for stage in self.stages:
+                item = stage.fn(item)
+            yield item
+
+    def _run_threaded(self, items):
+        stop = threading.Event()
+        trace = metrics.current_trace()
+        queues = [queue.Queue(maxsize=self.max_queued) for _ in range(len(self.stages) + 1)]
+        threads = []
+
+        def feed():
+            metrics.use_trace(trace)
+            seq = 0
+            try:
+                for item in items:
+                    put(queues[0], (seq, item), stop)
+                    seq += 1
+            except Stopped:
+                return
+            except Exception as e:
+                try:
+                    put(queues[0], (seq, StageError("source", e)), stop)
+                    seq += 1
+                except Stopped:
+                    return
+            try:
+                put(queues[0], (seq, END), stop)
+            except Stopped:
+                pass
+
+        def work(stage, inbox, forward):
+            metrics.use_trace(trace)
+            try:
+                while True:
+                    seq, item = get(inbox, stop)
+                    if item is END:
+                        put(inbox, (seq, item), stop)  # let this stage's other workers see it too
+                        forward.deliver(seq, item)
+                        return
+                    if not isinstance(item, StageError):
+                        try:
+                            item = stage.fn(item)
+                        except Exception as e:
+                            item = StageError(stage.name, e)
+                    forward.deliver(seq, item)
+            except Stopped:
+                return
+
+        threads.append(threading.Thread(target=feed, name="pipeline-source", daemon=True))
+        for k, stage in enumerate(self.stages):
+            forward = InOrder(queues[k + 1], stop)
+            for n in range(stage.workers):
+                threads.append(threading.Thread(target=work, args=(stage, queues[k], forward),
+                                                name=f"pipeline-{stage.name}-{n}", daemon=True))
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                _, item = queues[-1].get()
+                if item is END:
+                    return
+                if isinstance(item, StageError):
+                    print(f"Pipeline stage {item.stage} failed: {item.error}")
+                    raise item.error
+                yield item
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+
+def parse_workers(spec):
+    """"cars=1,encode=2" -> {"cars": 1, "encode": 2}."""
+    workers = {}
+    for part in spec.split(","):
+        if part.strip():
+            name, _, count = part.partition("=")
+            workers[name.strip()] = int(count)
+    return workers
@@ -0,0 +1,161 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class PriceLookupError(Exception):
+    """Raised when the price database can't be reached or queried."""
+
+
+class PriceCache:
+    """Thread-safe LRU cache of (brand, model, part) -> price with a time-to-live.
+
+    Parts that have no price are cached as None too, so a missing row doesn't cost a query
+    on every request.
+    """
+
+    def __init__(self, max_entries=4096, ttl_seconds=300):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_many(self, keys):
+        """Return ({key: price} for fresh hits, [keys that missed])."""
+        hits, misses = {}, []
+        now = time.monotonic()
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is None or entry[1] < now:
+                    self.entries.pop(key, None)
+                    misses.append(key)
+                    continue
+                self.entries.move_to_end(key)
+                hits[key] = entry[0]
+        return hits, misses
+
+    def put_many(self, items):
+        expires = time.monotonic() + self.ttl_seconds
+        with self.lock:
+            for key, price in items.items():
+                self.entries[key] = (price, expires)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class MySQLPriceStore:
+    """Reads car_models through a MySQL connection pool, created on first use.
+
+    The pool raises straight away when every connection is in use, so callers wait up to
+    wait_seconds for a free one instead.
+    """
+
+    def __init__(self, db_config, pool_size=5, pool_name="claimswift_prices", wait_seconds=30.0):
+        self.db_config = db_config
+        self.pool_size = pool_size
+        self.pool_name = pool_name
+        self.wait_seconds = wait_seconds
+        self.pool = None
+        self.lock = threading.Lock()
+        self.free_connections = threading.BoundedSemaphore(pool_size)
+
+    def _get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                from mysql.connector import pooling
+                self.pool = pooling.MySQLConnectionPool(
+                    pool_name=self.pool_name, pool_size=self.pool_size, **self.db_config
+                )
+            return self.pool
+
+    def fetch_prices(self, brand, model, parts):
+        """Return {part: price} for the given parts with one query."""
+        import mysql.connector as connector
+
+        placeholders = ", ".join(["%s"] * len(parts))
+        query = f"SELECT part, price FROM car_models WHERE brand = %s AND model = %s AND part IN ({placeholders})"
+        if not self.free_connections.acquire(timeout=self.wait_seconds):
+            raise PriceLookupError(f"No database connection free after {self.wait_seconds:g}s")
+        try:
+            connection = self._get_pool().get_connection()
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(query, (brand, model, *parts))
+                    rows = cursor.fetchall()
+            finally:
+                connection.close()  # hands the connection back to the pool
+        except connector.Error as e:
+            raise PriceLookupError(str(e)) from e
+        finally:
+            self.free_connections.release()
+        return {part: price for part, price in rows}
+
+
+class SQLitePriceStore:
+    """Local stand-in for the MySQL car_models table, for running and testing without MySQL."""
+
+    def __init__(self, db_path=":memory:"):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS car_models (brand TEXT, model TEXT, part TEXT, price REAL)"
+            )
+
+    def add_prices(self, rows):
+        """Insert (brand, model, part, price) rows."""
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT INTO car_models (brand, model, part, price) VALUES (?, ?, ?, ?)", rows)
+
+    def fetch_prices(self, brand, model, parts):
+        """Return {part: price} for the given parts with one query."""
+        placeholders = ", ".join(["?"] * len(parts))
+        query = f"SELECT part, price FROM car_models WHERE brand = ? AND model = ? AND part IN ({placeholders})"
+        try:
+            with self.lock:
+                rows = self.connection.execute(query, (brand, model, *parts)).fetchall()
+        except sqlite3.Error as e:
+            raise PriceLookupError(str(e)) from e
+        return {part: price for part, price in rows}
+
+
+class CachedPriceStore:
+    """Puts a PriceCache in front of a MySQL or SQLite store."""
+
+    def __init__(self, store, cache=None):
+        self.store = store
+        self.cache = cache or PriceCache()
+
+    def get_prices(self, brand, model, parts):
+        """Return {part: price} for every part that has a price; at most one query per call."""
+        parts = list(dict.fromkeys(parts))
+        hits, misses = self.cache.get_many([(brand, model, part) for part in parts])
+
+        if misses:
+            missing_parts = [part for _, _, part in misses]
+            fetched = self.store.fetch_prices(brand, model, missing_parts)
+            found = {(brand, model, part): fetched.get(part) for part in missing_parts}
+            self.cache.put_many(found)
+            hits.update(found)
+
+        return {part: price for (_, _, part), price in hits.items() if price is not None}
+
+
+def create_price_store(db_config):
+    """Pooled, cached MySQL store; set PRICE_DB_PATH to use a SQLite file instead.
+
+    PRICE_DB_POOL_SIZE sets the number of MySQL connections and PRICE_DB_POOL_WAIT how many
+    seconds a lookup waits for one of them.
+    """
+    sqlite_path = os.environ.get("PRICE_DB_PATH")
+    if sqlite_path:
+        store = SQLitePriceStore(sqlite_path)
+    else:
+        store = MySQLPriceStore(db_config, pool_size=int(os.environ.get("PRICE_DB_POOL_SIZE", "5")),
+                                wait_seconds=float(os.environ.get("PRICE_DB_POOL_WAIT", "30")))
+    cache = PriceCache(ttl_seconds=float(os.environ.get("PRICE_CACHE_TTL", "300")))
+    return CachedPriceStore(store, cache)
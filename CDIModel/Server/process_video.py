@@ -1,69 +1,239 @@
+import os
+import inspect
 import cv2
 import numpy as np
 import torch
 from torchvision import models, transforms
 from PIL import Image
 import onnxruntime as ort
+from quantization import int8_path, is_stale, mark_built, quantize_onnx_model, quantize_torch_linear, yolo_blob
+
+
+# COCO class id for "car" in the YOLOv5 export
+CAR_CLASS_ID = 2
+
+
+def non_max_suppression(boxes, scores, iou_threshold):
+    """Greedy NMS over (N, 4) x1y1x2y2 boxes; returns the kept indices, highest score first."""
+    order = scores.argsort()[::-1]
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    keep = []
+    while order.size > 0:
+        best, rest = order[0], order[1:]
+        keep.append(best)
+
+        xx1 = np.maximum(boxes[best, 0], boxes[rest, 0])
+        yy1 = np.maximum(boxes[best, 1], boxes[rest, 1])
+        xx2 = np.minimum(boxes[best, 2], boxes[rest, 2])
+        yy2 = np.minimum(boxes[best, 3], boxes[rest, 3])
+        intersection = np.clip(xx2 - xx1, 0, None) * np.clip(yy2 - yy1, 0, None)
+        iou = intersection / (areas[best] + areas[rest] - intersection + 1e-9)
+
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=int)
 
 
 class YOLOModel:
-    def __init__(self, weights_path):
-        self.session = ort.InferenceSession(weights_path)
+    """YOLOv5 ONNX car detector.
+
+    quantize=True runs an int8 copy of the model, created next to the weights on first use (and
+    again whenever the weights change) and statically calibrated on calibration_dir's images
+    (YOLO has no layers that weight-only quantization would speed up).
+    """
+
+    def __init__(self, weights_path, conf_threshold=0.5, iou_threshold=0.45, input_size=640, intra_op_threads=None,
+                 quantize=False, calibration_dir=None):
+        if quantize:
+            quantized_path = int8_path(weights_path)
+            if is_stale(quantized_path, weights_path):
+                if not calibration_dir:
+                    raise ValueError("Quantizing the YOLO model needs a calibration_dir of sample images")
+                print(f"Quantizing YOLO model to {quantized_path}")
+                quantize_onnx_model(weights_path, quantized_path, calibration_dir,
+                                    lambda image: yolo_blob(image, input_size))
+                mark_built(quantized_path, weights_path)
+            weights_path = quantized_path
+
+        options = ort.SessionOptions()
+        if intra_op_threads:
+            options.intra_op_num_threads = intra_op_threads
+        self.session = ort.InferenceSession(weights_path, options)
         self.input_name = self.session.get_inputs()[0].name
         self.output_name = self.session.get_outputs()[0].name
+        self.conf_threshold = conf_threshold
+        self.iou_threshold = iou_threshold
+        self.input_size = input_size
 
-    def detect_objects(self, frame):
+    def decode_cars(self, predictions, frame_width, frame_height):
+        """Turn the raw (N, 5 + classes) YOLOv5 output into NMS-filtered car boxes.
+
+        Returns an (M, 5) array of x1, y1, x2, y2, confidence in frame pixels, best first.
+        """
+        class_scores = predictions[:, 5:]
+        confidence = predictions[:, 4] * class_scores[:, CAR_CLASS_ID]
+
+        # Keep rows whose top class is "car" and whose objectness * class score clears the threshold
+        mask = (class_scores.argmax(axis=1) == CAR_CLASS_ID) & (confidence > self.conf_threshold)
+        if not mask.any():
+            return np.empty((0, 5), dtype=np.float32)
+        predictions = predictions[mask]
+        confidence = confidence[mask]
+
+        # Boxes are centre/size in input_size x input_size pixels; blobFromImage stretched the frame to that
+        scale = np.array([frame_width / self.input_size, frame_height / self.input_size], dtype=np.float32)
+        centres = predictions[:, 0:2] * scale
+        half_sizes = predictions[:, 2:4] * scale / 2
+        boxes = np.concatenate([centres - half_sizes, centres + half_sizes], axis=1)
+        boxes[:, [0, 2]] = np.clip(boxes[:, [0, 2]], 0, frame_width)
+        boxes[:, [1, 3]] = np.clip(boxes[:, [1, 3]], 0, frame_height)
+
+        valid = (boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])
+        boxes, confidence = boxes[valid], confidence[valid]
+
+        keep = non_max_suppression(boxes, confidence, self.iou_threshold)
+        return np.concatenate([boxes[keep], confidence[keep, None]], axis=1)
+
+    def detect_cars(self, frame):
+        """Return every car in the frame as (x1, y1, x2, y2, confidence), ranked by confidence."""
         h, w = frame.shape[:2]
-        blob = cv2.dnn.blobFromImage(frame, 1 / 255.0, (640, 640), swapRB=True, crop=False)
-        outputs = self.session.run([self.output_name], {self.input_name: blob.astype(np.float32)})[0]
-
-        for detection in outputs[0]:
-            scores = detection[5:]
-            class_id = np.argmax(scores)
-            confidence = scores[class_id]
-            if confidence > 0.5 and class_id == 2:
-                box = detection[:4] * np.array([w, h, w, h])
-                x, y, bw, bh = box.astype("int")
-                x1, y1 = max(0, int(x - bw / 2)), max(0, int(y - bh / 2))
-                x2, y2 = min(w, int(x + bw / 2)), min(h, int(y + bh / 2))
-                print(f"Bounding Box: {(x1, y1, x2, y2)}")
-                return frame[y1:y2, x1:x2], (x1, y1, x2, y2)
-        return None, None
+        outputs = self.session.run([self.output_name], {self.input_name: yolo_blob(frame, self.input_size)})[0]
+
+        cars = self.decode_cars(outputs[0], w, h)
+        return [(int(x1), int(y1), int(x2), int(y2), float(conf)) for x1, y1, x2, y2, conf in cars]
+
+    def detect_objects(self, frame):
+        """Return the crop and box of the most confident car, or (None, None)."""
+        cars = self.detect_cars(frame)
+        if not cars:
+            return None, None
+        x1, y1, x2, y2, _ = cars[0]
+        print(f"Bounding Box: {(x1, y1, x2, y2)}")
+        return frame[y1:y2, x1:x2], (x1, y1, x2, y2)
 
 class VGGModel:
-    def __init__(self, model_path):
-        self.model = models.vgg16(pretrained=False)
-        self.model.classifier[6] = torch.nn.Linear(4096, 3)
-        self.model.load_state_dict(torch.load(model_path, map_location='cpu'))
-        self.model.eval()
+    """VGG16 damage classifier over car crops.
+
+    backend="torch" runs the PyTorch model; backend="onnx" runs an exported copy through
+    onnxruntime with intra_op_threads threads, exporting it next to the weights on first use.
+    quantize=True uses int8 weights for the fully connected layers with either backend. Exports
+    are rebuilt whenever the weights they came from change, so retrained weights take effect.
+    """
 
+    def __init__(self, model_path, backend="torch", onnx_path=None, intra_op_threads=None, quantize=False):
+        self.backend = backend
         self.transform = transforms.Compose([
             transforms.Resize((224, 224)),
             transforms.ToTensor(),
             transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
         ])
 
-    def classify_objects(self, img):
-        img_tensor = self.transform(Image.fromarray(img)).unsqueeze(0)
+        if backend == "torch":
+            self.model = self.load_torch_model(model_path)
+            if quantize:
+                self.model = quantize_torch_linear(self.model)
+        elif backend == "onnx":
+            onnx_path = onnx_path or os.path.splitext(model_path)[0] + ".onnx"
+            if is_stale(onnx_path, model_path):
+                print(f"Exporting VGG model to {onnx_path}")
+                export_vgg_onnx(self.load_torch_model(model_path), onnx_path)
+                mark_built(onnx_path, model_path)
+            if quantize:
+                fp32_path, onnx_path = onnx_path, int8_path(onnx_path)
+                if is_stale(onnx_path, fp32_path):
+                    print(f"Quantizing VGG model to {onnx_path}")
+                    quantize_onnx_model(fp32_path, onnx_path)
+                    mark_built(onnx_path, fp32_path)
+
+            options = ort.SessionOptions()
+            if intra_op_threads:
+                options.intra_op_num_threads = intra_op_threads
+            self.session = ort.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+            self.input_name = self.session.get_inputs()[0].name
+        else:
+            raise ValueError(f"Unknown VGG backend: {backend}")
+
+    @staticmethod
+    def load_torch_model(model_path):
+        model = models.vgg16(pretrained=False)
+        model.classifier[6] = torch.nn.Linear(4096, 3)
+        model.load_state_dict(torch.load(model_path, map_location='cpu'))
+        model.eval()
+        return model
+
+    def preprocess(self, imgs):
+        """Stack a list of crops into one (N, 3, 224, 224) tensor."""
+        return torch.stack([self.transform(Image.fromarray(img)) for img in imgs])
+
+    def predict_logits(self, imgs):
+        """Return the (N, 3) class logits for a list of crops as a NumPy array."""
+        batch = self.preprocess(imgs)
+        if self.backend == "onnx":
+            return self.session.run(None, {self.input_name: batch.numpy()})[0]
         with torch.no_grad():
-            outputs = self.model(img_tensor)
-            _, preds = torch.max(outputs, 1)
-        print(preds)
-        return preds.item()
+            return self.model(batch).numpy()
+
+    def classify_batch(self, imgs):
+        """Classify a list of crops in one forward pass; returns one class index per crop."""
+        return [pred for pred, _ in self.classify_with_confidence(imgs)]
+
+    def classify_with_confidence(self, imgs):
+        """Classify a list of crops in one forward pass; returns (class index, softmax probability) per crop."""
+        if not imgs:
+            return []
+        logits = self.predict_logits(imgs)
+        exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+        probs = exp / exp.sum(axis=1, keepdims=True)
+        preds = probs.argmax(axis=1)
+        return [(int(pred), float(probs[n, pred])) for n, pred in enumerate(preds)]
+
+    def classify_objects(self, img):
+        return self.classify_batch([img])[0]
+
+
+def export_vgg_onnx(model, onnx_path):
+    """Export the PyTorch classifier to ONNX with a dynamic batch dimension."""
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        kwargs["dynamo"] = False  # the TorchScript exporter needs no extra packages
+    torch.onnx.export(
+        model, torch.zeros(1, 3, 224, 224), onnx_path,
+        input_names=["input"], output_names=["logits"],
+        dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}},
+        opset_version=13, **kwargs
+    )
+
+
+def analyze_cars(frame, yolo_model, vgg_model):
+    """Detect every car and classify all of their crops in one batch.
+
+    Returns a list of dicts with the car's box, YOLO confidence, VGG class and VGG
+    probability, most confident car first.
+    """
+    cars = yolo_model.detect_cars(frame)
+    crops = [frame[y1:y2, x1:x2] for x1, y1, x2, y2, _ in cars]
+    classes = vgg_model.classify_with_confidence(crops)
+    return [
+        {"box": (x1, y1, x2, y2), "confidence": conf, "class": cls, "class_confidence": cls_conf}
+        for (x1, y1, x2, y2, conf), (cls, cls_conf) in zip(cars, classes)
+    ]
+
+def draw_cars(frame, cars):
+    """Outline every car with its VGG class; the primary car gets a thicker box."""
+    for n, car in enumerate(cars):
+        x1, y1, x2, y2 = car["box"]
+        thickness = 2 if n == 0 else 1
+        cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), thickness)
+        cv2.putText(frame, f"{car['class']}", (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), thickness)
+    return frame
+
 def process_frame(frame, yolo_model, vgg_model):
-    car_roi, bbox = yolo_model.detect_objects(frame)
-    if car_roi is None:
+    cars = analyze_cars(frame, yolo_model, vgg_model)
+    if not cars:
         print("No car detected.")
         return frame, "No car detected"
 
-    classified_obj = vgg_model.classify_objects(car_roi)
-    label = f"{classified_obj}"
+    # The most confident car provides the frame label
+    label = f"{cars[0]['class']}"
+    draw_cars(frame, cars)
 
-    # Check if bbox is valid
-    if bbox:
-        cv2.rectangle(frame, (bbox[0], bbox[1]), (bbox[2], bbox[3]), (0, 255, 0), 2)
-        cv2.putText(frame, label, (bbox[0], bbox[1] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
-    else:
-        print("No bounding box detected.")
-    
     return frame, label
\ No newline at end of file
@@ -0,0 +1,99 @@
+import glob
+import os
+
+import cv2
+import numpy as np
+import torch
+
+
+def int8_path(fp32_path):
+    """Where the int8 copy of an ONNX model lives: next to it, as <name>.int8.onnx."""
+    return os.path.splitext(fp32_path)[0] + ".int8.onnx"
+
+
+def source_stamp(source_path):
+    """Size and mtime of a model file, the same fingerprint result_cache.model_version uses."""
+    stat = os.stat(source_path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def is_stale(derived_path, source_path):
+    """True if derived_path (an export or int8 copy) is missing or wasn't made from source_path as it is now.
+
+    The source's stamp is recorded next to the copy as <derived_path>.source by mark_built(), so
+    replaced weights are noticed even when their mtime is older than the copy's.
+    """
+    try:
+        with open(derived_path + ".source") as f:
+            recorded = f.read().strip()
+    except OSError:
+        return True
+    return not os.path.exists(derived_path) or recorded != source_stamp(source_path)
+
+
+def mark_built(derived_path, source_path):
+    """Record which version of source_path derived_path was made from."""
+    with open(derived_path + ".source", "w") as f:
+        f.write(source_stamp(source_path))
+
+
+def quantize_torch_linear(model):
+    """Dynamic int8 quantization of every nn.Linear in a PyTorch model, for CPU inference.
+
+    Weights are stored as int8 and activations are quantized on the fly, so no calibration data
+    is needed. In VGG16 the Linear layers hold about 90% of the weights; in Mask R-CNN they are
+    the box head's fully connected layers, while the convolutional backbone stays fp32.
+    """
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class ImageFolderCalibration:
+    """onnxruntime CalibrationDataReader feeding preprocessed images from a folder."""
+
+    def __init__(self, input_name, images_dir, preprocess, limit=32):
+        self.input_name = input_name
+        self.paths = sorted(glob.glob(os.path.join(images_dir, "*.jpg")))[:limit]
+        self.preprocess = preprocess
+        self.position = 0
+
+    def get_next(self):
+        while self.position < len(self.paths):
+            image = cv2.imread(self.paths[self.position])
+            self.position += 1
+            if image is not None:
+                return {self.input_name: self.preprocess(image)}
+        return None
+
+    def rewind(self):
+        self.position = 0
+
+
+def quantize_onnx_model(fp32_path, output_path=None, calibration_dir=None, preprocess=None):
+    """Write an int8 copy of an ONNX model and return its path.
+
+    With calibration_dir (and the model's preprocess function) the model is statically quantized
+    in QDQ format from those images, which suits convolutional models like YOLOv5; without it
+    the MatMul/Gemm weights are quantized (dynamic quantization), which suits the classifier.
+    """
+    from onnxruntime.quantization import CalibrationMethod, QuantFormat, QuantType, quantize_dynamic, quantize_static
+    import onnxruntime as ort
+
+    output_path = output_path or int8_path(fp32_path)
+    if calibration_dir:
+        input_name = ort.InferenceSession(fp32_path, providers=["CPUExecutionProvider"]).get_inputs()[0].name
+        reader = ImageFolderCalibration(input_name, calibration_dir, preprocess)
+        if not reader.paths:
+            raise ValueError(f"No calibration images in {calibration_dir}")
+        quantize_static(fp32_path, output_path, reader, quant_format=QuantFormat.QDQ,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                        calibrate_method=CalibrationMethod.MinMax)
+    else:
+        # ConvInteger is slower than fp32 Conv on most CPUs, so only the fully connected layers are quantized
+        quantize_dynamic(fp32_path, output_path, weight_type=QuantType.QInt8, op_types_to_quantize=["MatMul", "Gemm"])
+    return output_path
+
+
+def yolo_blob(image, input_size=640):
+    """The blob YOLOModel.detect_cars feeds the network, for calibration."""
+    blob = cv2.dnn.blobFromImage(image, 1 / 255.0, (input_size, input_size), swapRB=True, crop=False)
+    return blob.astype(np.float32)
@@ -0,0 +1,149 @@
+"""Compare fp32 and int8 inference: latency and detection quality for each model.
+
+VGG: class agreement and probability drift between fp32 and int8 on car-like crops.
+YOLO: car box agreement (IoU >= 0.5) between fp32 and int8.
+Damage detector: COCO box mAP of fp32 and int8 against the validation annotations.
+
+Models whose weights aren't given are skipped. Results are printed and, with --output,
+written as JSON.
+
+Usage:
+    python quantization_report.py --vgg-weights ../vgg/vgg_damage_model.pth \\
+        --yolo-weights ../yolo/yolov5s.onnx \\
+        --damage-config ../V_MODELS/damage/config_detectron.yaml \\
+        --damage-weights ../V_MODELS/damage/detectron_model.pth --output int8_report.json
+    python quantization_report.py --random-vgg   # smoke test without the trained weights
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import cv2
+import numpy as np
+import torch
+from torchvision import models
+
+from benchmark import latency_summary, time_calls
+from damage_tracker import box_iou
+from evaluation import CocoGroundTruth, coco_map, instances_to_predictions
+from process_video import VGGModel, YOLOModel
+from vgg_onnx_parity import load_crops
+
+
+def compare_vgg(weights, crops, threads):
+    fp32 = VGGModel(weights, intra_op_threads=threads)
+    int8 = VGGModel(weights, intra_op_threads=threads, quantize=True)
+    fp32_out, fp32_ms = time_calls(lambda crop: fp32.classify_with_confidence([crop])[0], crops)
+    int8_out, int8_ms = time_calls(lambda crop: int8.classify_with_confidence([crop])[0], crops)
+    return {
+        "fp32": latency_summary(fp32_ms),
+        "int8": latency_summary(int8_ms),
+        "class_agreement": float(np.mean([a[0] == b[0] for a, b in zip(fp32_out, int8_out)])),
+        "max_probability_drift": float(max(abs(a[1] - b[1]) for a, b in zip(fp32_out, int8_out))),
+    }
+
+
+def compare_yolo(weights, images, calibration_dir, workdir):
+    # Quantize a copy so the int8 file doesn't land next to the production weights
+    local_weights = os.path.join(workdir, os.path.basename(weights))
+    shutil.copy(weights, local_weights)
+    fp32 = YOLOModel(local_weights)
+    int8 = YOLOModel(local_weights, quantize=True, calibration_dir=calibration_dir)
+    fp32_out, fp32_ms = time_calls(fp32.detect_cars, images)
+    int8_out, int8_ms = time_calls(int8.detect_cars, images)
+
+    matched, total = 0, 0
+    for a, b in zip(fp32_out, int8_out):
+        total += len(a)
+        if a and b:
+            iou = box_iou([car[:4] for car in a], [car[:4] for car in b])
+            matched += int((iou.max(axis=1) >= 0.5).sum())
+    return {
+        "fp32": latency_summary(fp32_ms),
+        "int8": latency_summary(int8_ms),
+        "fp32_cars": total,
+        "int8_cars": sum(len(b) for b in int8_out),
+        "box_agreement": matched / total if total else None,
+    }
+
+
+def compare_damage(config, weights, annotations):
+    from detectron2.config import get_cfg
+    from batch_predictor import BatchPredictor
+
+    cfg = get_cfg()
+    cfg.merge_from_file(config)
+    cfg.MODEL.WEIGHTS = weights
+    cfg.MODEL.DEVICE = "cpu"
+
+    ground_truth = CocoGroundTruth(annotations)
+    names, images = zip(*[(name, cv2.imread(path)) for name, path in ground_truth.image_paths()])
+    category_map = {0: min(ground_truth.categories)}  # the damage model has a single class
+
+    report = {}
+    for mode, quantize in (("fp32", False), ("int8", True)):
+        predictor = BatchPredictor(cfg, batch_size=1, quantize=quantize)
+        outputs, latencies = time_calls(predictor, list(images))
+        predictions = {name: instances_to_predictions(out["instances"], category_map)
+                       for name, out in zip(names, outputs)}
+        quality = coco_map(ground_truth, predictions)
+        report[mode] = dict(latency_summary(latencies), mAP=quality["mAP"], AP50=quality["AP50"], AP75=quality["AP75"])
+    return report
+
+
+def main():
+    data_dir = os.path.join("..", "data")
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vgg-weights", help="Path to vgg_damage_model.pth")
+    parser.add_argument("--random-vgg", action="store_true", help="Use a randomly initialised VGG")
+    parser.add_argument("--yolo-weights", help="Path to yolov5s.onnx")
+    parser.add_argument("--damage-config", help="Detectron2 damage config (config_detectron.yaml)")
+    parser.add_argument("--damage-weights", help="Detectron2 damage weights (detectron_model.pth)")
+    parser.add_argument("--images", default=os.path.join(data_dir, "val"))
+    parser.add_argument("--annotations", default=os.path.join(data_dir, "val", "COCO_val_annos.json"))
+    parser.add_argument("--calibration", default=os.path.join(data_dir, "img"), help="Images for YOLO calibration")
+    parser.add_argument("--limit", type=int, default=32)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--output", help="Write the report as JSON here")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    workdir = tempfile.mkdtemp(prefix="int8_report_")
+    report = {"images": args.images}
+
+    vgg_weights = args.vgg_weights
+    if vgg_weights is None and args.random_vgg:
+        model = models.vgg16(pretrained=False)
+        model.classifier[6] = torch.nn.Linear(4096, 3)
+        vgg_weights = os.path.join(workdir, "vgg_random.pth")
+        torch.save(model.state_dict(), vgg_weights)
+    if vgg_weights:
+        crops = load_crops(args.images, args.limit)
+        if not crops:
+            print(f"No images found in {args.images}")
+            return 1
+        report["vgg"] = compare_vgg(vgg_weights, crops, args.threads)
+
+    if args.yolo_weights:
+        images = [cv2.imread(path) for _, path in CocoGroundTruth(args.annotations).image_paths()][:args.limit]
+        report["yolo"] = compare_yolo(args.yolo_weights, images, args.calibration, workdir)
+
+    if args.damage_config and args.damage_weights:
+        report["damage"] = compare_damage(args.damage_config, args.damage_weights, args.annotations)
+
+    if len(report) == 1:
+        parser.error("give at least one of --vgg-weights/--random-vgg, --yolo-weights, --damage-config/--damage-weights")
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """sha256 of a file's contents, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def bytes_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def model_version(*weights_paths):
+    """Short id for a set of model weights; changes whenever a weights file is replaced.
+
+    MODEL_VERSION overrides it, e.g. to share a disk cache between machines with the same models.
+    """
+    override = os.environ.get('MODEL_VERSION')
+    if override:
+        return override
+    digest = hashlib.sha256()
+    for path in weights_paths:
+        digest.update(str(path).encode())
+        if os.path.exists(path):
+            stat = os.stat(path)
+            digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()[:16]
+
+
+def cache_key(content_digest, version, **options):
+    """Key for a result: the upload's hash, the model version and any options that change the output."""
+    parts = [content_digest, version] + [f"{name}={options[name]}" for name in sorted(options)]
+    return hashlib.sha256("|".join(parts).encode()).hexdigest()
+
+
+class ResultCache:
+    """LRU cache of JSON-serialisable inference results, capped by total size.
+
+    Entries live in memory up to max_bytes. With disk_dir set, every entry is also written there
+    as <key>.json, so results survive restarts and memory evictions; the directory is trimmed
+    oldest-first to max_disk_bytes.
+    """
+
+    def __init__(self, max_bytes=256 << 20, disk_dir=None, max_disk_bytes=2 << 30):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()  # key -> (value, size)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def get(self, key):
+        """Cached value for key, or None."""
+        if key is None:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+        value = self._read_disk(key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self._put_memory(key, value, len(json.dumps(value)))
+        return value
+
+    def put(self, key, value):
+        if key is None:
+            return
+        data = json.dumps(value)
+        self._put_memory(key, value, len(data))
+        self._write_disk(key, data)
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.total_bytes, "hits": self.hits, "misses": self.misses}
+
+    def _put_memory(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+            self.entries[key] = (value, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path) as f:
+                value = json.load(f)
+            os.utime(path)  # mark as recently used for trimming
+            return value
+        except (OSError, ValueError):
+            return None
+
+    def _write_disk(self, key, data):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(data)
+            os.replace(tmp_path, path)  # readers never see a half-written entry
+            self._trim_disk()
+        except OSError as e:
+            print(f"Could not write result cache entry: {e}")
+
+    def _trim_disk(self):
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.disk_dir, name))
+            except OSError:
+                continue  # removed by another worker in the meantime
+            files.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.disk_dir, name))
+                total -= size
+            except OSError:
+                pass
+
+
+def create_result_cache(name):
+    """Cache configured from RESULT_CACHE_MB, RESULT_CACHE_DIR (enables the disk tier, one
+    subdirectory per name) and RESULT_CACHE_DISK_MB; RESULT_CACHE_MB=0 without a directory turns caching off."""
+    max_mb = float(os.environ.get('RESULT_CACHE_MB', '256'))
+    disk_root = os.environ.get('RESULT_CACHE_DIR')
+    return ResultCache(
+        max_bytes=int(max_mb * (1 << 20)),
+        disk_dir=os.path.join(disk_root, name) if disk_root else None,
+        max_disk_bytes=int(float(os.environ.get('RESULT_CACHE_DISK_MB', '2048')) * (1 << 20)),
+    )
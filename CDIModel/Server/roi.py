@@ -0,0 +1,73 @@
+import numpy as np
+import torch
+from detectron2.structures import Boxes, Instances
+
+
+def pad_box(box, frame_shape, padding=0.1):
+    """Grow (x1, y1, x2, y2) by padding times its size on every side, clipped to the frame."""
+    h, w = frame_shape[:2]
+    x1, y1, x2, y2 = box
+    pad_x, pad_y = (x2 - x1) * padding, (y2 - y1) * padding
+    return (max(int(x1 - pad_x), 0), max(int(y1 - pad_y), 0),
+            min(int(x2 + pad_x), w), min(int(y2 + pad_y), h))
+
+
+def adaptive_min_size(crop_shape, max_min_size=800, min_min_size=320, step=32):
+    """Input short edge for a crop: its own short edge, kept within [min_min_size, max_min_size].
+
+    A car that fills only part of the frame is no longer blown up to the config's full size, so
+    the forward pass sees far fewer pixels; tiny crops are still upscaled enough to resolve dents.
+    """
+    short_edge = min(crop_shape[:2])
+    size = min(max(short_edge, min_min_size), max_min_size)
+    return max(step, int(round(size / step)) * step)
+
+
+def to_frame_coordinates(instances, offset, frame_shape):
+    """Map instances predicted on a crop back onto the full frame."""
+    x1, y1 = offset
+    h, w = frame_shape[:2]
+    crop_h, crop_w = instances.image_size
+
+    result = Instances((h, w))
+    result.scores = instances.scores
+    result.pred_classes = instances.pred_classes
+
+    boxes = instances.pred_boxes.tensor.clone()
+    boxes[:, 0::2] += x1
+    boxes[:, 1::2] += y1
+    result.pred_boxes = Boxes(boxes)
+
+    if instances.has("pred_masks"):
+        masks = torch.zeros((len(instances), h, w), dtype=instances.pred_masks.dtype, device=instances.pred_masks.device)
+        masks[:, y1:y1 + crop_h, x1:x1 + crop_w] = instances.pred_masks
+        result.pred_masks = masks
+    return result
+
+
+def predict_rois(predictor, frames, car_boxes, padding=0.1, min_min_size=320):
+    """Run a BatchPredictor on the padded car crop of each frame at a size picked from the crop.
+
+    Frames whose car box is None go through at full size. Returns one {"instances": Instances}
+    dict per frame, in full-frame coordinates, like predict_batch.
+    """
+    crops, offsets, min_sizes = [], [], []
+    for frame, box in zip(frames, car_boxes):
+        if box is not None:
+            x1, y1, x2, y2 = pad_box(box, frame.shape, padding)
+        if box is None or x2 <= x1 or y2 <= y1:
+            crops.append(frame)
+            offsets.append(None)
+            min_sizes.append(None)
+            continue
+        crop = np.ascontiguousarray(frame[y1:y2, x1:x2])
+        crops.append(crop)
+        offsets.append((x1, y1))
+        min_sizes.append(adaptive_min_size(crop.shape, predictor.cfg.INPUT.MIN_SIZE_TEST, min_min_size))
+
+    results = []
+    for frame, offset, output in zip(frames, offsets, predictor.predict_batch(crops, min_sizes)):
+        if offset is not None:
+            output = {"instances": to_frame_coordinates(output["instances"], offset, frame.shape)}
+        results.append(output)
+    return results
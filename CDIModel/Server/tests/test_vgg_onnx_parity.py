@@ -0,0 +1,19 @@
+"""The ONNX export of the VGG classifier must agree with PyTorch (see vgg_onnx_parity.py)."""
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from vgg_onnx_parity import compare_backends, random_vgg_weights
+
+
+def test_onnx_backend_matches_torch(tmp_path):
+    weights = random_vgg_weights(str(tmp_path / "vgg_random.pth"))
+    rng = np.random.default_rng(0)
+    crops = [rng.integers(0, 256, size=(h, w, 3), dtype=np.uint8) for h, w in ((180, 320), (240, 240), (300, 160))]
+
+    max_diff, mismatches, _, _ = compare_backends(weights, crops, str(tmp_path))
+
+    assert mismatches == 0
+    assert max_diff <= 1e-3
@@ -0,0 +1,158 @@
+import json
+import os
+import threading
+import time
+import uuid
+
+from werkzeug.utils import secure_filename
+
+UPLOAD_ID_LENGTH = 32
+
+
+class UploadOffsetError(ValueError):
+    """A chunk didn't start where the upload left off; the client should resume from `offset`."""
+
+    def __init__(self, offset):
+        super().__init__(f"Chunk must start at offset {offset}")
+        self.offset = offset
+
+
+class Upload:
+    """One resumable upload: a per-upload file plus its progress, persisted next to it as JSON.
+
+    Readers can wait() for more bytes while the upload is still arriving.
+    """
+
+    def __init__(self, folder, upload_id, filename, size=None, received=0, complete=False):
+        self.upload_id = upload_id
+        self.filename = filename
+        self.size = size
+        self.received = received
+        self.complete = complete
+        self.path = os.path.join(folder, f"{upload_id}_{filename}")
+        self.meta_path = os.path.join(folder, f"{upload_id}.json")
+        self.changed = threading.Condition()
+
+    def status(self):
+        return {"upload_id": self.upload_id, "filename": self.filename, "size": self.size,
+                "offset": self.received, "complete": self.complete}
+
+    def append(self, offset, data, final=False):
+        """Write a chunk at offset, which must be the number of bytes received so far.
+
+        A repeated chunk that was already written in full is accepted without writing it
+        again, so a client can retry after a lost response. The upload completes when final is
+        set or the declared size is reached.
+        """
+        with self.changed:
+            if self.complete:
+                raise UploadOffsetError(self.received)
+            if offset + len(data) <= self.received and offset < self.received:
+                return self.status()  # retry of a chunk we already have
+            if offset != self.received:
+                raise UploadOffsetError(self.received)
+            if self.size is not None and offset + len(data) > self.size:
+                raise ValueError(f"Chunk goes past the declared size of {self.size} bytes")
+
+            with open(self.path, 'r+b' if os.path.exists(self.path) else 'wb') as f:
+                f.seek(offset)
+                f.write(data)
+                f.truncate()
+            self.received = offset + len(data)
+            self.complete = final or (self.size is not None and self.received >= self.size)
+            self.save_meta()
+            self.changed.notify_all()
+            return self.status()
+
+    def wait(self, received, timeout=None):
+        """Block until more than `received` bytes have arrived, the upload completes, or timeout."""
+        with self.changed:
+            self.changed.wait_for(lambda: self.received > received or self.complete, timeout)
+            return self.received, self.complete
+
+    def remove(self):
+        """Delete the upload's file and progress; readers still waiting see it as complete."""
+        with self.changed:
+            self.complete = True
+            self.changed.notify_all()
+        for path in (self.path, self.meta_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Could not remove {path}: {e}")
+
+    def save_meta(self):
+        tmp_path = f"{self.meta_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"filename": self.filename, "size": self.size, "received": self.received,
+                       "complete": self.complete}, f)
+        os.replace(tmp_path, self.meta_path)
+
+
+class UploadStore:
+    """Resumable uploads under one folder, each written to its own file.
+
+    Progress is kept in <upload_id>.json so an interrupted upload can resume after a restart.
+    Waiting for new bytes only works within one process. Uploads are removed with delete(),
+    or by expire() once nothing has been written to them for ttl_seconds.
+    """
+
+    def __init__(self, folder, ttl_seconds=24 * 3600):
+        self.folder = folder
+        self.ttl_seconds = ttl_seconds
+        self.uploads = {}
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def create(self, filename, size=None):
+        if size is not None and size <= 0:
+            raise ValueError("size must be positive")
+        self.expire()
+        upload = Upload(self.folder, uuid.uuid4().hex, secure_filename(filename or '') or 'video.mp4', size)
+        open(upload.path, 'wb').close()
+        upload.save_meta()
+        with self.lock:
+            self.uploads[upload.upload_id] = upload
+        return upload
+
+    def get(self, upload_id):
+        """The upload, reloaded from disk if this process hasn't seen it; None if unknown."""
+        if len(upload_id) != UPLOAD_ID_LENGTH or not all(c in "0123456789abcdef" for c in upload_id):
+            return None
+        with self.lock:
+            upload = self.uploads.get(upload_id)
+            if upload is None:
+                try:
+                    with open(os.path.join(self.folder, f"{upload_id}.json")) as f:
+                        meta = json.load(f)
+                except (OSError, ValueError):
+                    return None
+                upload = self.uploads[upload_id] = Upload(self.folder, upload_id, **meta)
+            return upload
+
+    def delete(self, upload_id):
+        """Remove an upload's file, progress and in-memory state; False if it is unknown."""
+        upload = self.get(upload_id)
+        if upload is None:
+            return False
+        with self.lock:
+            self.uploads.pop(upload_id, None)
+        upload.remove()
+        return True
+
+    def expire(self):
+        """Delete uploads, complete or not, whose progress hasn't changed for ttl_seconds."""
+        cutoff = time.time() - self.ttl_seconds
+        for name in os.listdir(self.folder):
+            upload_id, extension = os.path.splitext(name)
+            if extension != ".json" or len(upload_id) != UPLOAD_ID_LENGTH:
+                continue
+            try:
+                if os.path.getmtime(os.path.join(self.folder, name)) >= cutoff:
+                    continue
+            except OSError:
+                continue  # deleted in the meantime
+            print(f"Removing upload {upload_id}, untouched for {self.ttl_seconds:g}s")
+            self.delete(upload_id)
@@ -0,0 +1,100 @@
+"""Check that the ONNX Runtime VGG backend matches the PyTorch one.
+
+Exports the classifier, runs both backends on crops from a folder of images and fails
+(exit code 1) if any prediction differs or the logits drift beyond --atol. The same check
+runs with random weights and synthetic crops in tests/test_vgg_onnx_parity.py.
+
+Usage:
+    python vgg_onnx_parity.py --weights ../vgg/vgg_damage_model.pth --images ../data/img
+    python vgg_onnx_parity.py --random-weights   # smoke test without the trained weights
+"""
+import argparse
+import glob
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import torch
+from torchvision import models
+
+from process_video import VGGModel
+
+
+def load_crops(images_dir, limit):
+    """Read up to limit images and take a centre crop of each, like a car ROI would be."""
+    crops = []
+    for path in sorted(glob.glob(os.path.join(images_dir, "*.jpg")))[:limit]:
+        image = cv2.imread(path)
+        if image is None:
+            continue
+        h, w = image.shape[:2]
+        crops.append(image[h // 8: h - h // 8, w // 8: w - w // 8])
+    return crops
+
+
+def random_vgg_weights(path):
+    """Save a randomly initialised damage classifier to path, for checks without the trained weights."""
+    model = models.vgg16(pretrained=False)
+    model.classifier[6] = torch.nn.Linear(4096, 3)
+    torch.save(model.state_dict(), path)
+    return path
+
+
+def compare_backends(weights, crops, workdir, threads=None):
+    """Run both backends on the crops; returns (max |logit diff|, prediction mismatches, torch s, onnx s)."""
+    torch_model = VGGModel(weights)
+    onnx_model = VGGModel(weights, backend="onnx", onnx_path=os.path.join(workdir, "vgg.onnx"),
+                          intra_op_threads=threads)
+
+    start = time.perf_counter()
+    torch_logits = torch_model.predict_logits(crops)
+    torch_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    onnx_logits = onnx_model.predict_logits(crops)
+    onnx_time = time.perf_counter() - start
+
+    max_diff = float(np.abs(torch_logits - onnx_logits).max())
+    mismatches = int((torch_logits.argmax(axis=1) != onnx_logits.argmax(axis=1)).sum())
+    return max_diff, mismatches, torch_time, onnx_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--weights", help="Path to vgg_damage_model.pth")
+    parser.add_argument("--random-weights", action="store_true", help="Use a randomly initialised model")
+    parser.add_argument("--images", default=os.path.join("..", "data", "img"))
+    parser.add_argument("--limit", type=int, default=16)
+    parser.add_argument("--threads", type=int, default=None, help="onnxruntime intra-op threads")
+    parser.add_argument("--atol", type=float, default=1e-3)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="vgg_parity_")
+    weights = args.weights
+    if weights is None:
+        if not args.random_weights:
+            parser.error("pass --weights or --random-weights")
+        weights = random_vgg_weights(os.path.join(workdir, "vgg_random.pth"))
+
+    crops = load_crops(args.images, args.limit)
+    if not crops:
+        print(f"No images found in {args.images}")
+        return 1
+
+    max_diff, mismatches, torch_time, onnx_time = compare_backends(weights, crops, workdir, args.threads)
+
+    print(f"{len(crops)} crops: torch {torch_time:.3f}s, onnxruntime {onnx_time:.3f}s")
+    print(f"max |logit diff| = {max_diff:.2e}, prediction mismatches = {mismatches}")
+
+    if mismatches or max_diff > args.atol:
+        print("FAIL: ONNX backend does not match PyTorch")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,18 +1,37 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS  # Import CORS
 import os
+import sys
 from ultralytics import YOLO
 from collections import Counter
-import mysql.connector as connector
 from werkzeug.utils import secure_filename
 
+# Shared helpers live next to the video server
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Server'))
+from price_store import create_price_store, PriceLookupError
+from result_cache import create_result_cache, bytes_digest, cache_key, model_version
+from artifacts import ArtifactStore
+import metrics
+from metrics import stage_timer
+
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
+metrics.init_app(app)  # /metrics and per-request trace ids
 
 # Load YOLO model
 model_path = r"D:\CarInsuranceClaim\CDIModel\flask_server\models\model weights\best.pt"
 model = YOLO(model_path)
 
+# Detections per uploaded image, keyed by the image's hash and the weights they came from
+result_cache = create_result_cache('detect_damage')
+detector_version = model_version(model_path)
+
+# Each distinct photo gets a directory under static/images/ with the upload and its annotated copies;
+# the least recently used ones are dropped once they take more than IMAGE_STORE_MB
+static_folder = 'static'
+image_store = ArtifactStore(os.path.join(static_folder, 'images'),
+                            max_bytes=int(float(os.environ.get('IMAGE_STORE_MB', '512')) * (1 << 20)))
+
 # Database configuration
 db_config = {
     'host': 'localhost',
@@ -21,13 +40,8 @@ db_config = {
     'database' : 'vehicle_damage_detection'
 }
 
-def connect_to_db():
-    try:
-        connection = connector.connect(**db_config)
-        return connection
-    except connector.Error as e:
-        print(f"Error connecting to database: {e}")
-        return None
+# Pooled, cached price lookups (PRICE_DB_PATH switches to a local SQLite copy)
+price_store = create_price_store(db_config)
 
 @app.route('/detect_damage', methods=['POST'])
 def detect_damage():
@@ -44,52 +58,72 @@ def detect_damage():
     if not car_name or not car_model:
         return jsonify({'error': 'Car name and model are required.'}), 400
 
-    # Save the uploaded image
-    image_path = os.path.join('static', 'uploaded_image.jpg')
-    file.save(image_path)
+    # Store the uploaded image under its content hash, so re-submitting a photo doesn't add a copy
+    image_bytes = file.read()
+    digest = bytes_digest(image_bytes)
+    image_id = digest[:32]
+    image_dir = image_store.job_dir(image_id)
+    original_image = f'images/{image_id}/original.jpg'
+    original_path = os.path.join(image_dir, 'original.jpg')
+    if not image_store.has_job(image_id) or not os.path.exists(original_path):
+        image_store.save(image_id, 'original.jpg', image_bytes)
+
+    # Re-submitting the same photo (e.g. with another car_model) reuses its detections
+    key = cache_key(digest, detector_version)
+    detections = result_cache.get(key)
+    if detections is not None and not os.path.exists(os.path.join(static_folder, detections['detected_image'])):
+        detections = None  # trimmed from the image store
 
-    # Make predictions using YOLO
-    result = model(image_path)
-    detected_objects = result[0].boxes
-    class_ids = [box.cls.item() for box in detected_objects]
-    class_counts = Counter(class_ids)
+    if detections is None:
+        # Make predictions using YOLO
+        with stage_timer("detect_parts"):
+            result = model(original_path)
+        detected_objects = result[0].boxes
 
-    # Save the image with detections
-    detected_image_path = os.path.join('static', 'detected_image.jpg')
-    result[0].save(detected_image_path)
+        # Save the image with detections next to the upload; named after the cache key so hits can serve it again
+        detected_name = f'detected_{key[:16]}.jpg'
+        detections = {
+            'class_ids': [box.cls.item() for box in detected_objects],
+            'detected_image': f'images/{image_id}/{detected_name}'
+        }
+        with stage_timer("render"):
+            result[0].save(os.path.join(image_dir, detected_name))
+        result_cache.put(key, detections)
+        image_store.trim()
+
+    class_counts = Counter(detections['class_ids'])
 
     # Fetch part prices from the database
-    part_prices = get_part_prices(car_name, car_model, class_counts)
+    with stage_timer("pricing"):
+        part_prices = get_part_prices(car_name, car_model, class_counts)
 
     return jsonify({
-        'original_image': 'uploaded_image.jpg',
-        'detected_image': 'detected_image.jpg',
+        'original_image': original_image,
+        'detected_image': detections['detected_image'],
         'part_prices': part_prices
     })
 
 def get_part_prices(car_name, car_model, class_counts):
-    connection = connect_to_db()
-    if connection:
-        try:
-            with connection.cursor(dictionary=True) as cursor:
-                prices = {}
-                for class_id, count in class_counts.items():
-                    part_name = get_part_name_from_id(class_id)
-                    if part_name:
-                        cursor.execute(
-                            "SELECT price FROM car_models WHERE brand = %s AND model = %s AND part = %s",
-                            (car_name, car_model, part_name)
-                        )
-                        price_data = cursor.fetchone()
-                        if price_data:
-                            price_per_part = price_data['price']
-                            total_price = price_per_part * count
-                            prices[part_name] = {'price': price_per_part, 'total': total_price}
-                return prices
-        except connector.Error as e:
-            print(f"Error executing query: {e}")
-            return {}
-    return {}
+    part_counts = {}
+    for class_id, count in class_counts.items():
+        part_name = get_part_name_from_id(class_id)
+        if part_name:
+            part_counts[part_name] = count
+
+    try:
+        # One query for every detected part instead of one per part
+        price_table = price_store.get_prices(car_name, car_model, list(part_counts))
+    except PriceLookupError as e:
+        print(f"Error executing query: {e}")
+        return {}
+
+    prices = {}
+    for part_name, count in part_counts.items():
+        if part_name in price_table:
+            price_per_part = price_table[part_name]
+            total_price = price_per_part * count
+            prices[part_name] = {'price': price_per_part, 'total': total_price}
+    return prices
 
 def get_part_name_from_id(class_id):
     class_names = ['Bonnet', 'Bumper', 'Dickey', 'Door', 'Fender', 'Light', 'Windshield']
@@ -156,15 +156,28 @@ const Claim = () => {
       formData.append("car_model", carModel);
       formData.append("car_number", carNumber);
       setLoading(true);
-      const response = await axios.post("http://10.100.2.239:5000/upload_video",
+      const serverUrl = "http://10.100.2.239:5000";
+      const upload = await axios.post(`${serverUrl}/upload_video`,
         formData, {  headers: { "Content-Type": "multipart/form-data",},} );
-      if (response.data.message) {
-        setMessage(response.data.message);
+
+      // The server queues the video and returns a job id; poll until the job finishes
+      let job = upload.data;
+      while (job.status === "queued" || job.status === "running") {
+        await new Promise((resolve) => setTimeout(resolve, 2000));
+        job = (await axios.get(`${serverUrl}/jobs/${upload.data.job_id}`)).data;
+      }
+      if (job.status === "failed") {
+        throw new Error(job.error);
+      }
+
+      const result = job.result;
+      if (result.message) {
+        setMessage(result.message);
       }
-      if (response.data.best_frame) {
-        setBestFrame(response.data.best_frame);
-        console.log(response.data.best_frame)
-        setMessage(response.data.message);
+      if (result.best_frame) {
+        setBestFrame(result.best_frame);
+        console.log(result.best_frame)
+        setMessage(result.message);
         setNotDetected(false);
         setShowEstimate(true);
         setShow(false);
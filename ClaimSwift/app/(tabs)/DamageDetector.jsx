@@ -140,23 +140,52 @@ const DamageDetector = () => {
       });
 
       setLoading(true);
+
+      // The server streams one NDJSON line per frame; render each frame as soon as it arrives
+      let consumed = 0;
+      let framesReceived = 0;
+      const handleStreamText = (text) => {
+        const lines = text.slice(consumed).split("\n");
+        lines.pop(); // last piece is an incomplete line (or empty after a trailing newline)
+        lines.forEach((line) => {
+          consumed += line.length + 1;
+          if (!line.trim()) {
+            return;
+          }
+          const message = JSON.parse(line);
+          if (message.type === "frame") {
+            framesReceived += 1;
+            setDamageImages((prev) => [...(prev || []), message.frame]);
+            setLabels((prev) => [...(prev || []), message.label]);
+          } else if (message.type === "error") {
+            Alert.alert("Error", message.error);
+          }
+        });
+      };
+
       const response = await axios.post(
-        "http://192.168.1.47:5000/upload_video",
-        //"http://172.16.23.48:5000/upload_video", // Ensure this IP matches the Flask server IP
-        //"http://192.168.0.109:5000/upload_video",
+        "http://192.168.1.47:5000/upload_video?stream=1",
+        //"http://172.16.23.48:5000/upload_video?stream=1", // Ensure this IP matches the Flask server IP
+        //"http://192.168.0.109:5000/upload_video?stream=1",
         formData,
         {
           headers: {
             "Content-Type": "multipart/form-data",
+            Accept: "application/x-ndjson",
+          },
+          responseType: "text",
+          onDownloadProgress: (progressEvent) => {
+            const xhr = progressEvent.event?.target;
+            if (xhr && xhr.responseText) {
+              handleStreamText(xhr.responseText);
+            }
           },
         }
       );
-      if (response.data.images || response.data.frames) {
-        //setDamageResults(response.data.damage_info);
-        setDamageImages(response.data.frames); // Set the images received
-        //setDamageImages(response.data.images);
-        setLabels(response.data.labels);
-      } else {
+      if (typeof response.data === "string") {
+        handleStreamText(response.data);
+      }
+      if (framesReceived === 0) {
         Alert.alert("Error", "No damage information received.");
       }
     } catch (error) {